@@ -1,13 +1,17 @@
 import os
-import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from logging_config import configure_logging
+from metrics import start_metrics_writer
+
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+configure_logging()
+# Write this process's metrics where /metrics in any process can read them
+start_metrics_writer()
 
 class Base(DeclarativeBase):
     pass
@@ -34,13 +38,12 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # initialize the app with the extension
 db.init_app(app)
 
-# Register routes and initialize models after app creation
+# Register routes and initialize models after app creation. The database
+# schema is created by `flask init-db`, not on every worker start.
 with app.app_context():
     # Import models and routes
     from models import User, Document, Chat, Report  # noqa: F401
     import routes  # noqa: F401
-    
-    # Create database tables
-    db.create_all()
+    import commands  # noqa: F401
 
     app.logger.info("Application initialized successfully")
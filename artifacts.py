@@ -0,0 +1,219 @@
+"""
+Stored intermediate results of document processing.
+
+The raw text extracted from a file and the chunks made from it are kept
+as gzip-compressed JSON Lines files, keyed by the file's content hash and extension, so
+reprocessing, re-chunking experiments and re-embedding read them instead
+of parsing the PDF or DOCX again. Every file starts with a header naming
+its kind and version:
+
+    artifacts/ab/<hash>-<extension>.text.e<extraction version>.jsonl.gz
+        one line per piece of text (PDF page, DOCX paragraph, TXT block)
+        with its character offset in the whole text
+    artifacts/ab/<hash>-<extension>.chunks.e<extraction version>-c<chunker version>-<max tokens>-<overlap>.jsonl.gz
+        one line per chunk, with its offsets in the cleaned text
+
+Files are written atomically, and a missing, unreadable or outdated file
+is treated as absent.
+"""
+import os
+import glob
+import gzip
+import json
+import logging
+import tempfile
+
+from utils import (iter_raw_text, file_sha256, file_extension, CHUNKER_VERSION,
+                   CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS)
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+ARTIFACT_DIRECTORY = os.environ.get(
+    "ARTIFACT_DIRECTORY", os.path.join(os.getcwd(), 'artifacts')
+)
+
+# Bump whenever a change to text extraction changes its output
+EXTRACTION_VERSION = 1
+
+def artifact_key(content_hash, file_path):
+    """
+    Key of a document's artifacts: its content hash, computed from the file
+    for documents stored before uploads were hashed, and its file extension,
+    since the same bytes are extracted differently as a PDF, DOCX or TXT
+
+    Returns:
+        str: The key, or None if there is no hash and the file is missing
+    """
+    if not content_hash:
+        try:
+            content_hash = file_sha256(file_path)
+        except OSError:
+            return None
+    return f"{content_hash}-{file_extension(file_path)}"
+
+def chunker_version(max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """Version of the chunks made with the given settings from the current text"""
+    return f"e{EXTRACTION_VERSION}-c{CHUNKER_VERSION}-{max_tokens}-{overlap_tokens}"
+
+def _path(key, kind, version):
+    return os.path.join(ARTIFACT_DIRECTORY, key[:2], f"{key}.{kind}.{version}.jsonl.gz")
+
+def _read(key, kind, version):
+    """
+    Records of an artifact, read lazily from the file, or None if it is
+    absent, unreadable or outdated. The header is checked right away; an
+    error further into the file is logged, the file is deleted so it will
+    be made again, and the error is raised to the consumer.
+    """
+    path = _path(key, kind, version)
+    if not os.path.exists(path):
+        return None
+    file = None
+    try:
+        file = gzip.open(path, 'rt', encoding='utf-8')
+        header = json.loads(file.readline())
+    except (OSError, ValueError, EOFError) as e:
+        logger.warning(f"Could not read {kind} artifact {path}: {str(e)}")
+        if file:
+            file.close()
+        return None
+    if header.get("kind") != kind or header.get("version") != version:
+        file.close()
+        return None
+    return _iter_records(file, path, kind)
+
+def _iter_records(file, path, kind):
+    """Yield the records of an open artifact after its header, then close it"""
+    with file:
+        try:
+            for line in file:
+                yield json.loads(line)
+        except (OSError, ValueError, EOFError) as e:
+            logger.warning(f"Could not read {kind} artifact {path}: {str(e)}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            raise
+
+class _ArtifactWriter:
+    """Write an artifact to a temporary file, moved into place by commit()"""
+
+    def __init__(self, key, kind, version):
+        self.path = _path(key, kind, version)
+        directory, name = os.path.split(self.path)
+        os.makedirs(directory, exist_ok=True)
+        # Unique per writer, as threads of one process may store the same
+        # artifact at once
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{name}.", suffix=".tmp")
+        os.close(fd)
+        self.file = gzip.open(self.tmp_path, 'wt', encoding='utf-8')
+        self.write({"kind": kind, "version": version})
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+def iter_text_pieces(key, file_path):
+    """
+    Yield the raw text of a document piece by piece, from its text artifact
+    if there is one. Otherwise the file is parsed, and the artifact is saved
+    once all of it has been read without errors. An extraction error, or an
+    artifact found corrupt partway through, is logged and raised, as the
+    pieces already yielded are only part of the text; the corrupt artifact
+    is deleted.
+
+    Args:
+        key (str): Artifact key of the document, or None to just parse the file
+        file_path (str): Path to the document's file
+
+    Yields:
+        str: Consecutive pieces of the text
+    """
+    if key is not None:
+        records = _read(key, "text", f"e{EXTRACTION_VERSION}")
+        if records is not None:
+            for record in records:
+                yield record["text"]
+            return
+
+    writer = None
+    if key is not None:
+        try:
+            writer = _ArtifactWriter(key, "text", f"e{EXTRACTION_VERSION}")
+        except OSError as e:
+            logger.warning(f"Could not store text of {file_path}: {str(e)}")
+    complete = False
+    try:
+        offset = 0
+        for number, piece in enumerate(iter_raw_text(file_path)):
+            if writer:
+                writer.write({"piece": number, "offset": offset, "text": piece})
+            offset += len(piece)
+            yield piece
+        complete = True
+    except Exception as e:
+        logger.error(f"Error extracting text from {file_path}: {str(e)}")
+        raise
+    finally:
+        if writer:
+            # Only text read to the end without errors is kept
+            if complete and offset:
+                writer.commit()
+            else:
+                writer.discard()
+
+def load_chunks(key, version=None):
+    """
+    Stored chunks of a document
+
+    Args:
+        key (str): Artifact key of the document
+        version (str): Chunker version, the current settings' by default
+
+    Returns:
+        list: (start offset, end offset, text) of each chunk in order, or
+        None if none are stored for the version
+    """
+    records = _read(key, "chunks", version or chunker_version())
+    if records is None:
+        return None
+    try:
+        return [(record["start"], record["end"], record["text"]) for record in records]
+    except (OSError, ValueError, EOFError):
+        # Already logged; the chunks are made again
+        return None
+
+def save_chunks(key, chunks, version=None):
+    """
+    Store the chunks of a document made by a chunker version, as
+    (start offset, end offset, text) tuples. Failing to store them is
+    logged, as they can always be made again.
+    """
+    writer = None
+    try:
+        writer = _ArtifactWriter(key, "chunks", version or chunker_version())
+        for index, (start, end, text) in enumerate(chunks):
+            writer.write({"index": index, "start": start, "end": end, "text": text})
+        writer.commit()
+    except OSError as e:
+        logger.warning(f"Could not store chunks of {key}: {str(e)}")
+        if writer:
+            writer.discard()
+
+def delete_artifacts(key):
+    """Delete every stored artifact of a document"""
+    for path in glob.glob(os.path.join(ARTIFACT_DIRECTORY, key[:2], f"{key}.*")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,724 @@
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+import statistics
+import subprocess
+import click
+import numpy as np
+
+from app import app, db
+from models import User, Document
+
+# Page size for scanning the vector store
+SCAN_BATCH_SIZE = 1000
+
+@app.cli.command("init-db")
+def init_db():
+    """Create database tables and add columns and indexes missing from older databases."""
+    from migrations import upgrade_schema
+    
+    db.create_all()
+    upgrade_schema()
+    click.echo("Database schema is up to date")
+
+def _directory_size(path):
+    """Total size in bytes of the files under a directory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _query_latency_ms(collection, user_ids, dimensions, repeats=5):
+    """Median latency of a user-filtered vector query, in milliseconds"""
+    if not user_ids or not dimensions:
+        return None
+
+    rng = np.random.default_rng(0)
+    timings = []
+    for user_id in user_ids:
+        for _ in range(repeats):
+            query = rng.standard_normal(dimensions).tolist()
+            started = time.perf_counter()
+            collection.query(query_embeddings=[query], n_results=5, where={"user_id": user_id})
+            timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+@app.cli.command("gc-vectors")
+@click.option("--dry-run", is_flag=True, help="Report what would be deleted without deleting it.")
+@click.option("--requeue-missing", is_flag=True,
+              help="Queue processed documents that have no vectors for reprocessing.")
+def gc_vectors(dry_run, requeue_missing):
+    """Reconcile the vector store against the Document table."""
+    from rag import get_document_collection, documents_changed, PERSISTENCE_DIRECTORY
+    
+    document_collection = get_document_collection()
+
+    # Map every stored chunk to its document
+    chunk_ids_by_document = {}
+    user_by_document = {}
+    dimensions = None
+    offset = 0
+    while True:
+        page = document_collection.get(include=["metadatas"], limit=SCAN_BATCH_SIZE, offset=offset)
+        if not page['ids']:
+            break
+        for chunk_id, metadata in zip(page['ids'], page['metadatas']):
+            document_id = metadata.get("document_id")
+            chunk_ids_by_document.setdefault(document_id, []).append(chunk_id)
+            user_by_document[document_id] = metadata.get("user_id")
+        offset += len(page['ids'])
+
+    sample = document_collection.get(limit=1, include=["embeddings"])
+    if sample['ids']:
+        dimensions = len(sample['embeddings'][0])
+
+    document_ids = set(db.session.execute(db.select(Document.id)).scalars())
+    orphaned = {document_id: chunk_ids for document_id, chunk_ids in chunk_ids_by_document.items()
+                if document_id not in document_ids}
+    orphaned_chunks = sum(len(chunk_ids) for chunk_ids in orphaned.values())
+    missing = db.session.execute(
+        db.select(Document).where(Document.is_processed.is_(True),
+                                  Document.id.notin_(list(chunk_ids_by_document)))
+    ).scalars().all()
+
+    click.echo(f"Chunks in vector store: {offset} from {len(chunk_ids_by_document)} documents")
+    click.echo(f"Orphaned chunks: {orphaned_chunks} from {len(orphaned)} deleted documents")
+    click.echo(f"Processed documents without vectors: {len(missing)}")
+
+    if dry_run:
+        return
+
+    user_ids = db.session.execute(db.select(User.id).limit(5)).scalars().all()
+    size_before = _directory_size(PERSISTENCE_DIRECTORY)
+    latency_before = _query_latency_ms(document_collection, user_ids, dimensions)
+
+    chunk_ids = [chunk_id for ids in orphaned.values() for chunk_id in ids]
+    for start in range(0, len(chunk_ids), SCAN_BATCH_SIZE):
+        document_collection.delete(ids=chunk_ids[start:start + SCAN_BATCH_SIZE])
+
+    affected_users = {user_by_document[document_id] for document_id in orphaned}
+    existing_users = set(db.session.execute(
+        db.select(User.id).where(User.id.in_([user_id for user_id in affected_users if user_id is not None]))
+    ).scalars())
+    for user_id in existing_users:
+        documents_changed(user_id)
+
+    if requeue_missing:
+        for document in missing:
+            document.is_processed = False
+            document.status = 'queued'
+            document.progress = 0
+            document.attempts = 0
+        db.session.commit()
+        click.echo(f"Queued {len(missing)} documents for reprocessing")
+
+    size_after = _directory_size(PERSISTENCE_DIRECTORY)
+    latency_after = _query_latency_ms(document_collection, user_ids, dimensions)
+
+    click.echo(f"Deleted {len(chunk_ids)} orphaned chunks")
+    click.echo(f"Vector store size: {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB "
+               f"(reclaimed {(size_before - size_after) / 1e6:.1f} MB)")
+    if latency_before is not None:
+        click.echo(f"Median filtered query latency: {latency_before:.1f} ms -> {latency_after:.1f} ms")
+
+def _requests_per_second(client, request_count):
+    """Throughput of failed logins, which render a page after a user lookup"""
+    started = time.perf_counter()
+    for i in range(request_count):
+        client.post('/login', data={'username': f'bench-{i}', 'password': 'x'})
+        # Requests share the command's app context; end the session as a
+        # real request would
+        db.session.remove()
+    return request_count / (time.perf_counter() - started)
+
+@app.cli.command("bench-logging")
+@click.option("--requests", "request_count", default=500, show_default=True,
+              help="Requests to time with each logging setup.")
+def bench_logging(request_count):
+    """Compare request throughput with global DEBUG logging and the queued logging."""
+    from logging_config import configure_logging, stop_logging, DEFAULT_LOGGER_LEVELS
+    
+    root = logging.getLogger()
+    client = app.test_client()
+    _requests_per_second(client, 20)  # warm up
+    
+    with tempfile.TemporaryDirectory() as directory:
+        debug_path = os.path.join(directory, "debug.log")
+        queued_path = os.path.join(directory, "queued.log")
+        
+        # The previous setup: synchronous, formatted output of everything
+        # at DEBUG, including SQLAlchemy, httpx and chromadb
+        stop_logging()
+        with open(debug_path, "w") as stream:
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            root.addHandler(handler)
+            root.setLevel(logging.DEBUG)
+            for name in DEFAULT_LOGGER_LEVELS:
+                logging.getLogger(name).setLevel(logging.NOTSET)
+            
+            debug_rate = _requests_per_second(client, request_count)
+            root.removeHandler(handler)
+        
+        with open(queued_path, "w") as stream:
+            configure_logging(stream=stream)
+            queued_rate = _requests_per_second(client, request_count)
+            stop_logging()
+        
+        debug_size = os.path.getsize(debug_path)
+        queued_size = os.path.getsize(queued_path)
+    
+    configure_logging()
+    
+    click.echo(f"Global DEBUG logging: {debug_rate:.0f} requests/s, {debug_size / 1e3:.0f} kB of logs")
+    click.echo(f"Queued JSON logging:  {queued_rate:.0f} requests/s, {queued_size / 1e3:.0f} kB of logs")
+    click.echo(f"Throughput change: {(queued_rate / debug_rate - 1) * 100:+.0f}%")
+
+# Modules that must only be imported on first use, not at startup
+LAZY_MODULES = ("chromadb", "openai", "PyPDF2", "docx")
+STARTUP_IMPORT_BUDGET_MS = float(os.environ.get("STARTUP_IMPORT_BUDGET_MS", 1000))
+
+def _import_times(module):
+    """
+    Import a module in a fresh interpreter with -X importtime
+    
+    Returns:
+        dict: Module name to (self, cumulative) import time in microseconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=app.root_path, capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        if self_time.strip().isdigit():
+            times[name.strip()] = (int(self_time), int(cumulative))
+    return times
+
+@app.cli.command("bench-startup")
+@click.option("--runs", default=3, show_default=True, help="Fresh interpreters to time.")
+@click.option("--budget-ms", type=float, default=STARTUP_IMPORT_BUDGET_MS, show_default=True,
+              help="Fail if importing the app takes longer than this.")
+def bench_startup(runs, budget_ms):
+    """Time importing the app, as each gunicorn worker does, against a budget."""
+    totals = []
+    for _ in range(runs):
+        times = _import_times("main")
+        totals.append(times["main"][1] / 1000)
+    
+    click.echo(f"Import time of main: median {statistics.median(totals):.0f} ms "
+               f"over {runs} runs (budget {budget_ms:.0f} ms)")
+    click.echo("Slowest modules by self time:")
+    for name, (self_time, _) in sorted(times.items(), key=lambda item: -item[1][0])[:10]:
+        click.echo(f"  {self_time / 1000:8.1f} ms  {name}")
+    
+    eager = sorted({name.split(".")[0] for name in times} & set(LAZY_MODULES))
+    if eager:
+        raise click.ClickException(f"Modules meant to load lazily were imported at startup: {', '.join(eager)}")
+    if statistics.median(totals) > budget_ms:
+        raise click.ClickException("Startup import time is over budget")
+
+def _synthetic_corpus(rng, chunk_count, dimensions, topic_count=40):
+    """
+    Chunks about random topics, half of them mentioning a term that occurs
+    nowhere else, like a medication name, with embeddings near their
+    topic's centroid. Like ada-002 embeddings, all of them share a large
+    common direction, so even unrelated chunks have cosine similarity
+    around 0.7.
+    
+    Returns:
+        tuple: (chunk texts, normalized embeddings, topic of each chunk,
+        unique term of each chunk or None, topic centroids)
+    """
+    topic_words = [[f"topic{topic}word{word}" for word in range(30)] for topic in range(topic_count)]
+    shared_words = [f"shared{word}" for word in range(300)]
+    common = 2.2 * rng.standard_normal(dimensions)
+    centroids = common + rng.standard_normal((topic_count, dimensions))
+    
+    texts, topics, terms = [], [], []
+    for number in range(chunk_count):
+        topic = int(rng.integers(topic_count))
+        words = list(rng.choice(topic_words[topic], 30)) + list(rng.choice(shared_words, 30))
+        term = f"med{number:06d}" if rng.random() < 0.5 else None
+        if term:
+            words.insert(int(rng.integers(len(words))), term)
+        texts.append(" ".join(words))
+        topics.append(topic)
+        terms.append(term)
+    
+    embeddings = centroids[topics] + 0.7 * rng.standard_normal((chunk_count, dimensions))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return texts, embeddings.astype(np.float32), topics, terms, centroids
+
+def _normalized(vector):
+    return vector / np.linalg.norm(vector)
+
+@app.cli.command("bench-retrieval")
+@click.option("--chunks", "chunk_count", default=5000, show_default=True, help="Chunks in the synthetic corpus.")
+@click.option("--queries", "query_count", default=200, show_default=True, help="Queries of each kind.")
+@click.option("--top-k", default=5, show_default=True, help="Chunks retrieved per query.")
+@click.option("--dimensions", default=256, show_default=True, help="Embedding dimensions.")
+def bench_retrieval(chunk_count, query_count, top_k, dimensions):
+    """Compare recall and latency of vector, BM25 and hybrid retrieval on a synthetic corpus."""
+    from vector_index import UserVectorIndex
+    from lexical_index import LexicalIndex
+    from rag import fuse_rankings, diversify, is_lexical_decisive, RETRIEVAL_CANDIDATE_FACTOR
+    
+    rng = np.random.default_rng(0)
+    texts, embeddings, topics, terms, centroids = _synthetic_corpus(rng, chunk_count, dimensions)
+    ids = [f"chunk_{number}" for number in range(chunk_count)]
+    metadatas = [{"document_id": number, "chunk_index": 0} for number in range(chunk_count)]
+    
+    started = time.perf_counter()
+    lexical_index = LexicalIndex.from_chunks(ids, texts, metadatas)
+    build_ms = (time.perf_counter() - started) * 1000
+    vector_index = UserVectorIndex(ids, embeddings, texts, metadatas)
+    
+    # Exact queries name a chunk's unique term, but their embedding only
+    # knows its topic. Semantic queries share no terms with the chunk they
+    # want, but their embedding is close to it; some of them also mention
+    # a word of the corpus, either a common one or the unique term of
+    # another chunk, which must not divert them to the lexical fast path.
+    kinds = ("exact", "semantic", "semantic + common term", "semantic + rare term")
+    queries = []
+    with_terms = [number for number, term in enumerate(terms) if term]
+    for number in rng.choice(with_terms, query_count, replace=False):
+        embedding = _normalized(centroids[topics[number]] + 0.7 * rng.standard_normal(dimensions))
+        queries.append(("exact", f"what dose of {terms[number]} shared{rng.integers(300)}",
+                        embedding, ids[number]))
+    for number in rng.choice(chunk_count, query_count, replace=False):
+        embedding = _normalized(embeddings[number] + 0.04 * rng.standard_normal(dimensions))
+        queries.append(("semantic", "how does my companion ease my worries", embedding, ids[number]))
+    for number in rng.choice(chunk_count, query_count, replace=False):
+        embedding = _normalized(embeddings[number] + 0.04 * rng.standard_normal(dimensions))
+        queries.append(("semantic + common term", f"how does my companion ease my worries shared{rng.integers(300)}",
+                        embedding, ids[number]))
+    for number in rng.choice(chunk_count, query_count, replace=False):
+        other = int(rng.choice([other for other in with_terms[:query_count + 1] if other != number]))
+        embedding = _normalized(embeddings[number] + 0.04 * rng.standard_normal(dimensions))
+        queries.append(("semantic + rare term", f"how does my companion ease my worries with {terms[other]}",
+                        embedding, ids[number]))
+    
+    candidate_count = top_k * RETRIEVAL_CANDIDATE_FACTOR
+    
+    def vector_search(text, embedding):
+        return vector_index.search(embedding, top_k)['ids']
+    
+    def lexical_search(text, embedding):
+        return lexical_index.search(text, top_k)['ids']
+    
+    def hybrid_search(text, embedding, fast_path=True):
+        lexical = lexical_index.search(text, candidate_count)
+        if fast_path and is_lexical_decisive(lexical, top_k):
+            return lexical['ids'][:top_k], True
+        vector = vector_index.search(embedding, candidate_count, include_embeddings=True)
+        return fuse_rankings([diversify(vector), lexical], top_k)['ids'], False
+    
+    click.echo(f"Corpus: {chunk_count} chunks, {len(lexical_index.vocabulary)} terms, "
+               f"lexical index built in {build_ms:.0f} ms; {query_count} queries of each kind, top {top_k}")
+    click.echo(f"Recall per query kind: " + ", ".join(kinds))
+    click.echo(f"{'method':16} " + " ".join(f"{f'recall {number + 1}':>9}" for number in range(len(kinds)))
+               + f" {'median ms':>10} {'p95 ms':>8}")
+    
+    methods = (
+        ("vector", vector_search),
+        ("bm25", lexical_search),
+        ("hybrid", hybrid_search),
+        ("hybrid, no skip", lambda text, embedding: hybrid_search(text, embedding, fast_path=False)),
+    )
+    for name, search in methods:
+        hits = dict.fromkeys(kinds, 0)
+        skipped = dict.fromkeys(kinds, 0)
+        latencies = []
+        for kind, text, embedding, wanted in queries:
+            started = time.perf_counter()
+            result = search(text, embedding)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if isinstance(result, tuple):
+                result, fast_path = result
+                skipped[kind] += fast_path
+            hits[kind] += wanted in result
+        
+        if name == "hybrid":
+            hybrid_skipped = skipped
+        click.echo(f"{name:16} " + " ".join(f"{hits[kind] / query_count:9.2f}" for kind in kinds)
+                   + f" {statistics.median(latencies):10.2f} {np.percentile(latencies, 95):8.2f}")
+    
+    click.echo("Hybrid skipped the query embedding for "
+               + ", ".join(f"{hybrid_skipped[kind] / query_count:.0%} of {kind}" for kind in kinds)
+               + " queries; latencies exclude the embedding call itself")
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+@app.cli.command("storage-report")
+def storage_report():
+    """Report disk use of the vector store and local indexes, and vector size per storage type."""
+    from rag import get_document_collection, PERSISTENCE_DIRECTORY
+    from vector_index import (VECTOR_INDEX_DIRECTORY, VECTOR_INDEX_DTYPE, VECTOR_INDEX_RESCORE_FACTOR,
+                              STORAGE_DTYPES, storage_bytes)
+    from lexical_index import LEXICAL_INDEX_DIRECTORY
+    from embedding_cache import EMBEDDING_CACHE_PATH
+    
+    document_collection = get_document_collection()
+    chunk_count = document_collection.count()
+    sample = document_collection.get(limit=1, include=["embeddings"])
+    dimensions = len(sample['embeddings'][0]) if sample['ids'] else 1536
+    
+    cache_size = sum(_file_size(EMBEDDING_CACHE_PATH + suffix) for suffix in ("", "-wal", "-shm"))
+    click.echo(f"Chunks in vector store: {chunk_count} ({dimensions} dimensions)")
+    click.echo("Disk use:")
+    for label, size in (
+        ("ChromaDB", _directory_size(PERSISTENCE_DIRECTORY)),
+        (f"Exact-search indexes ({VECTOR_INDEX_DTYPE})", _directory_size(VECTOR_INDEX_DIRECTORY)),
+        ("Lexical indexes", _directory_size(LEXICAL_INDEX_DIRECTORY)),
+        ("Embedding cache", cache_size),
+    ):
+        click.echo(f"  {label:36} {size / 1e6:10.1f} MB")
+    
+    # Exact-search matrices are memory-mapped, so what they take on disk
+    # is also what searching them keeps in the page cache
+    click.echo(f"Vectors of all {chunk_count} chunks per exact-search storage type (disk and memory):")
+    for dtype in STORAGE_DTYPES:
+        size = storage_bytes(chunk_count, dimensions, dtype)
+        marker = "  (current)" if dtype == VECTOR_INDEX_DTYPE else ""
+        click.echo(f"  {dtype:8} {storage_bytes(1, dimensions, dtype):6} bytes/vector "
+                   f"{size / 1e6:10.1f} MB{marker}")
+    click.echo("VECTOR_INDEX_DTYPE only shrinks the exact-search indexes: ChromaDB keeps its own "
+               "float32 copy of every vector whatever the setting")
+    if VECTOR_INDEX_DTYPE != "float32" and VECTOR_INDEX_RESCORE_FACTOR > 0:
+        click.echo(f"Each {VECTOR_INDEX_DTYPE} search re-ranks its best {VECTOR_INDEX_RESCORE_FACTOR} * top_k "
+                   f"matches with vectors fetched from ChromaDB; VECTOR_INDEX_RESCORE_FACTOR=0 skips this")
+
+@app.cli.command("bench-quantization")
+@click.option("--chunks", "chunk_count", default=2000, show_default=True, help="Vectors in the synthetic corpus.")
+@click.option("--queries", "query_count", default=200, show_default=True, help="Queries to run.")
+@click.option("--top-k", default=20, show_default=True, help="Matches compared per query.")
+@click.option("--dimensions", default=1536, show_default=True, help="Embedding dimensions.")
+@click.option("--user-id", type=int, help="Use this user's stored embeddings instead of a synthetic corpus.")
+def bench_quantization(chunk_count, query_count, top_k, dimensions, user_id):
+    """Compare recall and size of exact search over float32, float16 and int8 vectors."""
+    from vector_index import UserVectorIndex, STORAGE_DTYPES, quantize, storage_bytes
+    
+    rng = np.random.default_rng(0)
+    if user_id is not None:
+        from rag import get_document_collection
+        
+        stored = get_document_collection().get(where={"user_id": user_id}, include=["embeddings"])
+        if not stored['ids']:
+            raise click.ClickException(f"User {user_id} has no stored chunks")
+        embeddings = np.asarray(stored['embeddings'], dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        chunk_count, dimensions = embeddings.shape
+    else:
+        _, embeddings, _, _, _ = _synthetic_corpus(rng, chunk_count, dimensions)
+    
+    ids = [f"chunk_{number}" for number in range(chunk_count)]
+    positions = {chunk_id: number for number, chunk_id in enumerate(ids)}
+    
+    # Queries about as similar to their closest chunk as real questions are
+    queries = embeddings[rng.integers(chunk_count, size=query_count)]
+    queries = queries + 0.6 / np.sqrt(dimensions) * rng.standard_normal(queries.shape)
+    
+    exact = UserVectorIndex(ids, embeddings, [""] * chunk_count, [{}] * chunk_count)
+    expected = [set(exact.search(query, top_k)['ids']) for query in queries]
+    
+    def full_precision(chunk_ids):
+        return embeddings[[positions[chunk_id] for chunk_id in chunk_ids]]
+    
+    click.echo(f"{chunk_count} vectors of {dimensions} dimensions, {query_count} queries, "
+               f"recall of the exact top {top_k}")
+    click.echo(f"{'storage':8} {'rescored':>8} {'MB':>8} {'bytes/vector':>13} {'recall':>7} {'median ms':>10}")
+    
+    for dtype in STORAGE_DTYPES:
+        matrix, scales = quantize(embeddings, dtype)
+        index = UserVectorIndex(ids, matrix, [""] * chunk_count, [{}] * chunk_count, scales=scales)
+        for rescored in ((False,) if dtype == "float32" else (False, True)):
+            recalls = []
+            latencies = []
+            for query, wanted in zip(queries, expected):
+                started = time.perf_counter()
+                found = index.search(query, top_k, full_precision=full_precision if rescored else None)['ids']
+                latencies.append((time.perf_counter() - started) * 1000)
+                recalls.append(len(wanted.intersection(found)) / len(wanted))
+            
+            click.echo(f"{dtype:8} {'yes' if rescored else 'no':>8} "
+                       f"{storage_bytes(chunk_count, dimensions, dtype) / 1e6:8.1f} "
+                       f"{storage_bytes(1, dimensions, dtype):13} {statistics.mean(recalls):7.3f} "
+                       f"{statistics.median(latencies):10.2f}")
+
+@app.cli.command("bench-vector-search")
+@click.option("--chunks", "chunk_count", default=2000, show_default=True, help="Chunks of each user.")
+@click.option("--users", "user_count", default=5, show_default=True,
+              help="Users sharing the ChromaDB collection; the first is searched.")
+@click.option("--queries", "query_count", default=200, show_default=True, help="Queries to run.")
+@click.option("--top-k", default=20, show_default=True, help="Matches per query, as retrieval's candidates.")
+@click.option("--dimensions", default=1536, show_default=True, help="Embedding dimensions.")
+def bench_vector_search(chunk_count, user_count, query_count, top_k, dimensions):
+    """Compare latency and recall of the per-user exact index and a user-filtered ChromaDB query."""
+    import chromadb
+    from vector_index import UserVectorIndex, VECTOR_INDEX_DTYPE, quantize
+
+    rng = np.random.default_rng(0)
+    texts, embeddings, _, _, _ = _synthetic_corpus(rng, chunk_count * user_count, dimensions)
+    ids = [f"chunk_{number}" for number in range(chunk_count * user_count)]
+    metadatas = [{"user_id": number // chunk_count, "document_id": number, "chunk_index": 0}
+                 for number in range(chunk_count * user_count)]
+
+    # Queries about as similar to their closest chunk as real questions are
+    user_embeddings = embeddings[:chunk_count]
+    queries = user_embeddings[rng.integers(chunk_count, size=query_count)]
+    queries = queries + 0.6 / np.sqrt(dimensions) * rng.standard_normal(queries.shape)
+
+    # Built as build_user_index builds it, from the searched user's chunks
+    matrix, scales = quantize(user_embeddings, VECTOR_INDEX_DTYPE)
+    index = UserVectorIndex(ids[:chunk_count], matrix, texts[:chunk_count], metadatas[:chunk_count], scales=scales)
+    exact = UserVectorIndex(ids[:chunk_count], user_embeddings, texts[:chunk_count], metadatas[:chunk_count])
+    expected = [set(exact.search(query, top_k)['ids']) for query in queries]
+
+    with tempfile.TemporaryDirectory() as directory:
+        collection = chromadb.PersistentClient(path=directory).get_or_create_collection(
+            name="esa_documents", metadata={"hnsw:space": "cosine"})
+        started = time.perf_counter()
+        for start in range(0, len(ids), SCAN_BATCH_SIZE):
+            end = start + SCAN_BATCH_SIZE
+            collection.add(ids=ids[start:end], embeddings=embeddings[start:end],
+                           documents=texts[start:end], metadatas=metadatas[start:end])
+        load_seconds = time.perf_counter() - started
+
+        # Both fetch what retrieval needs: texts, metadata, distances and embeddings
+        methods = (
+            (f"exact index ({VECTOR_INDEX_DTYPE})",
+             lambda query: index.search(query, top_k, include_embeddings=True)['ids']),
+            ("chroma query",
+             lambda query: collection.query(query_embeddings=[query.tolist()], n_results=top_k,
+                                            where={"user_id": 0},
+                                            include=["documents", "metadatas", "distances", "embeddings"]
+                                            )['ids'][0]),
+        )
+
+        click.echo(f"{user_count} users of {chunk_count} chunks, {dimensions} dimensions, loaded into ChromaDB "
+                   f"in {load_seconds:.1f} s; {query_count} queries for user 0, recall of the exact top {top_k}")
+        click.echo(f"{'method':24} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7}")
+        for name, search in methods:
+            for query in queries[:10]:
+                search(query)
+            latencies = []
+            recalls = []
+            for query, wanted in zip(queries, expected):
+                started = time.perf_counter()
+                found = search(query)
+                latencies.append((time.perf_counter() - started) * 1000)
+                recalls.append(len(wanted.intersection(found)) / len(wanted))
+            click.echo(f"{name:24} {np.percentile(latencies, 50):8.2f} {np.percentile(latencies, 95):8.2f} "
+                       f"{statistics.mean(recalls):7.3f}")
+
+def _start_stub_openai(embedding_latency=0.0, chat_latency=0.0, token_latency=0.0):
+    """
+    Serve the load test's stub OpenAI API on a local port and point the
+    shared OpenAI client at it. The client reads its address when it is
+    created, so this must run before the first OpenAI request, as it does
+    at the start of a command.
+    """
+    from loadtest import StubServer, StubOpenAIHandler
+    
+    StubOpenAIHandler.embedding_latency = embedding_latency
+    StubOpenAIHandler.chat_latency = chat_latency
+    StubOpenAIHandler.token_latency = token_latency
+    server = StubServer(("127.0.0.1", 0), StubOpenAIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    return server
+
+@app.cli.command("bench-embeddings")
+@click.option("--sizes", default="10,100,1000", show_default=True, help="Comma-separated chunk counts to embed.")
+@click.option("--latency", default=0.05, show_default=True, help="Stub embeddings request latency, seconds.")
+def bench_embeddings(sizes, latency):
+    """Compare embedding a document's chunks one request at a time and in batches, against a stub API."""
+    from unittest import mock
+    import rag
+    from embedding_cache import EmbeddingCache
+    from metrics import span_duration
+    
+    _start_stub_openai(embedding_latency=latency)
+    
+    click.echo(f"Stub embeddings latency {latency * 1000:.0f} ms per request; "
+               f"requests are also rate limited by OPENAI_EMBEDDINGS_RPS")
+    click.echo(f"{'chunks':>7} {'method':10} {'requests':>9} {'seconds':>9} {'chunks/s':>9} {'failed':>7}")
+    
+    with tempfile.TemporaryDirectory() as directory:
+        for size in (int(size) for size in sizes.split(",")):
+            # About 300 tokens each, like the chunker's output
+            texts = [f"Chunk {number} of {size}: " + "The patient reports anxiety at night and "
+                     "walks the dog every morning. " * 17 for number in range(size)]
+            
+            methods = (
+                ("per chunk", lambda: [rag.generate_embedding(text) for text in texts]),
+                ("batched", lambda: rag.generate_embeddings(texts)),
+            )
+            for name, embed in methods:
+                # An empty cache, so every chunk is sent to the API
+                cache = EmbeddingCache(os.path.join(directory, f"{name}-{size}.sqlite3"), size)
+                with mock.patch.object(rag, "embedding_cache", cache):
+                    requests_before = span_duration.count("openai.embeddings")
+                    started = time.perf_counter()
+                    vectors = embed()
+                    seconds = time.perf_counter() - started
+                    requests = span_duration.count("openai.embeddings") - requests_before
+                
+                failed = sum(1 for vector in vectors if not vector)
+                click.echo(f"{size:7} {name:10} {requests:9} {seconds:9.2f} {size / seconds:9.0f} {failed:7}")
+
+def _synthetic_pdf(path, page_count, lines_per_page=50):
+    """Write a PDF of text-only pages, each about as long as a page of a clinical record"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_numbers = []
+    for page in range(page_count):
+        lines = b"".join(b"(Page %d line %d: the patient reports anxiety at night, sleeps six hours "
+                         b"and walks the dog daily.) '\n" % (page + 1, line) for line in range(lines_per_page))
+        content = b"BT /F1 9 Tf 40 800 Td 15 TL\n" + lines + b"ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects)))
+        page_numbers.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % number for number in page_numbers), page_count)
+    
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    
+    with open(path, "wb") as file:
+        file.write(output)
+
+@app.cli.command("bench-pdf-extraction")
+@click.option("--pages", default="16,32,64,128,256,512", show_default=True,
+              help="Comma-separated page counts of the synthetic PDFs.")
+@click.option("--workers", default=max(2, os.cpu_count() or 1), show_default=True,
+              help="Processes in the extraction pool.")
+def bench_pdf_extraction(pages, workers):
+    """Compare serial and process-pool text extraction of synthetic PDFs to pick PDF_PARALLEL_MIN_PAGES."""
+    from utils import iter_pdf_pages, PDF_PARALLEL_MIN_PAGES
+    
+    cpus = os.cpu_count() or 1
+    click.echo(f"{cpus} CPUs, pool of {workers} workers, current PDF_PARALLEL_MIN_PAGES={PDF_PARALLEL_MIN_PAGES}")
+    click.echo(f"{'pages':>6} {'MB':>6} {'serial s':>9} {'parallel s':>11} {'speedup':>8}")
+    
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for page_count in (int(count) for count in pages.split(",")):
+            path = os.path.join(directory, f"synthetic-{page_count}.pdf")
+            _synthetic_pdf(path, page_count)
+            
+            started = time.perf_counter()
+            serial_pages = list(iter_pdf_pages(path, parallel_min_pages=sys.maxsize))
+            serial = time.perf_counter() - started
+            
+            started = time.perf_counter()
+            parallel_pages = list(iter_pdf_pages(path, parallel_min_pages=0, workers=workers))
+            parallel = time.perf_counter() - started
+            
+            if parallel_pages != serial_pages:
+                raise click.ClickException(f"Parallel extraction of {page_count} pages differs from serial")
+            results.append((page_count, serial, parallel))
+            click.echo(f"{page_count:6} {os.path.getsize(path) / 1e6:6.1f} {serial:9.2f} {parallel:11.2f} "
+                       f"{serial / parallel:7.2f}x")
+    
+    # The pool costs a roughly fixed start-up (spawning interpreters that
+    # import PyPDF2 and parse the file again) and then saves a share of
+    # the per-page time, so it pays off from the page count where the two
+    # are equal
+    largest, serial, parallel = results[-1]
+    per_page = serial / largest
+    startup = max(parallel - serial / min(workers, cpus), 0.0)
+    effective = min(workers, cpus)
+    if effective < 2:
+        click.echo(f"With {cpus} CPU the pool cannot be faster; keep it off with a high PDF_PARALLEL_MIN_PAGES")
+    else:
+        break_even = startup / (per_page * (1 - 1 / effective))
+        click.echo(f"Pool start-up {startup:.2f} s, {per_page * 1000:.1f} ms per page: parallel extraction "
+                   f"pays off from about {break_even:.0f} pages on this machine")
+    for cpu_count in (2, 4, 8):
+        break_even = startup / (per_page * (1 - 1 / cpu_count))
+        click.echo(f"  estimated break-even with {cpu_count} workers: {break_even:.0f} pages")
+
+def _peak_memory(run):
+    """
+    Run a function under tracemalloc
+    
+    Returns:
+        tuple: (its result, peak traced memory in bytes, seconds)
+    """
+    import tracemalloc
+    
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        result = run()
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak, seconds
+
+@app.cli.command("bench-extraction-memory")
+@click.option("--text-mb", default=16, show_default=True, help="Size of the synthetic text file.")
+@click.option("--pdf-pages", default=300, show_default=True, help="Pages of the synthetic PDF.")
+def bench_extraction_memory(text_mb, pdf_pages):
+    """Compare peak memory of whole-text and streaming extraction and chunking."""
+    from unittest import mock
+    import artifacts
+    from utils import iter_raw_text, iter_text_chunks, extract_text_from_file, split_text_into_chunks
+    
+    def count(chunks):
+        return sum(1 for _ in chunks)
+    
+    with tempfile.TemporaryDirectory() as directory:
+        text_path = os.path.join(directory, "synthetic.txt")
+        paragraph = ("Session notes: the patient reports anxiety at night, sleeps six hours and walks "
+                     "the dog daily. Symptoms ease when the dog is nearby. " * 4 + "\n\n")
+        with open(text_path, "w", encoding="utf-8") as file:
+            for _ in range(text_mb * 1024 * 1024 // len(paragraph)):
+                file.write(paragraph)
+        pdf_path = os.path.join(directory, "synthetic.pdf")
+        _synthetic_pdf(pdf_path, pdf_pages)
+        
+        click.echo(f"{'file':16} {'method':22} {'chunks':>7} {'peak MB':>8} {'seconds':>8}")
+        with mock.patch.object(artifacts, "ARTIFACT_DIRECTORY", os.path.join(directory, "artifacts")):
+            for label, path in ((f"text, {text_mb} MB", text_path), (f"PDF, {pdf_pages} pages", pdf_path)):
+                key = artifacts.artifact_key(None, path)
+                methods = (
+                    ("whole text", lambda: len(split_text_into_chunks(extract_text_from_file(path)))),
+                    ("streaming", lambda: count(iter_text_chunks(iter_raw_text(path)))),
+                    ("streaming, storing", lambda: count(iter_text_chunks(artifacts.iter_text_pieces(key, path)))),
+                    ("from stored text", lambda: count(iter_text_chunks(artifacts.iter_text_pieces(key, path)))),
+                )
+                for name, run in methods:
+                    chunks, peak, seconds = _peak_memory(run)
+                    click.echo(f"{label:16} {name:22} {chunks:7} {peak / 1e6:8.1f} {seconds:8.2f}")
+    
+    click.echo("Peaks are Python allocations traced by tracemalloc; parsing libraries' C buffers are not included")
@@ -0,0 +1,200 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+import numpy as np
+
+from metrics import register_counter
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Cache location and size. Each ada-002 entry is about 6KB, so the default
+# bound keeps the cache file around 600MB.
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH", os.path.join(os.getcwd(), 'cache', 'embeddings.sqlite3')
+)
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 100000))
+
+# How many inserts to allow between checks of the entry count
+EVICTION_CHECK_INTERVAL = 100
+
+# SQLite limits the number of bound parameters per statement
+SQL_BATCH_SIZE = 500
+
+def normalize_text(text):
+    """Normalize text so trivially different copies of a chunk share a cache key"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def cache_key(text, model):
+    """Content address of a text for a given embedding model"""
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Persistent, size-bounded LRU cache of embedding vectors.
+
+    Entries are keyed by a hash of the normalized text and the model name
+    and stored as float32 blobs in a local SQLite database, which can be
+    shared by the web and worker processes. Once the cache holds more than
+    max_entries vectors, the least recently used ones are evicted.
+
+    Cache errors are logged and treated as misses so they never break
+    embedding generation.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._inserts_since_check = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_access REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get_many(self, texts, model):
+        """
+        Look up cached embeddings for a list of texts
+
+        Args:
+            texts (list): Texts to look up
+            model (str): Embedding model name
+
+        Returns:
+            list: Embedding vector for each text, or None where it is not cached
+        """
+        keys = [cache_key(text, model) for text in texts]
+        found = {}
+
+        try:
+            with self._lock:
+                connection = self._connect()
+                now = time.time()
+                for start in range(0, len(keys), SQL_BATCH_SIZE):
+                    batch = keys[start:start + SQL_BATCH_SIZE]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = connection.execute(
+                        f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    for key, blob in rows:
+                        found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                    if rows:
+                        hit_keys = [key for key, _ in rows]
+                        connection.execute(
+                            f"UPDATE embeddings SET last_access = ? "
+                            f"WHERE key IN ({','.join('?' * len(hit_keys))})",
+                            [now] + hit_keys
+                        )
+                connection.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding cache lookup failed: {str(e)}")
+
+        results = [found.get(key) for key in keys]
+        hits = sum(1 for result in results if result is not None)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def get(self, text, model):
+        """Look up the cached embedding of a single text, or None"""
+        return self.get_many([text], model)[0]
+
+    def put_many(self, texts, embeddings, model):
+        """
+        Store embeddings for a list of texts, evicting old entries if needed
+
+        Args:
+            texts (list): Texts that were embedded
+            embeddings (list): Embedding vector for each text
+            model (str): Embedding model name
+        """
+        now = time.time()
+        rows = [
+            (cache_key(text, model), np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for text, embedding in zip(texts, embeddings) if embedding
+        ]
+        if not rows:
+            return
+
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding, last_access) VALUES (?, ?, ?)", rows
+                )
+                self._inserts_since_check += len(rows)
+                if self._inserts_since_check >= EVICTION_CHECK_INTERVAL:
+                    self._evict(connection)
+                    self._inserts_since_check = 0
+                connection.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Embedding cache store failed: {str(e)}")
+
+    def put(self, text, embedding, model):
+        """Store the embedding of a single text"""
+        self.put_many([text], [embedding], model)
+
+    def _evict(self, connection):
+        """Delete least recently used entries beyond max_entries"""
+        count = connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            connection.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_access LIMIT ?)", (excess,)
+            )
+            self.evictions += excess
+            logger.info(f"Evicted {excess} entries from the embedding cache")
+
+    def stats(self):
+        """
+        Hit/miss counters for this process plus the current cache size
+
+        Returns:
+            dict: Cache statistics
+        """
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+            "evictions": self.evictions,
+            "max_entries": self.max_entries,
+        }
+        try:
+            with self._lock:
+                stats["entries"] = self._connect().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            stats["size_bytes"] = os.path.getsize(self.path)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Could not read embedding cache size: {str(e)}")
+        return stats
+
+# Shared cache instance
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES)
+
+register_counter("esa_embedding_cache_hits_total", "Embedding cache lookups that found a vector",
+                 lambda: embedding_cache.hits)
+register_counter("esa_embedding_cache_misses_total", "Embedding cache lookups that found nothing",
+                 lambda: embedding_cache.misses)
+register_counter("esa_embedding_cache_evictions_total", "Entries evicted from the embedding cache",
+                 lambda: embedding_cache.evictions)
@@ -0,0 +1,131 @@
+import os
+import json
+import logging
+import tempfile
+import threading
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+def write_atomic(path, write):
+    """
+    Write a file by calling write with a temporary path next to it, then
+    move it into place so readers never see it half-written. Each call gets
+    its own temporary file, so threads and processes writing the same file
+    at once don't collide.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class UserIndexStore:
+    """
+    One kind of per-user search index on disk, and the copies of it loaded
+    in this process.
+
+    An index is a JSON metadata file, stamped with the user's documents
+    version it was built from, and a file of numpy arrays. The arrays are
+    written first and the metadata last; a loaded copy is reused while the
+    metadata file is unchanged.
+    """
+
+    def __init__(self, directory, arrays_extension, name):
+        self.directory = directory
+        self.arrays_extension = arrays_extension
+        self.name = name
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def paths(self, user_id):
+        """Paths of a user's metadata and arrays files"""
+        base = os.path.join(self.directory, f"user_{user_id}")
+        return base + ".json", base + self.arrays_extension
+
+    def load(self, user_id, documents_version, from_files):
+        """
+        Load a user's index from disk, reusing the in-process copy while the
+        files are unchanged
+
+        Args:
+            user_id (int): ID of the user
+            documents_version (int): The user's current documents version; an
+                index built from another version of their documents is stale
+            from_files (callable): Takes the metadata dict and the arrays
+                file's path and returns the index, or None if the files don't
+                belong together or are outdated
+
+        Returns:
+            The index, or None if it has not been built or is stale
+        """
+        meta_path, arrays_path = self.paths(user_id)
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+        except FileNotFoundError:
+            with self._lock:
+                self._loaded.pop(user_id, None)
+            return None
+
+        with self._lock:
+            cached = self._loaded.get(user_id)
+        if cached and cached[0] == mtime:
+            return cached[1] if cached[1].documents_version == documents_version else None
+
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            if meta.get("documents_version") != documents_version:
+                # Built from chunks read before the documents last changed,
+                # e.g. while a worker was processing one; rebuild
+                return None
+            index = from_files(meta, arrays_path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not load {self.name} index for user {user_id}: {str(e)}")
+            return None
+        if index is None:
+            return None
+
+        with self._lock:
+            self._loaded[user_id] = (mtime, index)
+        return index
+
+    def save(self, user_id, meta, write_arrays=None):
+        """
+        Write a user's index to disk
+
+        Args:
+            user_id (int): ID of the user
+            meta (dict): Metadata, including the documents version
+            write_arrays (callable): Writes the arrays file to the path it is
+                given; None removes the user's arrays file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        meta_path, arrays_path = self.paths(user_id)
+
+        if write_arrays is not None:
+            write_atomic(arrays_path, write_arrays)
+
+        def write_meta(path):
+            with open(path, 'w', encoding='utf-8') as file:
+                json.dump(meta, file)
+        write_atomic(meta_path, write_meta)
+
+        if write_arrays is None and os.path.exists(arrays_path):
+            os.remove(arrays_path)
+
+    def invalidate(self, user_id):
+        """Drop a user's index after their documents change; it is rebuilt on next use"""
+        for path in self.paths(user_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            self._loaded.pop(user_id, None)
@@ -0,0 +1,217 @@
+import os
+import re
+import logging
+import numpy as np
+
+from index_store import UserIndexStore
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_DIRECTORY = os.environ.get(
+    "LEXICAL_INDEX_DIRECTORY", os.path.join(os.getcwd(), 'lexical_index')
+)
+
+# BM25 term frequency saturation and document length normalization
+BM25_K1 = float(os.environ.get("BM25_K1", 1.2))
+BM25_B = float(os.environ.get("BM25_B", 0.75))
+
+# Words, keeping internal punctuation so doses, dates and codes like
+# "12.5mg", "2024-05-13" or "f41.1" stay one term
+_TOKEN_RE = re.compile(r"[^\W_]+(?:[.'/-][^\W_]+)*")
+
+STOPWORDS = frozenset("""
+a about after all also am an and any are as at be because been before being but by can
+could did do does doing for from had has have having he her here hers him his how i if in
+into is it its just me more most my no not now of on or other our out over she should so
+some than that the their them then there these they this those to too under up very was
+we were what when where which while who why will with would you your
+""".split())
+
+def tokenize(text):
+    """Lowercase terms of a text, without stopwords"""
+    return [term for term in _TOKEN_RE.findall(text.lower()) if term not in STOPWORDS]
+
+class LexicalIndex:
+    """
+    BM25 search over one user's chunks.
+
+    Postings are stored in compressed sparse row form: the chunk numbers
+    and term frequencies of term t are postings[offsets[t]:offsets[t + 1]].
+    Scoring a query touches only the postings of its terms.
+    """
+
+    def __init__(self, ids, documents, metadatas, vocabulary, offsets, postings, frequencies, lengths,
+                 documents_version=None):
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.vocabulary = vocabulary
+        self.terms = {term: number for number, term in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.postings = postings
+        self.frequencies = frequencies
+        self.lengths = lengths
+        # The user's documents version the index was built from
+        self.documents_version = documents_version
+        average_length = float(lengths.mean()) if len(lengths) else 0.0
+        self.length_norms = (BM25_K1 * (1 - BM25_B + BM25_B * lengths / (average_length or 1.0))
+                             ).astype(np.float32)
+
+    @classmethod
+    def from_chunks(cls, ids, documents, metadatas, documents_version=None):
+        """Index chunk texts in memory"""
+        return cls(list(ids), list(documents), list(metadatas), *_postings_arrays(documents),
+                   documents_version=documents_version)
+
+    def _idf(self, document_frequency):
+        count = len(self.ids)
+        return float(np.log1p((count - document_frequency + 0.5) / (document_frequency + 0.5)))
+
+    def search(self, query, top_k):
+        """
+        Find the chunks with the best BM25 scores for a query
+
+        Args:
+            query (str): Query text
+            top_k (int): Number of results to return
+
+        Returns:
+            dict: 'ids', 'documents', 'metadatas' and 'scores' of the chunks
+            matching any query term, best first, and the 'coverage' of each:
+            the share of the weight of the query terms found in the index
+            that it matches. 'query_terms' and 'known_terms' count the
+            query's distinct terms and those found in the index.
+        """
+        terms = set(tokenize(query))
+        results = {"ids": [], "documents": [], "metadatas": [], "scores": [], "coverage": [],
+                   "query_terms": len(terms), "known_terms": sum(term in self.terms for term in terms)}
+        if not terms or not self.ids or top_k <= 0:
+            return results
+
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        matched_weight = np.zeros(len(self.ids), dtype=np.float32)
+        total_weight = 0.0
+
+        for term in terms:
+            number = self.terms.get(term)
+            if number is None:
+                continue
+
+            start, end = self.offsets[number], self.offsets[number + 1]
+            chunks = self.postings[start:end]
+            frequencies = self.frequencies[start:end].astype(np.float32)
+            idf = self._idf(end - start)
+            total_weight += idf
+
+            # Each chunk appears once in a term's postings, so fancy-index
+            # addition is safe
+            scores[chunks] += idf * frequencies * (BM25_K1 + 1) / (frequencies + self.length_norms[chunks])
+            matched_weight[chunks] += idf
+
+        matches = np.flatnonzero(scores)
+        if not matches.size:
+            return results
+
+        k = min(top_k, matches.size)
+        top = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        results["ids"] = [self.ids[i] for i in top]
+        results["documents"] = [self.documents[i] for i in top]
+        results["metadatas"] = [self.metadatas[i] for i in top]
+        results["scores"] = [float(scores[i]) for i in top]
+        results["coverage"] = [float(matched_weight[i] / total_weight) for i in top]
+        return results
+
+_store = UserIndexStore(LEXICAL_INDEX_DIRECTORY, ".npz", "lexical")
+
+def _postings_arrays(documents):
+    """Build the vocabulary and CSR postings arrays for chunk texts"""
+    term_numbers = {}
+    entry_terms = []
+    entry_chunks = []
+    entry_frequencies = []
+    lengths = np.zeros(len(documents), dtype=np.int32)
+
+    for chunk_number, text in enumerate(documents):
+        counts = {}
+        for term in tokenize(text or ""):
+            counts[term] = counts.get(term, 0) + 1
+        lengths[chunk_number] = sum(counts.values())
+        for term, count in counts.items():
+            entry_terms.append(term_numbers.setdefault(term, len(term_numbers)))
+            entry_chunks.append(chunk_number)
+            entry_frequencies.append(count)
+
+    entry_terms = np.asarray(entry_terms, dtype=np.int32)
+    order = np.argsort(entry_terms, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(entry_terms, minlength=len(term_numbers)))))
+
+    return (
+        list(term_numbers),
+        offsets.astype(np.int64),
+        np.asarray(entry_chunks, dtype=np.int32)[order],
+        np.minimum(np.asarray(entry_frequencies, dtype=np.int64), np.iinfo(np.uint16).max)
+          .astype(np.uint16)[order],
+        lengths,
+    )
+
+def _from_files(meta, postings_path):
+    with np.load(postings_path) as arrays:
+        offsets, postings = arrays["offsets"], arrays["postings"]
+        frequencies, lengths = arrays["frequencies"], arrays["lengths"]
+    if len(lengths) != len(meta["ids"]) or len(offsets) != len(meta["vocabulary"]) + 1:
+        # Caught between writes of the two files; rebuild
+        return None
+    return LexicalIndex(meta["ids"], meta["documents"], meta["metadatas"], meta["vocabulary"],
+                        offsets, postings, frequencies, lengths, documents_version=meta["documents_version"])
+
+def load_lexical_index(user_id, documents_version):
+    """
+    Load a user's index from disk, reusing the in-process copy while the
+    files are unchanged
+
+    Args:
+        user_id (int): ID of the user
+        documents_version (int): The user's current documents version; an
+            index built from another version of their documents is stale
+
+    Returns:
+        LexicalIndex: The index, or None if it has not been built or is stale
+    """
+    return _store.load(user_id, documents_version, _from_files)
+
+def build_lexical_index(user_id, documents_version, ids, documents, metadatas):
+    """
+    Write a user's index to disk
+
+    Args:
+        user_id (int): ID of the user
+        documents_version (int): The user's documents version, read before
+            the chunks were
+        ids (list): Chunk IDs
+        documents (list): Chunk texts
+        metadatas (list): Chunk metadata dicts
+
+    Returns:
+        LexicalIndex: The new index
+    """
+    index = LexicalIndex.from_chunks(ids, documents, metadatas, documents_version=documents_version)
+
+    # np.savez appends .npz to names without it, so write through a file object
+    def write_postings(path):
+        with open(path, 'wb') as file:
+            np.savez(file, offsets=index.offsets, postings=index.postings,
+                     frequencies=index.frequencies, lengths=index.lengths)
+    meta = {"ids": index.ids, "documents": index.documents, "metadatas": index.metadatas,
+            "vocabulary": index.vocabulary, "documents_version": documents_version}
+    _store.save(user_id, meta, write_postings)
+
+    logger.info(f"Built lexical index for user {user_id} with {len(ids)} chunks "
+                f"and {len(index.vocabulary)} terms")
+    return index
+
+def invalidate_lexical_index(user_id):
+    """Drop a user's index after their documents change"""
+    _store.invalidate(user_id)
@@ -0,0 +1,295 @@
+"""
+Shared OpenAI client for the app.
+
+All OpenAI requests go through create_embeddings and create_chat_completion,
+which share one pooled HTTP client and, per endpoint:
+- a token bucket limiting the request rate
+- a cap on concurrent requests
+- retries with jittered exponential backoff on 429s, 5xx responses,
+  timeouts and connection errors, honouring Retry-After
+- a circuit breaker that fails fast while the endpoint keeps failing
+
+Limits are per process. Everything is configured through environment
+variables; OPENAI_BASE_URL points the client at a local fake server.
+The openai package is only imported when the first request is made.
+"""
+import os
+import time
+import random
+import logging
+import threading
+
+from metrics import span, record_tokens
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+
+# HTTP connection pool and timeouts, in seconds
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 50))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 30))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 5))
+OPENAI_READ_TIMEOUT = float(os.environ.get("OPENAI_READ_TIMEOUT", 60))
+
+# Retries of failed requests
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 4))
+OPENAI_RETRY_BASE_DELAY = float(os.environ.get("OPENAI_RETRY_BASE_DELAY", 0.5))
+OPENAI_RETRY_MAX_DELAY = float(os.environ.get("OPENAI_RETRY_MAX_DELAY", 20))
+
+# Circuit breaker: open after this many consecutive failed calls, then let
+# a trial request through after the cooldown
+OPENAI_BREAKER_THRESHOLD = int(os.environ.get("OPENAI_BREAKER_THRESHOLD", 5))
+OPENAI_BREAKER_COOLDOWN = float(os.environ.get("OPENAI_BREAKER_COOLDOWN", 30))
+
+class LLMUnavailableError(Exception):
+    """Raised without calling the API while an endpoint's circuit breaker is open"""
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Tokens refill continuously at `rate` per second up to `capacity`; each
+    request takes one, waiting for it if the bucket is empty.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, blocking until one is available"""
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    After `threshold` failed calls in a row the breaker opens and calls are
+    rejected for `cooldown` seconds. Then one trial call is let through:
+    success closes the breaker, failure opens it for another cooldown.
+    """
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raise LLMUnavailableError if the call should not be attempted"""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial_running or time.monotonic() - self.opened_at < self.cooldown:
+                raise LLMUnavailableError(f"OpenAI {self.name} endpoint is temporarily unavailable")
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit breaker for OpenAI {self.name} closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                logger.warning(f"Circuit breaker for OpenAI {self.name} open after "
+                               f"{self.failures} consecutive failures")
+
+class Endpoint:
+    """Rate limit, concurrency cap and circuit breaker for one API endpoint"""
+
+    def __init__(self, name, requests_per_second, burst, max_concurrent):
+        self.name = name
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.breaker = CircuitBreaker(name, OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN)
+
+def _endpoint_from_env(name, default_rps, default_concurrency):
+    prefix = f"OPENAI_{name.upper()}"
+    rps = float(os.environ.get(f"{prefix}_RPS", default_rps))
+    return Endpoint(
+        name,
+        requests_per_second=rps,
+        burst=float(os.environ.get(f"{prefix}_BURST", max(1.0, rps))),
+        max_concurrent=int(os.environ.get(f"{prefix}_MAX_CONCURRENT", default_concurrency))
+    )
+
+embeddings_endpoint = _endpoint_from_env("embeddings", default_rps=50, default_concurrency=8)
+chat_endpoint = _endpoint_from_env("chat", default_rps=10, default_concurrency=16)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Get the shared OpenAI client, creating it on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import httpx
+                from openai import OpenAI, DefaultHttpxClient
+                
+                # Initialize OpenAI client
+                # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
+                # do not change this unless explicitly requested by the user
+                # Retries are done here rather than by the SDK so they share
+                # the rate limiter and circuit breaker
+                _client = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    max_retries=0,
+                    timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+                    http_client=DefaultHttpxClient(limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+                    ))
+                )
+    return _client
+
+def _is_retryable(error):
+    """Whether a failed request may succeed if sent again"""
+    from openai import APIConnectionError, APIStatusError, RateLimitError, InternalServerError
+    
+    if isinstance(error, (RateLimitError, InternalServerError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in (408, 409)
+
+def is_bad_request(error):
+    """Whether an error is the API rejecting the request as invalid"""
+    from openai import BadRequestError
+    
+    return isinstance(error, BadRequestError)
+
+def _retry_delay(error, attempt):
+    """Full-jitter exponential backoff, but no sooner than Retry-After"""
+    delay = random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after", 0))
+        except ValueError:
+            retry_after = 0
+        delay = max(delay, min(retry_after, OPENAI_RETRY_MAX_DELAY))
+
+    return delay
+
+def _call(endpoint, create, kwargs):
+    """
+    Send a request through an endpoint's breaker, rate limiter and
+    concurrency cap, retrying transient failures
+    """
+    endpoint.breaker.before_call()
+
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        endpoint.bucket.acquire()
+        try:
+            with endpoint.slots:
+                response = create(**kwargs)
+        except Exception as e:
+            if not _is_retryable(e):
+                # The request was at fault, not the service
+                endpoint.breaker.record_success()
+                raise
+            if attempt == OPENAI_MAX_RETRIES:
+                endpoint.breaker.record_failure()
+                raise
+
+            delay = _retry_delay(e, attempt)
+            logger.warning(f"OpenAI {endpoint.name} request failed ({type(e).__name__}), "
+                           f"retrying in {delay:.2f}s")
+            time.sleep(delay)
+        else:
+            endpoint.breaker.record_success()
+            return response
+
+def _record_usage(endpoint, response):
+    """Record the token counts OpenAI reports for a response"""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record_tokens(endpoint.name, "prompt", getattr(usage, "prompt_tokens", None))
+        record_tokens(endpoint.name, "completion", getattr(usage, "completion_tokens", None))
+
+class _UsageRecordingStream:
+    """A chat completion stream that records the token usage its last chunk reports"""
+
+    def __init__(self, endpoint, stream):
+        self.endpoint = endpoint
+        self.stream = stream
+
+    def __iter__(self):
+        for chunk in self.stream:
+            if getattr(chunk, "usage", None) is not None:
+                _record_usage(self.endpoint, chunk)
+            yield chunk
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def create_embeddings(**kwargs):
+    """
+    Create embeddings; takes the arguments of client.embeddings.create
+
+    Raises:
+        LLMUnavailableError: If the circuit breaker is open
+        openai.OpenAIError: If the request failed and could not be retried
+    """
+    with span("openai.embeddings"):
+        response = _call(embeddings_endpoint, get_client().embeddings.create, kwargs)
+    _record_usage(embeddings_endpoint, response)
+    return response
+
+def create_chat_completion(**kwargs):
+    """
+    Create a chat completion; takes the arguments of
+    client.chat.completions.create
+
+    With stream=True only opening the stream is retried and counted
+    against the concurrency cap; reading it is up to the caller. The
+    stream is asked to end with a chunk reporting the token usage, which
+    is recorded once the caller reads it; that chunk has no choices.
+
+    Raises:
+        LLMUnavailableError: If the circuit breaker is open
+        openai.OpenAIError: If the request failed and could not be retried
+    """
+    if kwargs.get("stream"):
+        kwargs.setdefault("stream_options", {"include_usage": True})
+    with span("openai.chat"):
+        response = _call(chat_endpoint, get_client().chat.completions.create, kwargs)
+    if kwargs.get("stream"):
+        return _UsageRecordingStream(chat_endpoint, response)
+    _record_usage(chat_endpoint, response)
+    return response
@@ -0,0 +1,389 @@
+"""
+Load test of the full request path against local stubs.
+
+Boots the app on a local port with a temporary database, Chroma directory
+and caches, and a stub OpenAI server with configurable latency. Virtual
+users then register, log in, upload a document and wait for it to be
+processed, chat, and generate a report, with several users running
+concurrently. Background workers run in-process.
+
+Latency percentiles and throughput per endpoint are printed and saved as
+JSON; pass an earlier result file with --compare to see the change.
+
+Usage:
+    python loadtest.py [--users N] [--concurrency N] [--turns N] [--stream | --check-streaming]
+                       [--embedding-latency S] [--chat-latency S]
+                       [--output FILE] [--compare FILE]
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import httpx
+
+EMBEDDING_DIMENSIONS = 1536
+POLL_INTERVAL = 0.2
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI API: deterministic embeddings derived from the input
+    text, and chat completions echoing the last message, optionally streamed
+    """
+
+    protocol_version = "HTTP/1.1"
+    embedding_latency = 0.0
+    chat_latency = 0.0
+    token_latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        if self.path.endswith("/embeddings"):
+            time.sleep(self.embedding_latency)
+            inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+            self._send_json({
+                "object": "list",
+                "model": request["model"],
+                "data": [{"object": "embedding", "index": i, "embedding": _stub_embedding(text)}
+                         for i, text in enumerate(inputs)],
+                "usage": {"prompt_tokens": sum(len(text) // 4 for text in inputs),
+                          "total_tokens": sum(len(text) // 4 for text in inputs)},
+            })
+            return
+
+        time.sleep(self.chat_latency)
+        words = f"Stub reply about: {request['messages'][-1]['content'][:200]}".split(" ")
+
+        if not request.get("stream"):
+            self._send_json({
+                "id": "stub", "object": "chat.completion", "created": 0, "model": request["model"],
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": {"prompt_tokens": sum(len(m["content"]) // 4 for m in request["messages"]),
+                          "completion_tokens": len(words), "total_tokens": 0},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(data):
+            chunk = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+
+        for word in words:
+            send_event(json.dumps({
+                "id": "stub", "object": "chat.completion.chunk", "created": 0, "model": request["model"],
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+            }))
+            time.sleep(self.token_latency)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            # Like OpenAI, a last chunk with no choices reports the usage
+            send_event(json.dumps({
+                "id": "stub", "object": "chat.completion.chunk", "created": 0, "model": request["model"],
+                "choices": [],
+                "usage": {"prompt_tokens": sum(len(m["content"]) // 4 for m in request["messages"]),
+                          "completion_tokens": len(words), "total_tokens": 0},
+            }))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is expected
+        pass
+
+def _stub_embedding(text):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS)
+    return (vector / np.linalg.norm(vector)).round(6).tolist()
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.server_address[1]
+
+class Recorder:
+    """Thread-safe collection of latencies and errors per endpoint"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        # (first token, last token, token count) of each streamed reply
+        self.streams = []
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, ok=True):
+        with self.lock:
+            self.latencies.setdefault(name, [])
+            self.errors.setdefault(name, 0)
+            if ok:
+                self.latencies[name].append(seconds)
+            else:
+                self.errors[name] += 1
+
+    def record_stream(self, first_token, last_token, tokens):
+        with self.lock:
+            self.streams.append((first_token, last_token, tokens))
+
+    def timed(self, name, send):
+        """Time an HTTP request, counting non-2xx/3xx responses as errors"""
+        started = time.perf_counter()
+        try:
+            response = send()
+        except httpx.HTTPError:
+            self.record(name, 0, ok=False)
+            return None
+        self.record(name, time.perf_counter() - started, ok=response.status_code < 400)
+        return response
+
+    def summary(self, wall_seconds):
+        results = {}
+        for name in sorted(self.latencies):
+            samples = np.array(self.latencies[name]) * 1000
+            results[name] = {
+                "count": int(samples.size),
+                "errors": self.errors[name],
+                "requests_per_second": samples.size / wall_seconds,
+                "mean_ms": float(samples.mean()) if samples.size else None,
+                **{f"p{q}_ms": float(np.percentile(samples, q)) if samples.size else None
+                   for q in (50, 95, 99)},
+            }
+        return results
+
+def _wait_for(check, timeout):
+    """Poll until check() returns a truthy value or the timeout passes"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(POLL_INTERVAL)
+    return None
+
+def run_user(base_url, user_number, args, recorder):
+    """Drive one virtual user through the whole app"""
+    rng = random.Random(user_number)
+    name = f"load-{user_number}-{rng.randrange(10 ** 9)}"
+
+    with httpx.Client(base_url=base_url, timeout=120) as client:
+        recorder.timed("POST /register", lambda: client.post(
+            "/register", data={"username": name, "email": f"{name}@example.com", "password": "load-test"}))
+        recorder.timed("POST /login", lambda: client.post(
+            "/login", data={"username": name, "password": "load-test"}))
+        recorder.timed("GET /chat", lambda: client.get("/chat"))
+
+        # Upload a document and time how long it takes to be processed
+        paragraphs = [f"Session {i}: the patient reports anxiety level {rng.randrange(10)}, "
+                      f"sleeps {rng.randrange(4, 9)} hours and walks the dog daily. " * 3
+                      for i in range(args.paragraphs)]
+        started = time.perf_counter()
+        recorder.timed("POST /upload", lambda: client.post(
+            "/upload", files={"file": (f"{name}.txt", "\n\n".join(paragraphs).encode("utf-8"), "text/plain")}))
+
+        def document_done():
+            response = client.get("/api/documents/status")
+            documents = response.json().get("documents", []) if response.status_code == 200 else []
+            return documents and all(doc["status"] in ("done", "failed") for doc in documents)
+        processed = bool(_wait_for(document_done, args.timeout))
+        recorder.record("document processing", time.perf_counter() - started, ok=processed)
+
+        for turn in range(args.turns):
+            message = f"How does my dog help with anxiety level {rng.randrange(10)}? (turn {turn})"
+            if args.stream:
+                started = time.perf_counter()
+                first_token = last_token = None
+                tokens = 0
+                try:
+                    with client.stream("POST", "/api/chat/message/stream", json={"message": message}) as response:
+                        for line in response.iter_lines():
+                            if not line.startswith("data: ") or "token" not in json.loads(line[6:]):
+                                continue
+                            last_token = time.perf_counter() - started
+                            if first_token is None:
+                                first_token = last_token
+                            tokens += 1
+                    recorder.record("POST /api/chat/message/stream", time.perf_counter() - started,
+                                    ok=response.status_code == 200)
+                    if first_token is not None:
+                        recorder.record("stream time to first token", first_token)
+                        recorder.record_stream(first_token, last_token, tokens)
+                except httpx.HTTPError:
+                    recorder.record("POST /api/chat/message/stream", 0, ok=False)
+            else:
+                recorder.timed("POST /api/chat/message", lambda: client.post(
+                    "/api/chat/message", json={"message": message}))
+
+        recorder.timed("GET /api/chat/history", lambda: client.get("/api/chat/history"))
+
+        if args.reports:
+            started = time.perf_counter()
+            response = recorder.timed("POST /api/generate-report", lambda: client.post(
+                "/api/generate-report", json={}))
+            job_id = response.json().get("job_id") if response is not None and response.status_code < 400 else None
+
+            def report_done():
+                status = client.get(f"/api/report-jobs/{job_id}").json().get("status")
+                return status in ("done", "failed", "cancelled") and status
+            ok = job_id is not None and _wait_for(report_done, args.timeout) == "done"
+            recorder.record("report generation", time.perf_counter() - started, ok=ok)
+
+        recorder.timed("GET /reports", lambda: client.get("/reports"))
+
+def check_streaming(streams, token_latency):
+    """
+    Check that streamed replies reached the client token by token: the
+    stub waits token_latency between tokens, so the first token must
+    arrive well before the last rather than together with it, as it would
+    if the response were buffered anywhere on the way
+
+    Returns:
+        list: Descriptions of the replies that failed the check
+    """
+    failures = []
+    for first_token, last_token, tokens in streams:
+        expected = (tokens - 1) * token_latency
+        if tokens < 2 or last_token - first_token < expected / 2:
+            failures.append(f"{tokens} tokens: first after {first_token * 1000:.0f} ms, "
+                            f"last after {last_token * 1000:.0f} ms (expected about {expected * 1000:.0f} ms apart)")
+    return failures
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def _print_results(results, previous=None):
+    print(f"{'endpoint':34} {'count':>6} {'err':>4} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stats in results.items():
+        line = (f"{name:34} {stats['count']:6} {stats['errors']:4} {stats['requests_per_second']:8.2f} "
+                + " ".join(f"{stats[key]:9.1f}" if stats[key] is not None else f"{'-':>9}"
+                           for key in ("p50_ms", "p95_ms", "p99_ms")))
+        before = (previous or {}).get(name)
+        if before and before.get("p95_ms") and stats["p95_ms"]:
+            line += f"   p95 {(stats['p95_ms'] / before['p95_ms'] - 1) * 100:+.0f}%"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app against local stub services")
+    parser.add_argument("--users", type=int, default=20, help="virtual users to run in total")
+    parser.add_argument("--concurrency", type=int, default=5, help="virtual users running at once")
+    parser.add_argument("--turns", type=int, default=5, help="chat turns per user")
+    parser.add_argument("--paragraphs", type=int, default=40, help="paragraphs in each uploaded document")
+    parser.add_argument("--stream", action="store_true", help="use the streaming chat endpoint")
+    parser.add_argument("--check-streaming", action="store_true",
+                        help="use the streaming chat endpoint and fail unless every reply's first token "
+                             "arrives well before its last")
+    parser.add_argument("--no-reports", dest="reports", action="store_false", help="skip report generation")
+    parser.add_argument("--workers", type=int, default=2, help="background worker threads")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="stub embeddings latency, seconds")
+    parser.add_argument("--chat-latency", type=float, default=0.3, help="stub chat latency, seconds")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="stub delay per streamed token")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for background jobs")
+    parser.add_argument("--output", default="loadtest-results.json", help="where to save the results")
+    parser.add_argument("--compare", help="earlier results file to compare p95 latencies against")
+    args = parser.parse_args()
+    args.stream = args.stream or args.check_streaming
+
+    StubOpenAIHandler.embedding_latency = args.embedding_latency
+    StubOpenAIHandler.chat_latency = args.chat_latency
+    StubOpenAIHandler.token_latency = args.token_latency
+    stub_port = _serve(StubServer(("127.0.0.1", 0), StubOpenAIHandler))
+
+    output_path = os.path.abspath(args.output)
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            previous = json.load(file)["endpoints"]
+
+    # The app keeps its uploads, Chroma data and caches under the working
+    # directory, so run it from a scratch one
+    scratch = tempfile.TemporaryDirectory(prefix="esa-loadtest-")
+    os.chdir(scratch.name)
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(scratch.name, 'loadtest.db')}",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{stub_port}/v1",
+        "OPENAI_API_KEY": "load-test",
+        "SESSION_SECRET": "load-test",
+        "INGESTION_POLL_INTERVAL": "0.1",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("LOG_LEVELS", "werkzeug=WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from werkzeug.serving import make_server
+    from app import app, db
+    from migrations import upgrade_schema
+    import worker
+
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+
+    for i in range(args.workers):
+        threading.Thread(target=worker.run_worker, args=(0.1,), daemon=True, name=f"worker-{i}").start()
+
+    app_port = _serve(make_server("127.0.0.1", 0, app, threaded=True))
+    base_url = f"http://127.0.0.1:{app_port}"
+
+    recorder = Recorder()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(run_user, base_url, i, args, recorder) for i in range(args.users)]:
+            future.result()
+    wall_seconds = time.perf_counter() - started
+
+    results = recorder.summary(wall_seconds)
+    _print_results(results, previous)
+    print(f"{args.users} users in {wall_seconds:.1f}s")
+
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump({
+            "commit": _git_commit(),
+            "timestamp": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "config": vars(args),
+            "wall_seconds": wall_seconds,
+            "endpoints": results,
+        }, file, indent=2)
+    print(f"Results saved to {output_path}")
+
+    if args.check_streaming:
+        failures = check_streaming(recorder.streams, args.token_latency)
+        if failures or not recorder.streams:
+            print(f"Streaming check failed for {len(failures)} of {len(recorder.streams)} replies:")
+            for failure in failures[:10]:
+                print(f"  {failure}")
+            sys.exit(1)
+        print(f"Streaming check passed: the first token of all {len(recorder.streams)} replies "
+              f"arrived before the rest of the completion")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Logging setup for the web app and the background workers.
+
+Records are handed to a bounded in-memory queue by the logging call and
+written by a background thread, so request threads never block on log
+I/O. Output is one JSON object per line (LOG_FORMAT=text for plain text).
+
+Environment:
+    LOG_LEVEL          Root level, default INFO
+    LOG_LEVELS         Per-logger levels, e.g. "rag=DEBUG,sqlalchemy.engine=INFO"
+    LOG_SAMPLE_RATES   Fraction of DEBUG/INFO records kept per logger,
+                       e.g. "metrics=0.1"; warnings and errors are always kept
+    LOG_FORMAT         "json" (default) or "text"
+    LOG_QUEUE_SIZE     Records buffered before new ones are dropped
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import register_counter
+
+# Chatty third-party loggers, quiet unless LOG_LEVELS says otherwise
+DEFAULT_LOGGER_LEVELS = {
+    "sqlalchemy": "WARNING",
+    "chromadb": "WARNING",
+    "httpx": "WARNING",
+    "httpcore": "WARNING",
+    "openai": "WARNING",
+    "urllib3": "WARNING",
+    "werkzeug": "INFO",
+}
+
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+# Standard LogRecord attributes; anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener = None
+_handler = None
+# Process the listener thread runs in; forked children need their own
+_listener_pid = None
+
+def _parse_mapping(value):
+    """Parse "name=value,name=value" into a dict"""
+    mapping = {}
+    for item in (value or "").split(","):
+        name, _, setting = item.partition("=")
+        if name.strip() and setting.strip():
+            mapping[name.strip()] = setting.strip()
+    return mapping
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                    .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of DEBUG and INFO records from high-volume loggers.
+    Rates apply to a logger and its children; the most specific name wins.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {name: float(rate) for name, rate in rates.items()}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition(".")[0]
+        return True
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    QueueHandler that never blocks the logging thread: when the queue is
+    full the record is dropped and counted
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Merge the arguments and render any traceback now, while they are
+        # valid, but leave the formatting to the listener thread
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def configure_logging(stream=None):
+    """
+    Install queue-based logging on the root logger, configured from the
+    environment. Safe to call more than once: later calls in the same
+    process do nothing, while a forked child gets its own writer thread.
+
+    Args:
+        stream: Where log lines are written, stderr by default
+
+    Returns:
+        NonBlockingQueueHandler: The handler installed on the root logger
+    """
+    global _listener, _handler, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        return _handler
+
+    if os.environ.get("LOG_FORMAT", "json").lower() == "text":
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    else:
+        formatter = JsonFormatter()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(formatter)
+
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(SamplingFilter(_parse_mapping(os.environ.get("LOG_SAMPLE_RATES"))))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+    levels = dict(DEFAULT_LOGGER_LEVELS)
+    levels.update(_parse_mapping(os.environ.get("LOG_LEVELS")))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    _handler = handler
+    _listener_pid = os.getpid()
+    atexit.register(stop_logging)
+    return handler
+
+def _dropped_records():
+    return _handler.dropped if _handler is not None else 0
+
+register_counter("esa_log_records_dropped_total", "Log records dropped because the log queue was full",
+                 _dropped_records)
+
+def stop_logging():
+    """Flush queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
@@ -0,0 +1,335 @@
+"""
+Lightweight timing, tracing and metrics for the hot paths.
+
+Code is instrumented with the span() context manager or the timed()
+decorator. Every span records its duration in a latency histogram, and
+spans opened while handling a request are also collected into a tree that
+is logged for slow requests. Histograms are exposed in the Prometheus
+text format by the /metrics route.
+
+Recording a span costs a few microseconds, so instrumentation is left on
+in production. Metrics are kept per process, and every process also
+writes them to a file in METRICS_DIRECTORY every METRICS_WRITE_INTERVAL
+seconds; /metrics sums its own with the other processes' files, so the
+background workers and every web worker are included.
+"""
+import os
+import glob
+import json
+import time
+import atexit
+import bisect
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Requests slower than this have their span tree logged. 0 logs every request.
+TRACE_LOG_THRESHOLD = float(os.environ.get("TRACE_LOG_THRESHOLD", 2.0))
+
+# Where each process writes its metrics for /metrics to sum. Empty keeps
+# them per process.
+METRICS_DIRECTORY = os.environ.get("METRICS_DIRECTORY", os.path.join(os.getcwd(), 'metrics'))
+METRICS_WRITE_INTERVAL = float(os.environ.get("METRICS_WRITE_INTERVAL", 10))
+# Files of processes that stopped writing this long ago are removed; their
+# counts then drop out of the totals, which Prometheus treats as a reset
+METRICS_STALE_SECONDS = int(os.environ.get("METRICS_STALE_SECONDS", 3600))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+
+class Histogram:
+    """Cumulative histogram with one series per combination of label values"""
+
+    def __init__(self, name, documentation, label_names, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # Bucket counts, then the overflow (+Inf) count, count and sum
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += 1
+            series[2] += value
+
+    def count(self, *label_values):
+        """Number of observations recorded in one series"""
+        with self.lock:
+            series = self.series.get(label_values)
+            return series[1] if series else 0
+
+    def snapshot(self):
+        """Copy of every series: a list of [label values, bucket counts, count, sum]"""
+        with self.lock:
+            return [[list(labels), list(counts), count, total]
+                    for labels, (counts, count, total) in self.series.items()]
+
+    def render(self, snapshots):
+        """
+        Prometheus text format lines for this histogram
+
+        Args:
+            snapshots (list): Snapshots of this histogram from every process,
+                summed series by series
+        """
+        merged = {}
+        for snapshot in snapshots:
+            for labels, counts, count, total in snapshot:
+                series = merged.setdefault(tuple(labels), [[0] * len(counts), 0, 0.0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += count
+                series[2] += total
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, count, total) in sorted(merged.items()):
+            labels = ",".join(f'{name}="{_escape(value)}"'
+                              for name, value in zip(self.label_names, label_values))
+            prefix = f"{labels}," if labels else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+        return lines
+
+class CallbackCounter:
+    """Counter whose value is read from a callback when metrics are collected"""
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        # Count inherited from the parent of a forked process
+        self.baseline = 0
+
+    def value(self):
+        try:
+            return (self.callback() or 0) - self.baseline
+        except Exception:
+            return 0
+
+    def render(self, values):
+        """Prometheus text format lines for the sum of this counter over every process"""
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter",
+                f"{self.name} {sum(values)}"]
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+span_duration = Histogram("esa_span_duration_seconds",
+                          "Duration of instrumented operations", ("span",), LATENCY_BUCKETS)
+request_duration = Histogram("esa_http_request_duration_seconds",
+                             "Duration of HTTP requests", ("endpoint", "method", "status"), LATENCY_BUCKETS)
+llm_tokens = Histogram("esa_llm_tokens",
+                       "Tokens per OpenAI request", ("endpoint", "kind"), TOKEN_BUCKETS)
+
+HISTOGRAMS = (span_duration, request_duration, llm_tokens)
+# Added to by the modules keeping the counts, with register_counter()
+COUNTERS = []
+
+def register_counter(name, documentation, callback):
+    """
+    Export a count kept elsewhere, e.g. a cache's hits, as a counter
+
+    Args:
+        name (str): Metric name, ending in _total
+        documentation (str): Help text
+        callback: Function returning this process's current count
+    """
+    COUNTERS.append(CallbackCounter(name, documentation, callback))
+
+class Span:
+    """A timed operation and the spans opened inside it"""
+
+    __slots__ = ("name", "started", "duration", "children")
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def format(self, depth=0):
+        duration = "running" if self.duration is None else f"{self.duration * 1000:.1f}ms"
+        lines = [f"{'  ' * depth}{self.name} {duration}"]
+        for child in self.children:
+            lines.extend(child.format(depth + 1))
+        return lines
+
+# Innermost open span of the current request, if any
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+@contextmanager
+def span(name):
+    """
+    Time a block of code, recording it in the latency histogram and in the
+    span tree of the current request
+
+    Args:
+        name (str): Name of the operation
+    """
+    node = Span(name)
+    parent = _current_span.get()
+    if parent is not None:
+        parent.children.append(node)
+    token = _current_span.set(node)
+    try:
+        yield node
+    finally:
+        node.duration = time.perf_counter() - node.started
+        _current_span.reset(token)
+        span_duration.observe(node.duration, name)
+
+def timed(name=None):
+    """
+    Decorator running each call of a function in a span, named after the
+    function unless a name is given. Not for generator functions, which
+    return before their body runs.
+    """
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_tokens(endpoint, kind, count):
+    """Record the token count of an OpenAI request"""
+    if count is not None:
+        llm_tokens.observe(count, endpoint, kind)
+
+def start_trace(name):
+    """
+    Open the root span of a request's span tree
+
+    Returns:
+        tuple: The root Span and a token for finish_trace
+    """
+    root = Span(name)
+    return root, _current_span.set(root)
+
+def finish_trace(root, token):
+    """
+    Close a request's root span, logging the span tree if it was slow
+
+    Returns:
+        float: Duration of the request in seconds
+    """
+    root.duration = time.perf_counter() - root.started
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        # Finished in a different context than it started, e.g. after streaming
+        _current_span.set(None)
+
+    if root.duration >= TRACE_LOG_THRESHOLD:
+        logger.info("Slow request trace:\n" + "\n".join(root.format()))
+    return root.duration
+
+def snapshot_metrics():
+    """This process's metrics, as written to its metrics file"""
+    return {
+        "histograms": {histogram.name: histogram.snapshot() for histogram in HISTOGRAMS},
+        "counters": {counter.name: counter.value() for counter in COUNTERS},
+    }
+
+# Identifies this process's metrics file; the start time tells apart
+# processes that reuse a PID
+_process_started = time.time()
+_writer_pid = None
+
+def _metrics_file():
+    return os.path.join(METRICS_DIRECTORY, f"{os.getpid()}-{int(_process_started * 1000)}.json")
+
+def write_metrics_file():
+    """Write this process's metrics file, atomically"""
+    path = _metrics_file()
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(METRICS_DIRECTORY, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(snapshot_metrics(), file)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write metrics file {path}: {str(e)}")
+
+def _write_periodically():
+    while True:
+        time.sleep(METRICS_WRITE_INTERVAL)
+        write_metrics_file()
+
+def start_metrics_writer():
+    """
+    Start writing this process's metrics to METRICS_DIRECTORY in the
+    background. Safe to call more than once; does nothing without a
+    directory.
+    """
+    global _writer_pid
+    if not METRICS_DIRECTORY or _writer_pid == os.getpid():
+        return
+    _writer_pid = os.getpid()
+    threading.Thread(target=_write_periodically, daemon=True, name="metrics-writer").start()
+    atexit.register(write_metrics_file)
+
+def _after_fork():
+    """A forked child starts from zero metrics, with its own writer and file"""
+    global _process_started, _writer_pid
+    for histogram in HISTOGRAMS:
+        histogram.lock = threading.Lock()
+        histogram.series = {}
+    for counter in COUNTERS:
+        counter.baseline += counter.value()
+    _process_started = time.time()
+    if _writer_pid is not None:
+        _writer_pid = None
+        start_metrics_writer()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def _other_processes_metrics():
+    """Metrics files of the other processes, removing stale ones"""
+    if not METRICS_DIRECTORY:
+        return []
+    own = _metrics_file()
+    snapshots = []
+    for path in glob.glob(os.path.join(METRICS_DIRECTORY, "*.json")):
+        if path == own:
+            continue
+        try:
+            if time.time() - os.path.getmtime(path) > METRICS_STALE_SECONDS:
+                os.remove(path)
+                continue
+            with open(path, 'r', encoding='utf-8') as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            # Removed or being replaced meanwhile
+            continue
+    return snapshots
+
+def render_metrics():
+    """All metrics of every process in the Prometheus text exposition format"""
+    snapshots = [snapshot_metrics()] + _other_processes_metrics()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render([snapshot["histograms"].get(histogram.name, [])
+                                       for snapshot in snapshots]))
+    for counter in COUNTERS:
+        lines.extend(counter.render([snapshot["counters"].get(counter.name, 0)
+                                     for snapshot in snapshots]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,57 @@
+import logging
+from sqlalchemy import inspect, text
+
+from app import db
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Data fixes to run right after a column is added to an existing table,
+# keyed by (table name, column name)
+COLUMN_BACKFILLS = {
+    ('document', 'status'): (
+        "UPDATE document SET status = CASE WHEN is_processed THEN 'done' ELSE 'queued' END"
+    ),
+    ('document', 'progress'): (
+        "UPDATE document SET progress = CASE WHEN is_processed THEN 100 ELSE 0 END"
+    ),
+    ('document', 'attempts'): "UPDATE document SET attempts = 0",
+}
+
+def upgrade_schema():
+    """
+    Bring an existing database up to date with the models.
+    
+    db.create_all() only creates missing tables, so columns and indexes
+    added to existing models are created here. Safe to run on every start:
+    anything that already exists is left alone.
+    """
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ADD COLUMN {preparer.format_column(column)} {column_type}"
+                ))
+                logger.info(f"Added column {table.name}.{column.name}")
+                
+                backfill = COLUMN_BACKFILLS.get((table.name, column.name))
+                if backfill:
+                    connection.execute(text(backfill))
+            
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
+                    logger.info(f"Created index {index.name}")
@@ -1,7 +1,8 @@
 import datetime
 from app import db
 from flask_login import UserMixin
-from sqlalchemy.orm import relationship
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import relationship, query_expression
 
 
 class User(UserMixin, db.Model):
@@ -10,6 +11,8 @@ class User(UserMixin, db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     # ensure password hash field has length of at least 256
     password_hash = db.Column(db.String(256))
+    # Incremented whenever the user's documents change; part of retrieval cache keys
+    documents_version = db.Column(db.Integer, default=0)
     
     # Relationships
     documents = relationship("Document", back_populates="user")
@@ -21,6 +24,15 @@ class User(UserMixin, db.Model):
 
 
 class Document(db.Model):
+    __table_args__ = (
+        # A user's documents, optionally only the processed ones
+        db.Index('ix_document_user_id_is_processed', 'user_id', 'is_processed'),
+        # Workers polling for queued documents and recovering stale ones
+        db.Index('ix_document_status_id', 'status', 'id'),
+        # Finding other documents with the same content
+        db.Index('ix_document_content_hash', 'content_hash'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(512), nullable=False)
@@ -28,6 +40,16 @@ class Document(db.Model):
     upload_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     is_processed = db.Column(db.Boolean, default=False)
     vector_store_id = db.Column(db.String(255), nullable=True)
+    # SHA-256 of the file; the file is stored under this name, so identical
+    # uploads share it. Not set for documents uploaded before hashing.
+    content_hash = db.Column(db.String(64), nullable=True)
+    
+    # Background processing state
+    status = db.Column(db.String(20), default='queued')  # 'queued', 'extracting', 'embedding', 'done' or 'failed'
+    progress = db.Column(db.Integer, default=0)  # percent complete
+    status_message = db.Column(db.String(255), nullable=True)
+    status_updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    attempts = db.Column(db.Integer, default=0)
     
     # Foreign keys
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -35,15 +57,24 @@ class Document(db.Model):
     # Relationships
     user = relationship("User", back_populates="documents")
     
+    @property
+    def is_pending(self):
+        return self.status in ('queued', 'extracting', 'embedding')
+    
     def __repr__(self):
         return f'<Document {self.filename}>'
 
 
 class Chat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     
+    # Rolling summary of the older part of the conversation, covering all
+    # messages up to and including summary_message_id
+    summary = db.Column(db.Text, nullable=True)
+    summary_message_id = db.Column(db.Integer, nullable=True)
+    
     # Relationships
     user = relationship("User", back_populates="chats")
     messages = relationship("ChatMessage", back_populates="chat", cascade="all, delete-orphan")
@@ -53,6 +84,11 @@ class Chat(db.Model):
 
 
 class ChatMessage(db.Model):
+    # Messages are always read per chat in (timestamp, id) order
+    __table_args__ = (
+        db.Index('ix_chat_message_chat_id_timestamp_id', 'chat_id', 'timestamp', 'id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # 'user' or 'assistant'
@@ -62,17 +98,89 @@ class ChatMessage(db.Model):
     # Relationships
     chat = relationship("Chat", back_populates="messages")
     
+    @classmethod
+    def page(cls, chat_id, limit, before=None, after=None):
+        """
+        Get a page of a chat's messages using keyset pagination
+        
+        Cursors are messages of the same chat; the page holds the messages
+        immediately before or after the cursor. Without a cursor the newest
+        messages are returned. Each page is a single range scan of the
+        (chat_id, timestamp, id) index, however long the chat is.
+        
+        Args:
+            chat_id (int): ID of the chat
+            limit (int): Maximum number of messages to return
+            before (ChatMessage): Return messages older than this one
+            after (ChatMessage): Return messages newer than this one
+            
+        Returns:
+            tuple: (list of ChatMessage objects oldest first, whether more
+            messages exist beyond the page)
+        """
+        query = cls.query.filter(cls.chat_id == chat_id)
+        
+        if after is not None:
+            query = query.filter(or_(
+                cls.timestamp > after.timestamp,
+                and_(cls.timestamp == after.timestamp, cls.id > after.id)
+            )).order_by(cls.timestamp, cls.id)
+        else:
+            if before is not None:
+                query = query.filter(or_(
+                    cls.timestamp < before.timestamp,
+                    and_(cls.timestamp == before.timestamp, cls.id < before.id)
+                ))
+            query = query.order_by(cls.timestamp.desc(), cls.id.desc())
+        
+        messages = query.limit(limit + 1).all()
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if after is None:
+            messages.reverse()
+        
+        return messages, has_more
+    
+    @classmethod
+    def latest(cls, chat_id, limit, after_id=None):
+        """
+        Get the newest messages of a chat, oldest first
+        
+        Args:
+            chat_id (int): ID of the chat
+            limit (int): Maximum number of messages to return
+            after_id (int): Only return messages with a greater ID
+            
+        Returns:
+            list: ChatMessage objects
+        """
+        query = cls.query.filter(cls.chat_id == chat_id)
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+        
+        messages = query.order_by(cls.timestamp.desc(), cls.id.desc()).limit(limit).all()
+        messages.reverse()
+        return messages
+    
     def __repr__(self):
         return f'<ChatMessage {self.id} {self.role}>'
 
 
 class Report(db.Model):
+    # A user's reports, newest first
+    __table_args__ = (
+        db.Index('ix_report_user_id_creation_date', 'user_id', 'creation_date'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
     content = db.Column(db.Text, nullable=False)
     creation_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     last_updated = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     
+    # Hash of the chat transcript and document set the report was generated from
+    source_hash = db.Column(db.String(64), nullable=True, index=True)
+    
     # Foreign keys
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=True)
@@ -80,5 +188,62 @@ class Report(db.Model):
     # Relationships
     user = relationship("User", back_populates="reports")
     
+    # Start of the content, for report listings that defer loading the rest
+    preview = query_expression()
+    
     def __repr__(self):
         return f'<Report {self.title}>'
+
+
+class ReportJob(db.Model):
+    __table_args__ = (
+        # A user's pending jobs, and jobs for the same inputs
+        db.Index('ix_report_job_user_id_status', 'user_id', 'status'),
+        # Workers polling for queued jobs and recovering stale ones
+        db.Index('ix_report_job_status_id', 'status', 'id'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), default='queued')  # 'queued', 'running', 'done', 'failed' or 'cancelled'
+    progress = db.Column(db.Integer, default=0)  # percent complete
+    status_message = db.Column(db.String(255), nullable=True)
+    source_hash = db.Column(db.String(64), nullable=True)
+    cancel_requested = db.Column(db.Boolean, default=False)
+    attempts = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    status_updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    
+    # Foreign keys
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False)
+    report_id = db.Column(db.Integer, db.ForeignKey('report.id', ondelete='SET NULL'), nullable=True)
+    
+    @property
+    def is_pending(self):
+        return self.status in ('queued', 'running')
+    
+    def __repr__(self):
+        return f'<ReportJob {self.id} {self.status}>'
+
+
+class SummaryJob(db.Model):
+    __table_args__ = (
+        # Workers polling for queued jobs and recovering stale ones
+        db.Index('ix_summary_job_status_id', 'status', 'id'),
+        # Whether a chat already has an update pending
+        db.Index('ix_summary_job_chat_id_status', 'chat_id', 'status'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), default='queued')  # 'queued', 'running', 'done' or 'failed'
+    progress = db.Column(db.Integer, default=0)  # percent complete
+    status_message = db.Column(db.String(255), nullable=True)
+    attempts = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    status_updated = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    
+    # Foreign keys
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False)
+    
+    def __repr__(self):
+        return f'<SummaryJob {self.id} {self.status}>'
@@ -0,0 +1,350 @@
+import os
+import logging
+from datetime import datetime
+from sqlalchemy import update, func
+
+from app import db
+from models import Chat, ChatMessage, SummaryJob
+from utils import estimate_tokens
+from llm_client import create_chat_completion
+from metrics import timed
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Input token budgets for a chat turn and for report generation
+CHAT_PROMPT_TOKEN_BUDGET = int(os.environ.get("CHAT_PROMPT_TOKEN_BUDGET", 6000))
+REPORT_PROMPT_TOKEN_BUDGET = int(os.environ.get("REPORT_PROMPT_TOKEN_BUDGET", 24000))
+# Most of the chat budget left after instructions that RAG context may use
+CONTEXT_BUDGET_SHARE = float(os.environ.get("CONTEXT_BUDGET_SHARE", 0.5))
+# Room kept for the rolling summary of older turns
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", 600))
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "gpt-4o")
+# Newest messages, by tokens and by count, that background summary updates
+# leave out of the summary so the next chat turns still see them verbatim.
+# The count must stay below rag.CHAT_HISTORY_MAX_MESSAGES.
+SUMMARY_KEEP_TOKENS = int(os.environ.get("SUMMARY_KEEP_TOKENS", 1500))
+SUMMARY_KEEP_MESSAGES = int(os.environ.get("SUMMARY_KEEP_MESSAGES", 40))
+# Messages folded into the summary per model call
+SUMMARY_BATCH_MESSAGES = int(os.environ.get("SUMMARY_BATCH_MESSAGES", 40))
+
+# Approximate per-message formatting overhead of the chat API
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant "
+    "that is gathering information for an Emotional Support Animal (ESA) report. "
+    "Update the summary with the new messages. Keep every fact relevant to the report: "
+    "mental health conditions, symptoms, diagnoses, treatments, medications, providers, "
+    "how an animal helps the user, and personal details they shared. "
+    f"Write plain prose of at most {SUMMARY_MAX_TOKENS * 3 // 4} words."
+)
+
+def message_tokens(content):
+    """Estimated tokens of one chat message"""
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+@timed()
+def update_chat_summary(chat, messages):
+    """
+    Fold messages into the chat's rolling summary
+    
+    Only the new messages and the previous summary are sent to the model,
+    so the cost of each update doesn't grow with the conversation. The
+    summary is only saved if no other process moved its cursor meanwhile;
+    otherwise this update is discarded and the chat reloaded.
+    
+    Args:
+        chat (Chat): The chat being summarized
+        messages (list): ChatMessage objects directly following the current
+            summary, oldest first
+        
+    Returns:
+        bool: False if the model call failed
+    """
+    if not messages:
+        return True
+    
+    summarized_through = chat.summary_message_id or 0
+    transcript = "\n".join(f"{msg.role.capitalize()}: {msg.content}" for msg in messages)
+    try:
+        response = create_chat_completion(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": (
+                    f"Current summary:\n{chat.summary or '(none yet)'}\n\n"
+                    f"New messages:\n{transcript}"
+                )}
+            ]
+        )
+    except Exception as e:
+        logger.error(f"Error updating summary of chat {chat.id}: {str(e)}")
+        return False
+    
+    updated = db.session.execute(
+        update(Chat)
+        .where(Chat.id == chat.id, func.coalesce(Chat.summary_message_id, 0) == summarized_through)
+        .values(summary=response.choices[0].message.content, summary_message_id=messages[-1].id)
+    ).rowcount
+    # Committing expires the chat, so it is reloaded with whichever summary won
+    db.session.commit()
+    
+    if updated:
+        logger.info(f"Folded {len(messages)} messages into the summary of chat {chat.id}")
+    else:
+        logger.info(f"Summary of chat {chat.id} was updated concurrently; discarded this update")
+    return True
+
+def fold_into_summary(chat, through_id):
+    """
+    Fold a chat's messages from its summary cursor up to a message into its
+    summary
+    
+    Messages are read from the database in batches of
+    SUMMARY_BATCH_MESSAGES, so however many have built up none are
+    skipped and each model call stays small.
+    
+    Args:
+        chat (Chat): The chat being summarized
+        through_id (int): ID of the newest message to fold in
+        
+    Returns:
+        bool: Whether the summary now covers every message up to through_id
+    """
+    while (chat.summary_message_id or 0) < through_id:
+        batch = ChatMessage.query.filter(
+            ChatMessage.chat_id == chat.id,
+            ChatMessage.id > (chat.summary_message_id or 0),
+            ChatMessage.id <= through_id
+        ).order_by(ChatMessage.id).limit(SUMMARY_BATCH_MESSAGES).all()
+        if not batch:
+            break
+        if not update_chat_summary(chat, batch):
+            return False
+    return True
+
+def _count_newest_within(messages, token_budget):
+    """Number of newest messages whose combined tokens fit within the budget"""
+    kept = 0
+    used = 0
+    for msg in reversed(messages):
+        used += message_tokens(msg.content)
+        if used > token_budget:
+            break
+        kept += 1
+    return kept
+
+def request_chat_summary(chat):
+    """
+    Queue a background update of a chat's summary, unless one is pending
+    
+    Returns:
+        bool: Whether a job was queued
+    """
+    pending = db.session.execute(
+        db.select(SummaryJob.id)
+        .where(SummaryJob.chat_id == chat.id, SummaryJob.status.in_(('queued', 'running')))
+        .limit(1)
+    ).first()
+    if pending:
+        return False
+    
+    db.session.add(SummaryJob(chat_id=chat.id))
+    db.session.commit()
+    logger.info(f"Queued a summary update of chat {chat.id}")
+    return True
+
+def fit_history(chat, chat_messages, token_budget, defer_summary=False):
+    """
+    Fit a conversation into a token budget
+    
+    The newest messages are kept verbatim while they fit; older messages
+    not yet covered by the chat's rolling summary are folded into it.
+    
+    Args:
+        chat (Chat): The chat the messages belong to
+        chat_messages (list): ChatMessage objects, oldest first
+        token_budget (int): Tokens available for the summary and history
+        defer_summary (bool): Instead of updating the summary now, queue a
+            background update and leave the older messages out meanwhile
+        
+    Returns:
+        tuple: (summary text or None, list of ChatMessage objects to include verbatim)
+    """
+    summarized_through = chat.summary_message_id or 0
+    unsummarized = [msg for msg in chat_messages if msg.id > summarized_through]
+    
+    summary_tokens = message_tokens(SUMMARY_HEADER + chat.summary) if chat.summary else 0
+    kept = _count_newest_within(unsummarized, token_budget - summary_tokens)
+    
+    if kept < len(unsummarized) and defer_summary:
+        # Summarizing is a model call; a worker does it while this prompt
+        # makes do with the current summary
+        request_chat_summary(chat)
+        logger.info(f"Leaving {len(unsummarized) - kept} older messages of chat {chat.id} "
+                    f"out of the prompt until its summary is updated")
+    elif kept < len(unsummarized):
+        # Leave room for the summary to grow, then fold older messages into it
+        kept = _count_newest_within(unsummarized, token_budget - message_tokens(SUMMARY_HEADER) - SUMMARY_MAX_TOKENS)
+        evicted = unsummarized[:len(unsummarized) - kept]
+        if not fold_into_summary(chat, evicted[-1].id):
+            # Without a new summary the older turns are simply dropped
+            logger.warning(f"Dropping {len(evicted)} older messages of chat {chat.id} from the prompt")
+    
+    return chat.summary, unsummarized[len(unsummarized) - kept:]
+
+def _update_job_status(job, status, progress=None, message=None):
+    """Record the state of a summary job"""
+    job.status = status
+    if progress is not None:
+        job.progress = progress
+    job.status_message = message
+    job.status_updated = datetime.utcnow()
+    db.session.commit()
+
+def _summary_boundary(chat):
+    """
+    ID of the newest message of a chat to fold into its summary, leaving
+    the newest SUMMARY_KEEP_MESSAGES messages, or SUMMARY_KEEP_TOKENS of
+    them if fewer, out of it
+    """
+    summarized_through = chat.summary_message_id or 0
+    newest = db.session.execute(
+        db.select(ChatMessage.id, ChatMessage.content)
+        .where(ChatMessage.chat_id == chat.id, ChatMessage.id > summarized_through)
+        .order_by(ChatMessage.id.desc())
+        .limit(SUMMARY_KEEP_MESSAGES + 1)
+    ).all()
+    
+    used = 0
+    for position, (message_id, content) in enumerate(newest):
+        used += message_tokens(content)
+        if used > SUMMARY_KEEP_TOKENS or position == SUMMARY_KEEP_MESSAGES:
+            return message_id
+    return summarized_through
+
+@timed()
+def process_summary_job(job_id):
+    """
+    Fold the older messages of a chat into its rolling summary, for a
+    queued summary job
+    
+    Args:
+        job_id (int): ID of the SummaryJob to run
+        
+    Returns:
+        bool: Success status
+    """
+    job = db.session.get(SummaryJob, job_id)
+    
+    if not job:
+        logger.error(f"Summary job with ID {job_id} not found")
+        return False
+    
+    try:
+        chat = db.session.get(Chat, job.chat_id)
+        if not fold_into_summary(chat, _summary_boundary(chat)):
+            raise RuntimeError("the summary model call failed")
+        
+        _update_job_status(job, 'done', progress=100)
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error running summary job {job_id}: {str(e)}")
+        db.session.rollback()
+        _update_job_status(job, 'failed', message="Summary update failed")
+        return False
+
+@timed()
+def build_chat_prompt(chat, system_prompt, chat_messages, context, user_message,
+                      token_budget=CHAT_PROMPT_TOKEN_BUDGET):
+    """
+    Assemble the messages for a chat turn within a token budget
+    
+    The instructions and the user's message are always included. The
+    best-ranked RAG chunks get up to CONTEXT_BUDGET_SHARE of what is left,
+    and the conversation history fills the rest, with older turns replaced
+    by the chat's rolling summary. Turns that no longer fit are left out
+    until a worker has folded them into the summary.
+    
+    Args:
+        chat (Chat): The current chat
+        system_prompt (str): Instructions for the assistant
+        chat_messages (list): Earlier ChatMessage objects, oldest first
+        context (list): Relevant document chunks, best first
+        user_message (str): The user's new message
+        token_budget (int): Total input tokens allowed
+        
+    Returns:
+        tuple: (messages for the chat completions API, dict of estimated
+        tokens used by each section)
+    """
+    usage = {
+        "instructions": message_tokens(system_prompt),
+        "user_message": message_tokens(user_message),
+    }
+    available = token_budget - usage["instructions"] - usage["user_message"]
+    
+    # RAG context, best-ranked chunks first
+    context_header = "I've found some relevant information from your documents that might help: \n\n"
+    context_footer = "\n\nLet me use this information to help you better."
+    context_budget = int(available * CONTEXT_BUDGET_SHARE)
+    context_tokens = message_tokens(context_header + context_footer)
+    selected_context = []
+    for chunk in context or []:
+        cost = estimate_tokens(chunk) + 2
+        if context_tokens + cost > context_budget:
+            break
+        context_tokens += cost
+        selected_context.append(chunk)
+    usage["context"] = context_tokens if selected_context else 0
+    
+    # Conversation history and summary
+    summary, history = fit_history(chat, chat_messages, available - usage["context"], defer_summary=True)
+    summary_message = SUMMARY_HEADER + summary if summary else None
+    usage["summary"] = message_tokens(summary_message) if summary_message else 0
+    usage["history"] = sum(message_tokens(msg.content) for msg in history)
+    
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary_message:
+        messages.append({"role": "system", "content": summary_message})
+    for msg in history:
+        messages.append({"role": msg.role, "content": msg.content})
+    if selected_context:
+        messages.append({"role": "assistant", "content": (
+            context_header + "\n\n---\n\n".join(selected_context) + context_footer
+        )})
+    messages.append({"role": "user", "content": user_message})
+    
+    usage["total"] = sum(usage.values())
+    logger.info(f"Chat {chat.id} prompt tokens: {usage}")
+    return messages, usage
+
+def build_report_transcript(chat, chat_messages, token_budget=REPORT_PROMPT_TOKEN_BUDGET):
+    """
+    Format a conversation for the report prompt within a token budget
+    
+    Args:
+        chat (Chat): The chat being reported on
+        chat_messages (list): ChatMessage objects, oldest first
+        token_budget (int): Tokens available for the transcript
+        
+    Returns:
+        tuple: (transcript text, dict of estimated tokens used by each section)
+    """
+    summary, history = fit_history(chat, chat_messages, token_budget)
+    
+    parts = []
+    if summary:
+        parts.append(SUMMARY_HEADER + summary + "\n")
+    parts.extend(f"{msg.role.capitalize()}: {msg.content}" for msg in history)
+    
+    usage = {
+        "summary": message_tokens(SUMMARY_HEADER + summary) if summary else 0,
+        "history": sum(message_tokens(msg.content) for msg in history),
+    }
+    logger.info(f"Chat {chat.id} report transcript tokens: {usage}")
+    return "\n".join(parts), usage
@@ -0,0 +1,184 @@
+"""
+Query-count and latency regression check of the list and detail pages.
+
+Seeds users with a few and with many documents, chat messages, reports
+and report jobs, then requests every page that lists them and counts the
+SQL statements each request runs with a before_cursor_execute listener.
+A page fails the check if it runs more statements for the larger user,
+which is an N+1 query, or more than its budget in QUERY_BUDGETS. Median
+latencies are printed alongside.
+
+Runs against a scratch SQLite database by default. Pass --database-url
+to check Postgres; it must point at an empty scratch database, as the
+tables are created in it and dropped afterwards.
+
+Usage:
+    python query_check.py [--sizes 5,200] [--repeat 20] [--database-url URL]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+# Most SQL statements each page may run: loading the logged-in user, the
+# page's own queries and nothing per listed row
+QUERY_BUDGETS = {
+    "GET /chat": 4,
+    "GET /upload": 2,
+    "GET /reports": 3,
+    "GET /reports/<id>": 2,
+    "GET /api/chat/history": 2,
+    "GET /api/documents/status": 2,
+    "GET /api/report-jobs/<id>": 2,
+}
+
+def seed_user(db, models, name, size):
+    """
+    Create a user with size documents, chat messages, reports and pending
+    report jobs
+
+    Returns:
+        dict: IDs of the user, their chat, a report and a report job
+    """
+    from werkzeug.security import generate_password_hash
+
+    user = models.User(username=name, email=f"{name}@example.com",
+                       password_hash=generate_password_hash("query-check"))
+    db.session.add(user)
+    db.session.flush()
+    chat = models.Chat(user_id=user.id)
+    db.session.add(chat)
+    db.session.flush()
+
+    for i in range(size):
+        db.session.add(models.Document(filename=f"document-{i}.txt", file_path=f"/nonexistent/{name}-{i}.txt",
+                                       file_type="txt", user_id=user.id, status="done", is_processed=True))
+        db.session.add(models.ChatMessage(chat_id=chat.id, role="user" if i % 2 == 0 else "assistant",
+                                          content=f"Message {i} about how my dog helps with anxiety."))
+        db.session.add(models.Report(title=f"ESA Report {i}", content="Report text. " * 200,
+                                     user_id=user.id, chat_id=chat.id))
+        db.session.add(models.ReportJob(user_id=user.id, chat_id=chat.id,
+                                        status="queued" if i % 2 == 0 else "running"))
+    db.session.commit()
+
+    return {
+        "user_id": user.id,
+        "chat_id": chat.id,
+        "report_id": db.session.execute(db.select(models.Report.id).filter_by(user_id=user.id).limit(1)).scalar(),
+        "job_id": db.session.execute(db.select(models.ReportJob.id).filter_by(user_id=user.id).limit(1)).scalar(),
+    }
+
+def check_pages(app, engine, username, ids, repeat):
+    """
+    Request each page as a logged-in user
+
+    Returns:
+        dict: Page name to (SQL statements per request, median seconds)
+    """
+    from sqlalchemy import event
+
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    client = app.test_client()
+    client.post("/login", data={"username": username, "password": "query-check"})
+    with client.session_transaction() as session:
+        session["active_chat_id"] = ids["chat_id"]
+
+    pages = {
+        "GET /chat": "/chat",
+        "GET /upload": "/upload",
+        "GET /reports": "/reports",
+        "GET /reports/<id>": f"/reports/{ids['report_id']}",
+        "GET /api/chat/history": "/api/chat/history",
+        "GET /api/documents/status": "/api/documents/status",
+        "GET /api/report-jobs/<id>": f"/api/report-jobs/{ids['job_id']}",
+    }
+
+    results = {}
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        for name, path in pages.items():
+            # Warm up templates and caches first
+            client.get(path)
+
+            del statements[:]
+            response = client.get(path)
+            if response.status_code != 200:
+                raise RuntimeError(f"{name} returned {response.status_code}")
+            count = len(statements)
+
+            durations = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                client.get(path)
+                durations.append(time.perf_counter() - started)
+            results[name] = (count, statistics.median(durations))
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the SQL statements and latency of the list and detail pages")
+    parser.add_argument("--sizes", default="5,200",
+                        help="comma-separated records of each kind to seed per user; the first is the baseline")
+    parser.add_argument("--repeat", type=int, default=20, help="requests per page to time")
+    parser.add_argument("--database-url", help="empty scratch database to use instead of a temporary SQLite one")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    # The app keeps its uploads and caches under the working directory, so
+    # run it from a scratch one
+    scratch = tempfile.TemporaryDirectory(prefix="esa-query-check-")
+    os.chdir(scratch.name)
+    os.environ.update({
+        "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(scratch.name, 'query-check.db')}",
+        "SESSION_SECRET": "query-check",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    from app import app, db
+    import models
+
+    with app.app_context():
+        db.create_all()
+        seeded = {size: seed_user(db, models, f"query-check-{size}", size) for size in sizes}
+        engine = db.engine
+    try:
+        # Outside the seeding app context, so each request gets a fresh
+        # session instead of finding the seeded rows in its identity map
+        results = {size: check_pages(app, engine, f"query-check-{size}", seeded[size], args.repeat)
+                   for size in sizes}
+    finally:
+        if args.database_url:
+            with app.app_context():
+                db.drop_all()
+
+    print(f"{'page':28} " + " ".join(f"{f'{size} rows':>20}" for size in sizes) + f" {'budget':>7}")
+    failures = []
+    baseline = sizes[0]
+    for name, budget in QUERY_BUDGETS.items():
+        print(f"{name:28} " + " ".join(
+            f"{results[size][name][0]:>5} queries {results[size][name][1] * 1000:>5.1f} ms" for size in sizes
+        ) + f" {budget:>7}")
+        for size in sizes:
+            count = results[size][name][0]
+            if count > budget:
+                failures.append(f"{name} ran {count} queries with {size} rows, over its budget of {budget}")
+            if count > results[baseline][name][0]:
+                failures.append(f"{name} ran {count} queries with {size} rows but "
+                                f"{results[baseline][name][0]} with {baseline}")
+
+    if failures:
+        print("Query check failed:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("Query check passed: no page's query count grows with its rows")
+
+if __name__ == "__main__":
+    main()
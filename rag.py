@@ -1,43 +1,63 @@
 import os
 import logging
-from openai import OpenAI
-import chromadb
-from chromadb.config import Settings
+import time
+import datetime
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import json
+from sqlalchemy import update, func
 
 from app import app, db
-from models import Document, Chat, ChatMessage
-from utils import extract_text_from_file, split_text_into_chunks
+from models import User, Document, Chat, ChatMessage
+from utils import iter_chunk_spans, merge_chunk_spans, estimate_tokens
+from embedding_cache import embedding_cache, normalize_text
+from cache import TTLCache
+from llm_client import create_embeddings, create_chat_completion, is_bad_request
+from metrics import span, timed
+from prompt_builder import build_chat_prompt, request_chat_summary
+from vector_index import (VECTOR_INDEX_MAX_CHUNKS, load_user_index, build_user_index,
+                          mark_user_index_large, invalidate_user_index, mmr_select)
+from lexical_index import load_lexical_index, build_lexical_index, invalidate_lexical_index
+from artifacts import artifact_key, iter_text_pieces, load_chunks, save_chunks
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-# the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-# do not change this unless explicitly requested by the user
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-openai = OpenAI(api_key=OPENAI_API_KEY)
-
-# Initialize ChromaDB
+# ChromaDB is opened on first use, so requests that never touch the
+# vector store don't pay for importing and starting it
 PERSISTENCE_DIRECTORY = os.path.join(os.getcwd(), 'chromadb')
-os.makedirs(PERSISTENCE_DIRECTORY, exist_ok=True)
+_document_collection = None
+_chroma_lock = threading.Lock()
 
-# Updated ChromaDB client initialization (following newer API)
-chroma_client = chromadb.PersistentClient(
-    path=PERSISTENCE_DIRECTORY
-)
+def get_document_collection():
+    """Get the ChromaDB collection of document chunks, opening it on first use"""
+    global _document_collection
+    if _document_collection is None:
+        with _chroma_lock:
+            if _document_collection is None:
+                import chromadb
+                
+                os.makedirs(PERSISTENCE_DIRECTORY, exist_ok=True)
+                chroma_client = chromadb.PersistentClient(
+                    path=PERSISTENCE_DIRECTORY
+                )
+                # Create a collection for document embeddings
+                _document_collection = chroma_client.get_or_create_collection(
+                    name="esa_documents",
+                    metadata={"hnsw:space": "cosine"}
+                )
+    return _document_collection
 
-# Create a collection for document embeddings
-try:
-    document_collection = chroma_client.get_or_create_collection(
-        name="esa_documents",
-        metadata={"hnsw:space": "cosine"}
-    )
-except Exception as e:
-    logger.error(f"Error initializing ChromaDB collection: {str(e)}")
-    document_collection = None
+# Embedding model and request limits. The embeddings endpoint accepts up to
+# 2048 inputs per request and caps the total tokens of a request, so chunks
+# are grouped into batches that stay under both limits.
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.environ.get("EMBEDDING_BATCH_MAX_TOKENS", 250000))
 
+@timed()
 def generate_embedding(text):
     """
     Generate embedding vector for a piece of text using OpenAI's embedding API
@@ -52,20 +72,261 @@ def generate_embedding(text):
         if not text.strip():
             return []
         
-        response = openai.embeddings.create(
+        cached = embedding_cache.get(text, EMBEDDING_MODEL)
+        if cached is not None:
+            return cached
+        
+        response = create_embeddings(
             input=text,
-            model="text-embedding-ada-002"
+            model=EMBEDDING_MODEL
         )
         
-        return response.data[0].embedding
+        embedding = response.data[0].embedding
+        embedding_cache.put(text, embedding, EMBEDDING_MODEL)
+        return embedding
     except Exception as e:
         logger.error(f"Error generating embedding: {str(e)}")
         return []
 
+def _batch_indices(texts, indices):
+    """
+    Group text indices into batches that respect the per-request input
+    count and token limits of the embeddings endpoint
+    """
+    batch = []
+    batch_tokens = 0
+    
+    for i in indices:
+        tokens = estimate_tokens(texts[i])
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or
+                      batch_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    
+    if batch:
+        yield batch
+
+def _embed_batch(texts, batch, results):
+    """
+    Embed one batch of texts, storing vectors in results by index.
+    
+    Transient errors are retried by the LLM client and raised once it
+    gives up. A batch the API rejects is split in half and each half is
+    retried separately, so only the inputs that actually fail end up
+    without an embedding.
+    """
+    try:
+        response = create_embeddings(
+            input=[texts[i] for i in batch],
+            model=EMBEDDING_MODEL
+        )
+        # Results carry the position of their input; don't rely on order
+        for item in response.data:
+            results[batch[item.index]] = item.embedding
+        return
+    except Exception as e:
+        if not is_bad_request(e):
+            raise
+        error = e
+    
+    if len(batch) == 1:
+        logger.error(f"Error generating embedding for chunk {batch[0]}: {str(error)}")
+        return
+    
+    logger.warning(f"Embedding batch of {len(batch)} was rejected, retrying in halves: {str(error)}")
+    middle = len(batch) // 2
+    _embed_batch(texts, batch[:middle], results)
+    _embed_batch(texts, batch[middle:], results)
+
+@timed()
+def generate_embeddings(texts, progress_callback=None):
+    """
+    Generate embedding vectors for many texts with batched API requests
+    
+    Args:
+        texts (list): The texts to embed
+        progress_callback (callable): Optional, called as
+            progress_callback(done, total) after each batch
+        
+    Returns:
+        list: One embedding vector per input text, in input order. Empty
+        texts and texts the API rejected get an empty list.
+        
+    Raises:
+        Exception: If the embeddings API stays unavailable
+    """
+    results = [[] for _ in texts]
+    indices = [i for i, text in enumerate(texts) if text.strip()]
+    
+    # Only texts missing from the embedding cache are sent to the API
+    cached = embedding_cache.get_many([texts[i] for i in indices], EMBEDDING_MODEL)
+    missing = []
+    for i, embedding in zip(indices, cached):
+        if embedding is None:
+            missing.append(i)
+        else:
+            results[i] = embedding
+    
+    done = 0
+    for batch in _batch_indices(texts, missing):
+        _embed_batch(texts, batch, results)
+        embedding_cache.put_many([texts[i] for i in batch], [results[i] for i in batch], EMBEDDING_MODEL)
+        done += len(batch)
+        if progress_callback:
+            progress_callback(done, len(missing))
+    
+    if indices:
+        logger.info(f"Embedded {len(indices)} texts: {len(indices) - len(missing)} from cache, "
+                    f"{len(missing)} from the API")
+    return results
+
+def _update_document_status(document, status, progress=None, message=None):
+    """Record the processing state of a document so the UI can poll it"""
+    document.status = status
+    if progress is not None:
+        document.progress = progress
+    document.status_message = message
+    document.status_updated = datetime.datetime.utcnow()
+    db.session.commit()
+
+def _chunk_metadata(document, chunk_index, start=None, end=None):
+    metadata = {
+        "document_id": document.id,
+        "chunk_index": chunk_index,
+        "document_name": document.filename,
+        "user_id": document.user_id
+    }
+    # Offsets in the document's cleaned text; missing on chunks indexed
+    # before they were recorded
+    if start is not None:
+        metadata["start"] = start
+        metadata["end"] = end
+    return metadata
+
+def _copy_processed_chunks(document):
+    """
+    Copy the chunks and embeddings of another processed document with the
+    same stored file, so the file isn't extracted and embedded again
+    
+    Args:
+        document (Document): The document being processed
+        
+    Returns:
+        tuple: (ids, embeddings, metadatas, documents) for this document,
+        all empty if there is no processed copy
+    """
+    if not document.content_hash:
+        return [], [], [], []
+    
+    source_ids = db.session.execute(
+        db.select(Document.id)
+        .where(Document.content_hash == document.content_hash,
+               Document.file_path == document.file_path,
+               Document.id != document.id,
+               Document.status == 'done')
+        .order_by(Document.id.desc())
+    ).scalars().all()
+    
+    for source_id in source_ids:
+        with span("chroma.get_chunks"):
+            chunks = get_document_collection().get(
+                where={"document_id": source_id},
+                include=["embeddings", "documents", "metadatas"]
+            )
+        if not chunks['ids']:
+            continue
+        
+        order = sorted(range(len(chunks['ids'])), key=lambda i: chunks['metadatas'][i]['chunk_index'])
+        source_metadatas = [chunks['metadatas'][i] for i in order]
+        return (
+            [f"doc_{document.id}_chunk_{metadata['chunk_index']}" for metadata in source_metadatas],
+            [chunks['embeddings'][i] for i in order],
+            [_chunk_metadata(document, metadata['chunk_index'], metadata.get('start'), metadata.get('end'))
+             for metadata in source_metadatas],
+            [chunks['documents'][i] for i in order],
+        )
+    
+    return [], [], [], []
+
+def _chunk_and_embed(document):
+    """
+    Extract a document's text, split it into chunks and embed them
+    
+    Args:
+        document (Document): The document being processed
+        
+    Returns:
+        tuple: (ids, embeddings, metadatas, documents) of the chunks, or
+        None if the document failed, with its status updated
+    """
+    # Reuse the chunks stored by an earlier run with the same chunker
+    # settings; otherwise extract, clean and split the text as a streaming
+    # pipeline, reading the stored text instead of parsing the file if
+    # there is any
+    _update_document_status(document, 'extracting', progress=0)
+    with span("rag.extract_chunks"):
+        key = artifact_key(document.content_hash, document.file_path)
+        chunks = load_chunks(key) if key else None
+        if chunks is None:
+            try:
+                chunks = list(iter_chunk_spans(iter_text_pieces(key, document.file_path)))
+            except Exception:
+                # Already logged; chunks of part of the text are neither
+                # stored nor embedded
+                _update_document_status(document, 'failed', message="Text could not be extracted")
+                return None
+            if key and chunks:
+                save_chunks(key, chunks)
+    
+    # Generate embeddings and add to ChromaDB
+    if not chunks:
+        logger.warning(f"No chunks generated for document {document.filename}")
+        _update_document_status(document, 'failed', message="No text could be extracted")
+        return None
+    
+    _update_document_status(document, 'embedding', progress=10)
+    
+    def report_progress(done, total):
+        _update_document_status(document, 'embedding', progress=10 + 85 * done // total)
+    
+    ids = []
+    embeddings = []
+    metadatas = []
+    documents = []
+    
+    # Generate embeddings for all chunks in batched requests
+    chunk_embeddings = generate_embeddings([text for _, _, text in chunks], progress_callback=report_progress)
+    
+    for i, ((start, end, chunk), embedding) in enumerate(zip(chunks, chunk_embeddings)):
+        if not embedding:
+            logger.warning(f"Could not generate embedding for chunk {i} of document {document.filename}")
+            continue
+        
+        ids.append(f"doc_{document.id}_chunk_{i}")
+        embeddings.append(embedding)
+        metadatas.append(_chunk_metadata(document, i, start, end))
+        documents.append(chunk)
+    
+    if not ids:
+        logger.warning(f"No valid embeddings generated for document {document.filename}")
+        _update_document_status(document, 'failed', message="Embeddings could not be generated")
+        return None
+    
+    return ids, embeddings, metadatas, documents
+
+@timed()
 def process_document(document_id):
     """
     Process a document: extract text, chunk it, generate embeddings, and store in vector db
     
+    Progress is recorded on the document as it moves through the
+    'extracting', 'embedding' and 'done' (or 'failed') states. If another
+    document with the same file was already processed, its chunks and
+    embeddings are copied instead.
+    
     Args:
         document_id (int): ID of the document to process
         
@@ -79,109 +340,522 @@ def process_document(document_id):
         return False
     
     try:
-        # Extract text from file
-        text = extract_text_from_file(document.file_path)
-        
-        if not text:
-            logger.warning(f"No text extracted from document {document.filename}")
-            return False
-        
-        # Split text into chunks
-        chunks = split_text_into_chunks(text)
+        # An identical file that was already processed, by this user or
+        # another, has chunks and embeddings that can be copied
+        ids, embeddings, metadatas, documents = _copy_processed_chunks(document)
+        if ids:
+            logger.info(f"Reusing {len(ids)} chunks of an identical file for document {document.filename}")
+        else:
+            chunked = _chunk_and_embed(document)
+            if chunked is None:
+                return False
+            ids, embeddings, metadatas, documents = chunked
         
-        # Generate embeddings and add to ChromaDB
-        if not chunks:
-            logger.warning(f"No chunks generated for document {document.filename}")
-            return False
-        
-        ids = []
-        embeddings = []
-        metadatas = []
-        documents = []
-        
-        for i, chunk in enumerate(chunks):
-            # Generate embedding
-            embedding = generate_embedding(chunk)
-            
-            if not embedding:
-                logger.warning(f"Could not generate embedding for chunk {i} of document {document.filename}")
-                continue
-            
-            chunk_id = f"doc_{document_id}_chunk_{i}"
+        # Upsert into ChromaDB so reprocessing replaces the previous chunks,
+        # then drop chunks the new version no longer has
+        with span("chroma.upsert"):
+            get_document_collection().upsert(
+                ids=ids,
+                embeddings=embeddings,
+                metadatas=metadatas,
+                documents=documents
+            )
             
-            ids.append(chunk_id)
-            embeddings.append(embedding)
-            metadatas.append({
-                "document_id": document_id,
-                "chunk_index": i,
-                "document_name": document.filename,
-                "user_id": document.user_id
-            })
-            documents.append(chunk)
-        
-        if not ids:
-            logger.warning(f"No valid embeddings generated for document {document.filename}")
-            return False
-        
-        # Add to ChromaDB
-        document_collection.add(
-            ids=ids,
-            embeddings=embeddings,
-            metadatas=metadatas,
-            documents=documents
-        )
+            existing_ids = get_document_collection().get(where={"document_id": document_id}, include=[])['ids']
+            stale_ids = sorted(set(existing_ids) - set(ids))
+            if stale_ids:
+                get_document_collection().delete(ids=stale_ids)
+                logger.info(f"Removed {len(stale_ids)} stale chunks of document {document.filename}")
+        
+        # Drop the user's cached results and indexes, and rebuild the
+        # lexical index now rather than on their next query
+        documents_changed(document.user_id)
+        get_user_lexical_index(document.user_id)
         
         # Update document status
         document.is_processed = True
         document.vector_store_id = f"doc_{document_id}"
-        db.session.commit()
+        _update_document_status(document, 'done', progress=100)
         
         logger.info(f"Successfully processed document {document.filename} with {len(ids)} chunks")
+        logger.info(f"Embedding cache stats: {embedding_cache.stats()}")
         return True
         
     except Exception as e:
         logger.error(f"Error processing document {document_id}: {str(e)}")
+        db.session.rollback()
+        _update_document_status(document, 'failed', message="Processing error")
         return False
 
+# In-process caches for the chat hot path. Retrieval results are keyed by
+# the user's documents version, so they go stale as soon as it changes.
+QUERY_CACHE_TTL = int(os.environ.get("QUERY_CACHE_TTL", 600))
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", 1024))
+query_embedding_cache = TTLCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL)
+retrieval_cache = TTLCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL)
+
+# Retrieval fetches this many candidates per chunk it selects, then picks
+# by relevance minus redundancy with RETRIEVAL_MMR_DIVERSITY (0 to 1)
+# weighting the redundancy penalty
+RETRIEVAL_CANDIDATE_FACTOR = int(os.environ.get("RETRIEVAL_CANDIDATE_FACTOR", 4))
+RETRIEVAL_MMR_DIVERSITY = float(os.environ.get("RETRIEVAL_MMR_DIVERSITY", 0.5))
+
+# Lexical (BM25) and vector rankings are fused by reciprocal rank with
+# this constant
+RRF_K = int(os.environ.get("RRF_K", 60))
+
+# The embedding call and vector search are skipped only when the lexical
+# ranking is clearly decisive: at least this share of the query's terms
+# occur in the user's chunks, more than top_k chunks match so the best can
+# be compared with the ones left out, and the best match scores at least
+# LEXICAL_FAST_PATH_MIN_SCORE, covers at least LEXICAL_FAST_PATH_MIN_COVERAGE
+# of the weight of the known query terms and scores at least
+# LEXICAL_FAST_PATH_MIN_RATIO times the best chunk left out. A coverage
+# above 1 disables the fast path.
+LEXICAL_FAST_PATH_MIN_QUERY_COVERAGE = float(os.environ.get("LEXICAL_FAST_PATH_MIN_QUERY_COVERAGE", 0.6))
+LEXICAL_FAST_PATH_MIN_SCORE = float(os.environ.get("LEXICAL_FAST_PATH_MIN_SCORE", 4.0))
+LEXICAL_FAST_PATH_MIN_COVERAGE = float(os.environ.get("LEXICAL_FAST_PATH_MIN_COVERAGE", 0.6))
+LEXICAL_FAST_PATH_MIN_RATIO = float(os.environ.get("LEXICAL_FAST_PATH_MIN_RATIO", 2.0))
+
+def documents_changed(user_id):
+    """
+    Invalidate everything derived from a user's documents after one is
+    processed or deleted: their exact-search and lexical indexes and, by
+    bumping their documents version, their cached retrieval results in
+    every process
+    
+    Args:
+        user_id (int): ID of the user
+    """
+    invalidate_user_index(user_id)
+    invalidate_lexical_index(user_id)
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(documents_version=func.coalesce(User.documents_version, 0) + 1)
+    )
+    db.session.commit()
+
+def delete_document_vectors(document_id):
+    """
+    Delete all chunks of a document from the vector store
+    
+    Args:
+        document_id (int): ID of the document
+    """
+    get_document_collection().delete(where={"document_id": document_id})
+
+def documents_version_of(user_id):
+    """The current documents version of a user, read from the database"""
+    return db.session.execute(
+        db.select(User.documents_version).where(User.id == user_id)
+    ).scalar() or 0
+
+@timed()
+def get_user_vector_index(user_id, documents_version=None):
+    """
+    Get the in-process exact-search index for a user's chunks, building it
+    from ChromaDB if needed
+    
+    Indexes are stamped with the documents version they were built from.
+    A worker may change the user's chunks while one is being built here;
+    it then bumps the version, so the index is rebuilt on next use instead
+    of serving the old chunks.
+    
+    Args:
+        user_id (int): ID of the user
+        documents_version (int): The user's documents version, read from
+            the database if not given; must be read before any chunks are
+        
+    Returns:
+        UserVectorIndex: The index, or None if the user has more chunks than
+        VECTOR_INDEX_MAX_CHUNKS and should be searched through ChromaDB
+    """
+    if VECTOR_INDEX_MAX_CHUNKS <= 0:
+        return None
+    
+    if documents_version is None:
+        documents_version = documents_version_of(user_id)
+    index = load_user_index(user_id, documents_version)
+    
+    if index is None:
+        # Count first so large users' embeddings are never pulled out of Chroma
+        chunk_ids = get_document_collection().get(where={"user_id": user_id}, include=[])['ids']
+        
+        if len(chunk_ids) > VECTOR_INDEX_MAX_CHUNKS:
+            index = mark_user_index_large(user_id, documents_version, len(chunk_ids))
+        elif chunk_ids:
+            chunks = get_document_collection().get(
+                ids=chunk_ids,
+                include=["embeddings", "documents", "metadatas"]
+            )
+            index = build_user_index(
+                user_id, documents_version, chunks['ids'], chunks['embeddings'],
+                chunks['documents'], chunks['metadatas']
+            )
+        else:
+            index = build_user_index(user_id, documents_version, [], [], [], [])
+    
+    return None if index.is_large else index
+
+@timed()
+def get_user_lexical_index(user_id, documents_version=None):
+    """
+    Get the BM25 index of a user's chunks, building it from ChromaDB if needed
+    
+    Like the exact-search index, it is stamped with the documents version
+    it was built from and rebuilt when that is no longer current.
+    
+    Args:
+        user_id (int): ID of the user
+        documents_version (int): The user's documents version, read from
+            the database if not given; must be read before any chunks are
+        
+    Returns:
+        LexicalIndex: The index
+    """
+    if documents_version is None:
+        documents_version = documents_version_of(user_id)
+    index = load_lexical_index(user_id, documents_version)
+    if index is None:
+        chunks = get_document_collection().get(where={"user_id": user_id}, include=["documents", "metadatas"])
+        index = build_lexical_index(user_id, documents_version, chunks['ids'],
+                                    chunks['documents'], chunks['metadatas'])
+    return index
+
+def is_lexical_decisive(lexical, top_k):
+    """
+    Whether lexical results are clear enough to skip the vector search
+    
+    A single rare query term found in a chunk is not enough: a semantic
+    question that happens to mention a word from some other chunk must
+    still reach the vector search.
+    """
+    if not lexical['query_terms'] or len(lexical['ids']) <= top_k:
+        return False
+    if lexical['known_terms'] / lexical['query_terms'] < LEXICAL_FAST_PATH_MIN_QUERY_COVERAGE:
+        return False
+    if (lexical['scores'][0] < LEXICAL_FAST_PATH_MIN_SCORE
+            or lexical['coverage'][0] < LEXICAL_FAST_PATH_MIN_COVERAGE):
+        return False
+    return lexical['scores'][0] >= LEXICAL_FAST_PATH_MIN_RATIO * lexical['scores'][top_k]
+
+def fuse_rankings(rankings, top_k):
+    """
+    Combine rankings by reciprocal rank fusion
+    
+    Args:
+        rankings (list): Result dicts with 'ids', 'documents' and 'metadatas', best first
+        top_k (int): Number of results to return
+        
+    Returns:
+        dict: 'ids', 'documents' and 'metadatas' of the best fused results, best first
+    """
+    scores = {}
+    chunks = {}
+    for ranking in rankings:
+        for rank, (chunk_id, document, metadata) in enumerate(
+                zip(ranking['ids'], ranking['documents'], ranking['metadatas'])):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+            chunks.setdefault(chunk_id, (document, metadata))
+    
+    ids = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return {
+        'ids': ids,
+        'documents': [chunks[chunk_id][0] for chunk_id in ids],
+        'metadatas': [chunks[chunk_id][1] for chunk_id in ids],
+    }
+
+def diversify(results):
+    """
+    Reorder vector search results by maximal marginal relevance, so
+    near-duplicates sink below other evidence
+    
+    Args:
+        results (dict): 'ids', 'documents', 'metadatas', 'distances' and
+            'embeddings' of the matches, best first
+        
+    Returns:
+        dict: The 'ids', 'documents' and 'metadatas' in the new order
+    """
+    relevance = 1.0 - np.asarray(results['distances'], dtype=np.float32)
+    order = mmr_select(relevance, results['embeddings'], len(relevance), RETRIEVAL_MMR_DIVERSITY)
+    return {key: [results[key][i] for i in order] for key in ('ids', 'documents', 'metadatas')}
+
+def _merge_consecutive(documents, metadatas):
+    """
+    Merge chunks that are consecutive in the same document into one span
+    without the text the chunker repeats between them, using their
+    offsets; chunks indexed without offsets are joined with blank lines
+    
+    Args:
+        documents (list): Chunk texts, best first
+        metadatas (list): Their metadata dicts
+        
+    Returns:
+        list: Context texts, ordered by their best-ranked chunk
+    """
+    def position_in_document(index):
+        metadata = metadatas[index] or {}
+        return str(metadata.get("document_id")), metadata.get("chunk_index", -1)
+    
+    runs = []
+    previous = None
+    for index in sorted(range(len(documents)), key=position_in_document):
+        document_id, chunk_index = position_in_document(index)
+        if (previous and chunk_index >= 0 and previous[0] == document_id
+                and previous[1] == chunk_index - 1):
+            runs[-1].append(index)
+        else:
+            runs.append([index])
+        previous = (document_id, chunk_index)
+    
+    def merge(run):
+        spans = [((metadatas[index] or {}).get("start"), (metadatas[index] or {}).get("end"), documents[index])
+                 for index in run]
+        if any(start is None or end is None for start, end, _ in spans):
+            return "\n\n".join(text for _, _, text in spans)
+        return merge_chunk_spans(spans)
+    
+    runs.sort(key=min)
+    return [merge(run) for run in runs]
+
+def _stored_embeddings(ids):
+    """
+    Full-precision embeddings of chunks from ChromaDB, for re-ranking the
+    matches of a quantized index
+    
+    Returns:
+        array: One row per ID, or None if any chunk is missing
+    """
+    with span("chroma.get_embeddings"):
+        chunks = get_document_collection().get(ids=ids, include=["embeddings"])
+    stored = dict(zip(chunks['ids'], chunks['embeddings']))
+    if any(chunk_id not in stored for chunk_id in ids):
+        return None
+    return np.array([stored[chunk_id] for chunk_id in ids], dtype=np.float32)
+
+def _vector_candidates(query_embedding, user_id, documents_version, count):
+    """
+    Search a user's chunks by embedding, exactly with their in-process
+    index or through ChromaDB for large users
+    
+    Returns:
+        dict: 'ids', 'documents', 'metadatas', 'distances' and
+        'embeddings' of the best matches, best first
+    """
+    index = get_user_vector_index(user_id, documents_version)
+    if index is not None:
+        with span("vector_index.search"):
+            return index.search(query_embedding, count, include_embeddings=True,
+                                full_precision=_stored_embeddings)
+    
+    with span("chroma.query"):
+        results = get_document_collection().query(
+            query_embeddings=[query_embedding],
+            n_results=count,
+            where={"user_id": user_id},
+            include=["documents", "metadatas", "distances", "embeddings"]
+        )
+    
+    keys = ('ids', 'documents', 'metadatas', 'distances', 'embeddings')
+    if not results or not results['ids']:
+        return {key: [] for key in keys}
+    return {key: results[key][0] for key in keys}
+
 def query_knowledge_base(query, user_id, top_k=5):
     """
     Query the knowledge base using RAG to retrieve relevant context
     
+    The user's chunks are ranked by BM25 over their lexical index and by
+    embedding similarity, with a wider set of vector matches reordered by
+    maximal marginal relevance so near-duplicates don't crowd out other
+    evidence. The two rankings are fused by reciprocal rank. When the
+    lexical ranking alone is decisive, e.g. for a question about a
+    medication named in one chunk and phrased in the words of the
+    documents, the embedding call is skipped, and if the query can't be
+    embedded the lexical ranking is used alone. Selected chunks that are
+    consecutive in a document are merged into one span.
+    
     Args:
         query (str): User query
         user_id (int): ID of the current user
-        top_k (int): Number of top results to return
+        top_k (int): Number of chunks to select
         
     Returns:
-        list: Retrieved relevant document chunks
+        list: Retrieved relevant document text, at most top_k chunks
+        merged into spans where they are consecutive
     """
     try:
+        # Repeated questions reuse earlier results until the user's documents change
+        documents_version = documents_version_of(user_id)
+        cache_key = (user_id, documents_version, normalize_text(query), top_k)
+        cached = retrieval_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        candidate_count = top_k * RETRIEVAL_CANDIDATE_FACTOR
+        with span("lexical_index.search"):
+            lexical = get_user_lexical_index(user_id, documents_version).search(query, candidate_count)
+        
+        if is_lexical_decisive(lexical, top_k):
+            context = _merge_consecutive(lexical['documents'][:top_k], lexical['metadatas'][:top_k])
+            retrieval_cache.set(cache_key, context)
+            return context
+        
         # Generate embedding for query
-        query_embedding = generate_embedding(query)
+        query_embedding = query_embedding_cache.get(cache_key[2])
+        if query_embedding is None:
+            query_embedding = generate_embedding(query)
+            if query_embedding:
+                query_embedding_cache.set(cache_key[2], query_embedding)
         
         if not query_embedding:
-            logger.warning("Could not generate embedding for query")
-            return []
-        
-        # Query ChromaDB for similar documents from this user
-        results = document_collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k,
-            where={"user_id": user_id}
-        )
+            # Fall back to the lexical ranking alone, without caching it so
+            # the next try searches the vectors again
+            logger.warning("Could not generate embedding for query; using lexical results only")
+            return _merge_consecutive(lexical['documents'][:top_k], lexical['metadatas'][:top_k])
         
-        if not results or not results['documents']:
+        vector = _vector_candidates(query_embedding, user_id, documents_version, candidate_count)
+        if not vector['ids'] and not lexical['ids']:
             logger.info("No relevant documents found in knowledge base")
             return []
         
-        # Return retrieved documents
-        return results['documents'][0]
+        with span("rag.select_context"):
+            selected = fuse_rankings([diversify(vector), lexical], top_k)
+            context = _merge_consecutive(selected['documents'], selected['metadatas'])
+        
+        retrieval_cache.set(cache_key, context)
+        return context
         
     except Exception as e:
         logger.error(f"Error querying knowledge base: {str(e)}")
         return []
 
-def get_ai_response(user_message, context, chat_id):
+AI_ERROR_MESSAGE = "I apologize, but I encountered an error while processing your request. Please try again later."
+
+CHAT_SYSTEM_PROMPT = (
+    "You are an AI assistant helping to create Emotional Support Animal (ESA) reports. "
+    "Your goal is to gather information about the user's mental health condition, "
+    "how an emotional support animal helps them, and relevant medical history. "
+    "Be empathetic, professional, and thorough in your responses."
+)
+
+# Most recent messages loaded for a chat turn. Older turns are normally
+# already folded into the chat's summary, so this only bounds the query;
+# a full window queues a summary update so none stay out of both.
+CHAT_HISTORY_MAX_MESSAGES = int(os.environ.get("CHAT_HISTORY_MAX_MESSAGES", 100))
+
+# Threads running the retrieval stage of chat turns alongside the request
+CHAT_PIPELINE_WORKERS = int(os.environ.get("CHAT_PIPELINE_WORKERS", 8))
+chat_pipeline_executor = ThreadPoolExecutor(max_workers=CHAT_PIPELINE_WORKERS,
+                                            thread_name_prefix="chat-pipeline")
+
+@timed()
+def load_chat_history(chat_id, user_message):
+    """
+    Load the recent messages of a chat not yet covered by its rolling summary
+    
+    If more than CHAT_HISTORY_MAX_MESSAGES are uncovered, the older ones are
+    left out and a background summary update is queued, which folds them
+    in from the summary cursor forward.
+    
+    Args:
+        chat_id (int): ID of the chat
+        user_message (str): The current user message, left out if it has
+            already been saved
+        
+    Returns:
+        list: ChatMessage objects, oldest first
+    """
+    chat = db.session.get(Chat, chat_id)
+    chat_messages = ChatMessage.latest(chat_id, CHAT_HISTORY_MAX_MESSAGES,
+                                       after_id=chat.summary_message_id)
+    if len(chat_messages) == CHAT_HISTORY_MAX_MESSAGES:
+        request_chat_summary(chat)
+    
+    # The current message is added to the prompt separately
+    if chat_messages and chat_messages[-1].role == 'user' and chat_messages[-1].content == user_message:
+        chat_messages = chat_messages[:-1]
+    
+    return chat_messages
+
+def _timed_retrieval(query, user_id):
+    """Run query_knowledge_base in its own app context, returning (results, seconds)"""
+    started = time.perf_counter()
+    with app.app_context():
+        context = query_knowledge_base(query, user_id)
+    return context, time.perf_counter() - started
+
+@timed()
+def prepare_chat_turn(chat_id, user_id, user_message):
+    """
+    Save the user's message and gather everything the reply needs
+    
+    Retrieval (query embedding and vector search) runs on the chat
+    pipeline executor while this thread saves the message and loads the
+    chat history, so the turn waits for the slower of the two rather than
+    their sum.
+    
+    Args:
+        chat_id (int): ID of the current chat
+        user_id (int): ID of the user
+        user_message (str): User's message
+        
+    Returns:
+        tuple: (list of relevant document chunks, list of history
+        ChatMessage objects, dict of stage durations in seconds)
+    """
+    timings = {}
+    # Run in a copy of this context so its spans join the request's trace
+    retrieval = chat_pipeline_executor.submit(contextvars.copy_context().run,
+                                              _timed_retrieval, user_message, user_id)
+    
+    started = time.perf_counter()
+    db.session.add(ChatMessage(chat_id=chat_id, role='user', content=user_message))
+    db.session.commit()
+    timings["save_message"] = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    chat_messages = load_chat_history(chat_id, user_message)
+    timings["history"] = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    context, timings["retrieval"] = retrieval.result()
+    timings["retrieval_wait"] = time.perf_counter() - started
+    
+    return context, chat_messages, timings
+
+def format_timings(timings):
+    """Format stage durations for logging"""
+    return ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in timings.items())
+
+@timed()
+def build_chat_messages(user_message, context, chat_id, chat_messages=None):
+    """
+    Assemble the OpenAI chat messages for a turn: system prompt, rolling
+    summary, recent chat history, RAG context and the current user
+    message, fitted into the chat prompt token budget
+    
+    Args:
+        user_message (str): User's message
+        context (list): List of relevant document chunks from RAG
+        chat_id (int): ID of the current chat
+        chat_messages (list): Chat history from load_chat_history, loaded
+            here if not given
+        
+    Returns:
+        list: Messages for the chat completions API
+    """
+    if chat_messages is None:
+        chat_messages = load_chat_history(chat_id, user_message)
+    
+    chat = db.session.get(Chat, chat_id)
+    messages, _ = build_chat_prompt(chat, CHAT_SYSTEM_PROMPT, chat_messages, context, user_message)
+    return messages
+
+@timed()
+def get_ai_response(user_message, context, chat_id, chat_messages=None, timings=None):
     """
     Generate AI response using OpenAI with RAG context
     
@@ -189,46 +863,68 @@ def get_ai_response(user_message, context, chat_id):
         user_message (str): User's message
         context (list): List of relevant document chunks from RAG
         chat_id (int): ID of the current chat
+        chat_messages (list): Optional preloaded chat history
+        timings (dict): Optional, receives the durations of the 'prompt'
+            and 'completion' stages in seconds
         
     Returns:
         str: AI response
     """
+    timings = {} if timings is None else timings
     try:
-        # Get chat history
-        chat_messages = ChatMessage.query.filter_by(chat_id=chat_id).order_by(ChatMessage.timestamp).all()
-        
-        # Format chat history for OpenAI API
-        messages = [{"role": "system", "content": (
-            "You are an AI assistant helping to create Emotional Support Animal (ESA) reports. "
-            "Your goal is to gather information about the user's mental health condition, "
-            "how an emotional support animal helps them, and relevant medical history. "
-            "Be empathetic, professional, and thorough in your responses."
-        )}]
-        
-        # Add chat history (max 10 messages to stay within context limits)
-        for msg in chat_messages[-10:]:
-            messages.append({"role": msg.role, "content": msg.content})
-        
-        # Add RAG context if available
-        if context:
-            context_message = (
-                "I've found some relevant information from your documents that might help: \n\n" +
-                "\n\n---\n\n".join(context) +
-                "\n\nLet me use this information to help you better."
-            )
-            messages.append({"role": "assistant", "content": context_message})
-        
-        # Add the current user message
-        messages.append({"role": "user", "content": user_message})
+        started = time.perf_counter()
+        messages = build_chat_messages(user_message, context, chat_id, chat_messages)
+        timings["prompt"] = time.perf_counter() - started
         
         # Generate response
-        response = openai.chat.completions.create(
+        started = time.perf_counter()
+        response = create_chat_completion(
             model="gpt-4o",
             messages=messages
         )
+        timings["completion"] = time.perf_counter() - started
         
         return response.choices[0].message.content
         
     except Exception as e:
         logger.error(f"Error generating AI response: {str(e)}")
-        return "I apologize, but I encountered an error while processing your request. Please try again later."
+        return AI_ERROR_MESSAGE
+
+def stream_ai_response(user_message, context, chat_id, chat_messages=None):
+    """
+    Generate AI response using OpenAI with RAG context, yielding the text
+    as it is produced
+    
+    Args:
+        user_message (str): User's message
+        context (list): List of relevant document chunks from RAG
+        chat_id (int): ID of the current chat
+        chat_messages (list): Optional preloaded chat history
+        
+    Yields:
+        str: Pieces of the AI response
+    """
+    started = False
+    stream = None
+    try:
+        messages = build_chat_messages(user_message, context, chat_id, chat_messages)
+        
+        stream = create_chat_completion(
+            model="gpt-4o",
+            messages=messages,
+            stream=True
+        )
+        
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                started = True
+                yield chunk.choices[0].delta.content
+        
+    except Exception as e:
+        logger.error(f"Error streaming AI response: {str(e)}")
+        if not started:
+            yield AI_ERROR_MESSAGE
+    finally:
+        # Stop reading from OpenAI if the consumer went away early
+        if stream is not None:
+            stream.close()
@@ -1,37 +1,57 @@
 import logging
-import os
-from openai import OpenAI
+import hashlib
 import json
 from datetime import datetime
 
+from app import db
+from models import Chat, ChatMessage, Document, Report, ReportJob
+from prompt_builder import build_report_transcript
+from llm_client import create_chat_completion
+from metrics import timed
+
 # Configure logger
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-# the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
-# do not change this unless explicitly requested by the user
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-openai = OpenAI(api_key=OPENAI_API_KEY)
+def report_source_hash(chat_messages, documents):
+    """
+    Hash the inputs of a report: the chat transcript and the document set
+    
+    Reports generated from the same inputs can be reused instead of calling
+    the model again.
+    
+    Args:
+        chat_messages (list): List of ChatMessage objects
+        documents (list): List of Document objects
+        
+    Returns:
+        str: Hex SHA-256 digest
+    """
+    source = {
+        "messages": [[msg.role, msg.content] for msg in chat_messages],
+        "documents": sorted([doc.id, doc.filename] for doc in documents),
+    }
+    return hashlib.sha256(json.dumps(source, sort_keys=True).encode("utf-8")).hexdigest()
 
-def generate_esa_report(chat_messages, documents):
+@timed()
+def generate_esa_report(chat_messages, documents, raise_errors=False):
     """
     Generate a comprehensive ESA report based on chat history and uploaded documents
     
     Args:
         chat_messages (list): List of ChatMessage objects containing conversation history
         documents (list): List of Document objects that have been processed
+        raise_errors (bool): Raise on failure instead of returning an error message
         
     Returns:
         str: Generated ESA report content
     """
     try:
-        # Format chat history for context
-        conversation = []
-        for msg in chat_messages:
-            conversation.append({
-                "role": msg.role,
-                "content": msg.content
-            })
+        # Format chat history for context, summarizing older turns if the
+        # conversation doesn't fit the report prompt budget
+        conversation = ""
+        if chat_messages:
+            chat = db.session.get(Chat, chat_messages[0].chat_id)
+            conversation, _ = build_report_transcript(chat, chat_messages)
         
         # Create a prompt for the OpenAI API
         system_prompt = """
@@ -62,11 +82,11 @@ def generate_esa_report(chat_messages, documents):
         # Prepare messages for OpenAI API
         messages = [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Here is the conversation history between the patient and the AI assistant:\n\n{json.dumps(conversation, indent=2)}\n\n{document_context}\n\nPlease generate a comprehensive ESA report based on this information."}
+            {"role": "user", "content": f"Here is the conversation history between the patient and the AI assistant:\n\n{conversation}\n\n{document_context}\n\nPlease generate a comprehensive ESA report based on this information."}
         ]
         
         # Generate report
-        response = openai.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-4o",
             messages=messages
         )
@@ -97,4 +117,87 @@ def generate_esa_report(chat_messages, documents):
         
     except Exception as e:
         logger.error(f"Error generating ESA report: {str(e)}")
+        if raise_errors:
+            raise
         return "Error generating report. Please try again later."
+
+def _update_job_status(job, status, progress=None, message=None):
+    """Record the state of a report job so the UI can poll it"""
+    job.status = status
+    if progress is not None:
+        job.progress = progress
+    job.status_message = message
+    job.status_updated = datetime.utcnow()
+    db.session.commit()
+
+def _cancel_requested(job):
+    """Check, with a fresh read, whether the user cancelled the job"""
+    db.session.refresh(job, attribute_names=['cancel_requested'])
+    return bool(job.cancel_requested)
+
+@timed()
+def process_report_job(job_id):
+    """
+    Generate the report for a queued report job and store it
+    
+    If a report was already generated from the same transcript and
+    documents, it is reused instead of calling the model again.
+    
+    Args:
+        job_id (int): ID of the ReportJob to run
+        
+    Returns:
+        bool: Success status
+    """
+    job = db.session.get(ReportJob, job_id)
+    
+    if not job:
+        logger.error(f"Report job with ID {job_id} not found")
+        return False
+    
+    try:
+        if _cancel_requested(job):
+            _update_job_status(job, 'cancelled')
+            return False
+        
+        chat_messages = ChatMessage.query.filter_by(chat_id=job.chat_id).order_by(ChatMessage.timestamp).all()
+        documents = Document.query.filter_by(user_id=job.user_id, is_processed=True).all()
+        
+        # The chat may have moved on since the job was queued
+        job.source_hash = report_source_hash(chat_messages, documents)
+        existing = Report.query.filter_by(user_id=job.user_id, source_hash=job.source_hash).first()
+        
+        if existing:
+            job.report_id = existing.id
+            _update_job_status(job, 'done', progress=100)
+            return True
+        
+        _update_job_status(job, 'running', progress=10)
+        report_content = generate_esa_report(chat_messages, documents, raise_errors=True)
+        
+        # The model call can't be interrupted; drop the result if cancelled meanwhile
+        if _cancel_requested(job):
+            _update_job_status(job, 'cancelled')
+            return False
+        
+        report = Report(
+            title=f"ESA Report - {datetime.now().strftime('%Y-%m-%d')}",
+            content=report_content,
+            user_id=job.user_id,
+            chat_id=job.chat_id,
+            source_hash=job.source_hash
+        )
+        db.session.add(report)
+        db.session.flush()
+        
+        job.report_id = report.id
+        _update_job_status(job, 'done', progress=100)
+        
+        logger.info(f"Generated report {report.id} for report job {job_id}")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error running report job {job_id}: {str(e)}")
+        db.session.rollback()
+        _update_job_status(job, 'failed', message="Report generation failed")
+        return False
@@ -1,23 +1,38 @@
 import os
 import json
+import time
 from datetime import datetime
-from flask import render_template, request, jsonify, redirect, url_for, send_file, session, flash
+from flask import render_template, request, jsonify, redirect, url_for, send_file, session, flash, Response, stream_with_context, g, abort
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from sqlalchemy import func, update
+from sqlalchemy.orm import defer, with_expression
 import io
 
 from app import app, db
-from models import User, Document, Chat, ChatMessage, Report
-from utils import allowed_file, extract_text_from_file
-from rag import process_document, query_knowledge_base
-from report_generator import generate_esa_report
+from models import User, Document, Chat, ChatMessage, Report, ReportJob
+from utils import allowed_file, extract_text_from_file, file_extension, save_upload
+from rag import prepare_chat_turn, format_timings, documents_changed, delete_document_vectors
+from report_generator import report_source_hash
+from artifacts import artifact_key, delete_artifacts
+from metrics import start_trace, finish_trace, request_duration, render_metrics
 
 # Initialize login manager
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Chat messages per page of history
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+# Characters of each report shown in the reports list
+REPORT_PREVIEW_LENGTH = 150
+
+# Bearer token required to read /metrics, if set
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
@@ -27,6 +42,38 @@ def load_user(user_id):
 def inject_now():
     return {'now': datetime.now()}
 
+# Trace every request; spans opened while handling it form its span tree
+@app.before_request
+def begin_request_trace():
+    g.trace = start_trace(f"{request.method} {request.endpoint or 'unknown'}")
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def end_request_trace(exc):
+    # Views streaming with stream_with_context set trace_streaming: their
+    # request is torn down again once the stream has finished, and the
+    # trace is ended then
+    if g.pop('trace_streaming', False):
+        return
+    
+    trace = g.pop('trace', None)
+    if trace is None:
+        return
+    
+    duration = finish_trace(*trace)
+    status = g.get('response_status', 500)
+    request_duration.observe(duration, request.endpoint or 'unknown', request.method, str(status))
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 # Main routes
 @app.route('/')
 def index():
@@ -105,8 +152,9 @@ def chat():
         db.session.commit()
         session['active_chat_id'] = active_chat.id
     
-    # Get chat history
-    chat_history = ChatMessage.query.filter_by(chat_id=active_chat.id).order_by(ChatMessage.timestamp).all()
+    # Get the latest page of chat history; older messages are loaded as
+    # the user scrolls up
+    chat_history, has_more_history = ChatMessage.page(active_chat.id, CHAT_HISTORY_PAGE_SIZE)
     
     # Get user's documents
     documents = Document.query.filter_by(user_id=current_user.id).all()
@@ -114,6 +162,7 @@ def chat():
     return render_template('chat.html', 
                            chat=active_chat, 
                            chat_history=chat_history,
+                           has_more_history=has_more_history,
                            documents=documents)
 
 @app.route('/api/chat/new', methods=['POST'])
@@ -141,23 +190,18 @@ def send_message():
     if not chat_id:
         return jsonify({'error': 'No active chat'}), 400
     
-    # Save user message
-    user_message = ChatMessage(
-        chat_id=chat_id,
-        role='user',
-        content=data.get('message')
-    )
-    db.session.add(user_message)
-    db.session.commit()
+    message = data.get('message')
     
-    # Get relevant context from the user's documents using RAG
-    context = query_knowledge_base(data.get('message'), current_user.id)
+    # Save the user message and load the chat history while the relevant
+    # context is retrieved from the user's documents
+    context, history, timings = prepare_chat_turn(chat_id, current_user.id, message)
     
     # Generate AI response with RAG context
     from rag import get_ai_response
-    ai_response_text = get_ai_response(data.get('message'), context, chat_id)
+    ai_response_text = get_ai_response(message, context, chat_id, history, timings)
     
     # Save AI response
+    started = time.perf_counter()
     ai_message = ChatMessage(
         chat_id=chat_id,
         role='assistant',
@@ -165,12 +209,64 @@ def send_message():
     )
     db.session.add(ai_message)
     db.session.commit()
+    timings['save_reply'] = time.perf_counter() - started
+    
+    app.logger.info(f"Chat {chat_id} turn timings: {format_timings(timings)}")
     
     return jsonify({
         'success': True,
         'message': ai_response_text
     })
 
+@app.route('/api/chat/message/stream', methods=['POST'])
+@login_required
+def stream_message():
+    data = request.json
+    chat_id = session.get('active_chat_id')
+    
+    if not chat_id:
+        return jsonify({'error': 'No active chat'}), 400
+    
+    message = data.get('message')
+    
+    # Save the user message and load the chat history while the relevant
+    # context is retrieved from the user's documents
+    context, history, timings = prepare_chat_turn(chat_id, current_user.id, message)
+    
+    from rag import stream_ai_response
+    
+    # Keep tracing the request until the stream has finished
+    g.trace_streaming = True
+    
+    def generate():
+        started = time.monotonic()
+        tokens = []
+        try:
+            for token in stream_ai_response(message, context, chat_id, history):
+                if not tokens:
+                    timings['first_token'] = time.monotonic() - started
+                    app.logger.info(f"Chat {chat_id} turn timings: {format_timings(timings)}")
+                tokens.append(token)
+                yield f"data: {json.dumps({'token': token})}\n\n"
+            yield f"data: {json.dumps({'done': True})}\n\n"
+        finally:
+            # Save the AI response once the stream has completed or the
+            # client has disconnected, keeping whatever was generated
+            if tokens:
+                ai_message = ChatMessage(
+                    chat_id=chat_id,
+                    role='assistant',
+                    content=''.join(tokens)
+                )
+                db.session.add(ai_message)
+                db.session.commit()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/chat/history', methods=['GET'])
 @login_required
 def get_chat_history():
@@ -179,7 +275,25 @@ def get_chat_history():
     if not chat_id:
         return jsonify({'error': 'No active chat'}), 400
     
-    chat_messages = ChatMessage.query.filter_by(chat_id=chat_id).order_by(ChatMessage.timestamp).all()
+    limit = min(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), CHAT_HISTORY_MAX_PAGE_SIZE)
+    if limit < 1:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    # Cursors are message IDs from a previous page of the same chat
+    cursors = {}
+    for name in ('before', 'after'):
+        cursor_id = request.args.get(name, type=int)
+        if cursor_id is None:
+            continue
+        cursor = ChatMessage.query.filter_by(id=cursor_id, chat_id=chat_id).first()
+        if not cursor:
+            return jsonify({'error': f'Invalid {name} cursor'}), 400
+        cursors[name] = cursor
+    
+    if len(cursors) > 1:
+        return jsonify({'error': 'Use either a before or an after cursor'}), 400
+    
+    chat_messages, has_more = ChatMessage.page(chat_id, limit, **cursors)
     
     messages = []
     for msg in chat_messages:
@@ -193,7 +307,8 @@ def get_chat_history():
     return jsonify({
         'success': True,
         'chat_id': chat_id,
-        'messages': messages
+        'messages': messages,
+        'has_more': has_more
     })
 
 @app.route('/upload', methods=['GET', 'POST'])
@@ -215,63 +330,125 @@ def upload():
         
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
+            # Stored under its content hash, so files with the same name
+            # don't overwrite each other and identical files are kept once
+            content_hash, file_path = save_upload(
+                file.stream, app.config['UPLOAD_FOLDER'], file_extension(file.filename)
+            )
             
-            # Create document record
+            existing = Document.query.filter_by(
+                user_id=current_user.id, content_hash=content_hash, file_path=file_path
+            ).first()
+            if existing:
+                if existing.status == 'failed':
+                    existing.status = 'queued'
+                    existing.progress = 0
+                    existing.attempts = 0
+                    existing.status_message = None
+                    db.session.commit()
+                    flash(f'This file was already uploaded as {existing.filename} and has been queued for processing again.', 'success')
+                else:
+                    flash(f'This file was already uploaded as {existing.filename}.', 'info')
+                return redirect(url_for('upload'))
+            
+            # Create document record; it is picked up from the queue by
+            # the background ingestion worker (worker.py), which reuses
+            # the chunks of an identical processed file if there is one
             doc = Document(
-                filename=filename,
+                filename=filename or file.filename,
                 file_path=file_path,
                 file_type=file.content_type,
-                user_id=current_user.id
+                content_hash=content_hash,
+                user_id=current_user.id,
+                status='queued'
             )
             db.session.add(doc)
             db.session.commit()
             
-            # Process the document asynchronously (in a real app)
-            # Here we do it synchronously for simplicity
-            try:
-                process_document(doc.id)
-                flash('Document uploaded and processed successfully!', 'success')
-            except Exception as e:
-                app.logger.error(f"Error processing document: {str(e)}")
-                flash(f'Document uploaded but could not be processed: {str(e)}', 'warning')
-            
+            flash('Document uploaded and queued for processing.', 'success')
             return redirect(url_for('upload'))
     
     # List user's documents
     documents = Document.query.filter_by(user_id=current_user.id).all()
     return render_template('upload.html', documents=documents)
 
+@app.route('/api/documents/status', methods=['GET'])
+@login_required
+def document_status():
+    # Only load the status columns; this endpoint is polled by the upload page
+    query = db.session.query(
+        Document.id, Document.status, Document.progress, Document.status_message
+    ).filter(Document.user_id == current_user.id)
+    
+    ids = [int(doc_id) for doc_id in request.args.get('ids', '').split(',') if doc_id.isdigit()]
+    if ids:
+        query = query.filter(Document.id.in_(ids))
+    
+    return jsonify({
+        'success': True,
+        'documents': [{
+            'id': doc_id,
+            'status': status,
+            'progress': progress or 0,
+            'message': message
+        } for doc_id, status, progress, message in query]
+    })
+
 @app.route('/documents/<int:doc_id>/delete', methods=['POST'])
 @login_required
 def delete_document(doc_id):
     doc = Document.query.filter_by(id=doc_id, user_id=current_user.id).first_or_404()
     
-    # Delete the file
+    # Delete the file and its stored text and chunks, unless another
+    # document has the same stored file
+    others = Document.query.filter(Document.id != doc.id, Document.file_path == doc.file_path)
+    if doc.content_hash:
+        others = others.filter(Document.content_hash == doc.content_hash)
     try:
-        if os.path.exists(doc.file_path):
-            os.remove(doc.file_path)
+        if others.first() is None:
+            # The stored text and chunks go even if the file is already gone
+            key = artifact_key(doc.content_hash, doc.file_path)
+            if key:
+                delete_artifacts(key)
+            if os.path.exists(doc.file_path):
+                os.remove(doc.file_path)
     except Exception as e:
         app.logger.error(f"Error deleting file: {str(e)}")
     
+    # Delete the document's chunks from the vector store
+    try:
+        delete_document_vectors(doc.id)
+    except Exception as e:
+        app.logger.error(f"Error deleting document vectors: {str(e)}")
+    
     # Delete from database
     db.session.delete(doc)
     db.session.commit()
     
+    # Drop cached retrieval results that may include this document
+    documents_changed(current_user.id)
+    
     flash('Document deleted successfully', 'success')
     return redirect(url_for('upload'))
 
 @app.route('/reports')
 @login_required
 def reports():
-    user_reports = Report.query.filter_by(user_id=current_user.id).order_by(Report.creation_date.desc()).all()
-    return render_template('reports.html', reports=user_reports)
+    # Only the start of each report is shown, so don't load the full content
+    user_reports = Report.query.filter_by(user_id=current_user.id).options(
+        defer(Report.content),
+        with_expression(Report.preview, func.substr(Report.content, 1, REPORT_PREVIEW_LENGTH + 1))
+    ).order_by(Report.creation_date.desc()).all()
+    report_jobs = ReportJob.query.filter(
+        ReportJob.user_id == current_user.id,
+        ReportJob.status.in_(('queued', 'running'))
+    ).order_by(ReportJob.created_at).all()
+    return render_template('reports.html', reports=user_reports, report_jobs=report_jobs)
 
 @app.route('/api/generate-report', methods=['POST'])
 @login_required
 def create_report():
-    data = request.json
+    data = request.get_json(silent=True) or {}
     chat_id = data.get('chat_id') or session.get('active_chat_id')
     
     if not chat_id:
@@ -284,24 +461,81 @@ def create_report():
     # Get user's processed documents
     documents = Document.query.filter_by(user_id=current_user.id, is_processed=True).all()
     
-    # Generate report
-    report_title = f"ESA Report - {datetime.now().strftime('%Y-%m-%d')}"
-    report_content = generate_esa_report(chat_messages, documents)
+    # Reuse a report generated from the same conversation and documents
+    source_hash = report_source_hash(chat_messages, documents)
+    existing_report = Report.query.filter_by(user_id=current_user.id, source_hash=source_hash).first()
+    if existing_report:
+        return jsonify({
+            'success': True,
+            'status': 'done',
+            'report_id': existing_report.id,
+            'title': existing_report.title
+        })
     
-    # Save report to database
-    new_report = Report(
-        title=report_title,
-        content=report_content,
-        user_id=current_user.id,
-        chat_id=chat.id
-    )
-    db.session.add(new_report)
+    # Join a job already running for the same inputs rather than starting another
+    job = ReportJob.query.filter(
+        ReportJob.user_id == current_user.id,
+        ReportJob.source_hash == source_hash,
+        ReportJob.status.in_(('queued', 'running'))
+    ).first()
+    
+    if not job:
+        # Queue report generation for the background worker (worker.py)
+        job = ReportJob(
+            user_id=current_user.id,
+            chat_id=chat.id,
+            source_hash=source_hash,
+            status='queued'
+        )
+        db.session.add(job)
+        db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'status': job.status,
+        'job_id': job.id
+    }), 202
+
+@app.route('/api/report-jobs/<int:job_id>', methods=['GET'])
+@login_required
+def report_job_status(job_id):
+    job = ReportJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'progress': job.progress or 0,
+        'message': job.status_message,
+        'report_id': job.report_id
+    })
+
+@app.route('/api/report-jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_report_job(job_id):
+    job = ReportJob.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    
+    # Conditional updates, so a worker claiming the job at the same moment
+    # either finds it cancelled or has it flagged
+    cancelled = db.session.execute(
+        update(ReportJob)
+        .where(ReportJob.id == job.id, ReportJob.status == 'queued')
+        .values(status='cancelled', status_updated=datetime.utcnow())
+    ).rowcount
+    if not cancelled:
+        # The worker checks this flag and discards the result
+        db.session.execute(
+            update(ReportJob)
+            .where(ReportJob.id == job.id, ReportJob.status == 'running')
+            .values(cancel_requested=True)
+        )
     db.session.commit()
+    db.session.refresh(job)
     
     return jsonify({
         'success': True,
-        'report_id': new_report.id,
-        'title': new_report.title
+        'job_id': job.id,
+        'status': job.status
     })
 
 @app.route('/reports/<int:report_id>')
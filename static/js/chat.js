@@ -5,6 +5,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const chatContainer = document.getElementById('chatContainer');
     const newChatBtn = document.getElementById('newChatBtn');
     const generateReportBtn = document.getElementById('generateReportBtn');
+    
+    // Controller for the response currently being streamed, if any
+    let activeStream = null;
 
     // Function to add a message to the chat
     function addMessage(content, isUser = false) {
@@ -15,7 +18,50 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Scroll to bottom
         chatContainer.scrollTop = chatContainer.scrollHeight;
+        
+        return messageDiv;
+    }
+
+    // Older messages are loaded a page at a time as the user scrolls up
+    let hasMoreHistory = chatMessages.dataset.hasMore === 'true';
+    let loadingHistory = false;
+    
+    function loadOlderMessages() {
+        const oldest = chatMessages.querySelector('[data-message-id]');
+        if (!hasMoreHistory || loadingHistory || !oldest) return;
+        
+        loadingHistory = true;
+        fetch(`/api/chat/history?before=${oldest.dataset.messageId}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) return;
+            
+            // Keep the visible messages in place while prepending
+            const previousHeight = chatContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(msg => {
+                const messageDiv = document.createElement('div');
+                messageDiv.className = `chat-message ${msg.role === 'user' ? 'user-message' : 'assistant-message'}`;
+                messageDiv.dataset.messageId = msg.id;
+                messageDiv.textContent = msg.content;
+                fragment.appendChild(messageDiv);
+            });
+            chatMessages.insertBefore(fragment, chatMessages.firstChild);
+            chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+            
+            hasMoreHistory = data.has_more;
+        })
+        .catch(error => console.error('Error:', error))
+        .finally(() => {
+            loadingHistory = false;
+        });
     }
+    
+    chatContainer.addEventListener('scroll', function() {
+        if (chatContainer.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
 
     // Function to add typing indicator
     function addTypingIndicator() {
@@ -51,25 +97,66 @@ document.addEventListener('DOMContentLoaded', function() {
         // Show typing indicator
         addTypingIndicator();
         
-        // Send message to server
-        fetch('/api/chat/message', {
+        // Stream the response from the server as Server-Sent Events
+        activeStream = new AbortController();
+        let messageDiv = null;
+        let responseText = '';
+        
+        function handleEvent(event) {
+            const dataLine = event.split('\n').find(line => line.startsWith('data: '));
+            if (!dataLine) return;
+            
+            const data = JSON.parse(dataLine.slice(6));
+            if (data.token) {
+                if (!messageDiv) {
+                    // First token: replace the typing indicator with the message
+                    removeTypingIndicator();
+                    messageDiv = addMessage('');
+                }
+                responseText += data.token;
+                messageDiv.textContent = responseText;
+                chatContainer.scrollTop = chatContainer.scrollHeight;
+            }
+        }
+        
+        fetch('/api/chat/message/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
                 message: message
-            })
+            }),
+            signal: activeStream.signal
         })
-        .then(response => response.json())
-        .then(data => {
-            // Remove typing indicator
+        .then(response => {
+            if (!response.ok || !response.body) {
+                throw new Error(`Server error: ${response.status}`);
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            
+            function read() {
+                return reader.read().then(({ done, value }) => {
+                    if (done) return;
+                    
+                    buffer += decoder.decode(value, { stream: true });
+                    const events = buffer.split('\n\n');
+                    buffer = events.pop();
+                    events.forEach(handleEvent);
+                    
+                    return read();
+                });
+            }
+            
+            return read();
+        })
+        .then(() => {
             removeTypingIndicator();
             
-            if (data.success) {
-                // Add AI response to chat
-                addMessage(data.message);
-            } else {
+            if (!messageDiv) {
                 // Show error
                 addMessage('Sorry, I encountered an error. Please try again.');
             }
@@ -78,15 +165,25 @@ document.addEventListener('DOMContentLoaded', function() {
             // Remove typing indicator
             removeTypingIndicator();
             
+            if (error.name === 'AbortError') return;
+            
             // Show error
             addMessage('Sorry, there was a network error. Please try again.');
             console.error('Error:', error);
+        })
+        .finally(() => {
+            activeStream = null;
         });
     });
 
     // Handle new chat button
     newChatBtn.addEventListener('click', function() {
         if (confirm('Start a new chat? This will clear the current conversation.')) {
+            // Stop any response still streaming into the old chat
+            if (activeStream) {
+                activeStream.abort();
+            }
+            
             fetch('/api/chat/new', {
                 method: 'POST',
                 headers: {
@@ -98,6 +195,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (data.success) {
                     // Clear chat messages
                     chatMessages.innerHTML = '';
+                    hasMoreHistory = false;
                     
                     // Add welcome message
                     addMessage("Hello! I'm your AI assistant for generating ESA reports. I can help gather information about your mental health condition and how an emotional support animal helps you. What would you like to discuss today?");
@@ -112,8 +210,56 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // Report generation runs as a background job that is polled until done
+    let activeReportJobId = null;
+    
+    function resetReportButton() {
+        activeReportJobId = null;
+        generateReportBtn.disabled = false;
+        generateReportBtn.innerHTML = '<i class="fas fa-file-medical me-1"></i> Generate ESA Report';
+    }
+    
+    function pollReportJob(jobId) {
+        fetch(`/api/report-jobs/${jobId}`)
+        .then(response => response.json())
+        .then(data => {
+            if (jobId !== activeReportJobId) return;
+            
+            if (data.status === 'done') {
+                resetReportButton();
+                alert('Report generated successfully!');
+                // Redirect to the report page
+                window.location.href = `/reports/${data.report_id}`;
+            } else if (data.status === 'failed') {
+                resetReportButton();
+                alert('Failed to generate report: ' + (data.message || 'Unknown error'));
+            } else if (data.status === 'cancelled') {
+                resetReportButton();
+            } else {
+                generateReportBtn.innerHTML = `<i class="fas fa-spinner fa-spin me-1"></i> Generating... ${data.progress}% (click to cancel)`;
+                setTimeout(() => pollReportJob(jobId), 2000);
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            setTimeout(() => pollReportJob(jobId), 5000);
+        });
+    }
+    
     // Handle generate report button
     generateReportBtn.addEventListener('click', function() {
+        // Clicking while a report is generating offers to cancel it
+        if (activeReportJobId) {
+            if (confirm('Cancel generating this report?')) {
+                const jobId = activeReportJobId;
+                generateReportBtn.disabled = true;
+                fetch(`/api/report-jobs/${jobId}/cancel`, { method: 'POST' })
+                .then(() => resetReportButton())
+                .catch(error => console.error('Error:', error));
+            }
+            return;
+        }
+        
         // First check if there are any messages in the chat
         if (chatMessages.childElementCount <= 1) {
             alert('Please have a conversation before generating a report.');
@@ -128,24 +274,26 @@ document.addEventListener('DOMContentLoaded', function() {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
-                }
+                },
+                body: JSON.stringify({})
             })
             .then(response => response.json())
             .then(data => {
-                generateReportBtn.disabled = false;
-                generateReportBtn.innerHTML = '<i class="fas fa-file-medical me-1"></i> Generate ESA Report';
-                
-                if (data.success) {
-                    alert('Report generated successfully!');
-                    // Redirect to the report page
+                if (!data.success) {
+                    resetReportButton();
+                    alert('Failed to generate report: ' + (data.error || 'Unknown error'));
+                } else if (data.report_id) {
+                    // An identical report already exists
+                    resetReportButton();
                     window.location.href = `/reports/${data.report_id}`;
                 } else {
-                    alert('Failed to generate report: ' + (data.error || 'Unknown error'));
+                    activeReportJobId = data.job_id;
+                    generateReportBtn.disabled = false;
+                    pollReportJob(data.job_id);
                 }
             })
             .catch(error => {
-                generateReportBtn.disabled = false;
-                generateReportBtn.innerHTML = '<i class="fas fa-file-medical me-1"></i> Generate ESA Report';
+                resetReportButton();
                 
                 alert('Error generating report. Please try again.');
                 console.error('Error:', error);
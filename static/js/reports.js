@@ -9,6 +9,43 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
     
+    // Poll report jobs that are still generating
+    function pollReportJob(jobElement) {
+        const jobId = jobElement.getAttribute('data-report-job-id');
+        
+        fetch(`/api/report-jobs/${jobId}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.status === 'done') {
+                    window.location.href = `/reports/${data.report_id}`;
+                    return;
+                }
+                if (data.status === 'failed' || data.status === 'cancelled') {
+                    jobElement.remove();
+                    return;
+                }
+                
+                jobElement.querySelector('.report-job-status').textContent = data.status;
+                jobElement.querySelector('.progress-bar').style.width = `${data.progress}%`;
+                setTimeout(() => pollReportJob(jobElement), 2000);
+            })
+            .catch(error => {
+                console.error('Error polling report job:', error);
+                setTimeout(() => pollReportJob(jobElement), 5000);
+            });
+    }
+    
+    document.querySelectorAll('.report-job').forEach(jobElement => {
+        pollReportJob(jobElement);
+        
+        jobElement.querySelector('.cancel-report-job').addEventListener('click', function() {
+            const jobId = jobElement.getAttribute('data-report-job-id');
+            this.disabled = true;
+            fetch(`/api/report-jobs/${jobId}/cancel`, { method: 'POST' })
+                .catch(error => console.error('Error cancelling report job:', error));
+        });
+    });
+    
     // Print functionality
     const printBtn = document.getElementById('printReportBtn');
     if (printBtn) {
@@ -1,4 +1,59 @@
 document.addEventListener('DOMContentLoaded', function() {
+    // Documents are processed in the background; poll their status until done
+    const pendingStatuses = ['queued', 'extracting', 'embedding'];
+    const statusBadges = {
+        queued: ['bg-secondary', 'Queued'],
+        extracting: ['bg-warning', 'Extracting'],
+        embedding: ['bg-warning', 'Embedding'],
+        done: ['bg-success', 'Processed'],
+        failed: ['bg-danger', 'Failed']
+    };
+    
+    function updateDocumentStatus(doc) {
+        const element = document.querySelector(`.uploaded-file[data-document-id="${doc.id}"]`);
+        if (!element) return;
+        
+        element.dataset.status = doc.status;
+        
+        const badge = element.querySelector('.file-status .badge');
+        const [badgeClass, label] = statusBadges[doc.status] || statusBadges.queued;
+        badge.className = `badge ${badgeClass}`;
+        badge.textContent = label;
+        badge.title = doc.message || '';
+        
+        const progressBar = element.querySelector('.progress-bar');
+        if (progressBar) {
+            if (pendingStatuses.includes(doc.status)) {
+                progressBar.style.width = `${doc.progress}%`;
+            } else {
+                progressBar.parentElement.remove();
+            }
+        }
+    }
+    
+    function pollDocumentStatus() {
+        const pendingIds = Array.from(document.querySelectorAll('.uploaded-file[data-document-id]'))
+            .filter(element => pendingStatuses.includes(element.dataset.status))
+            .map(element => element.dataset.documentId);
+        
+        if (pendingIds.length === 0) return;
+        
+        fetch(`/api/documents/status?ids=${pendingIds.join(',')}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    data.documents.forEach(updateDocumentStatus);
+                }
+                setTimeout(pollDocumentStatus, 2000);
+            })
+            .catch(error => {
+                console.error('Status polling error:', error);
+                setTimeout(pollDocumentStatus, 5000);
+            });
+    }
+    
+    pollDocumentStatus();
+    
     // Initialize Dropzone
     Dropzone.autoDiscover = false;
     
@@ -1,9 +1,13 @@
 import os
+import hashlib
 import logging
-from app import app
-from PyPDF2 import PdfReader
-import docx
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import re
+import numpy as np
+
+from metrics import timed
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -11,11 +15,90 @@ logger = logging.getLogger(__name__)
 # File extension whitelist
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx', 'rtf'}
 
+# PDFs with at least this many pages are extracted by a process pool.
+# Starting the pool costs about a second (see `flask bench-pdf-extraction`),
+# which text pages at a few ms each only win back in long files.
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", 500))
+PDF_EXTRACTION_WORKERS = int(os.environ.get("PDF_EXTRACTION_WORKERS", os.cpu_count() or 1))
+PDF_MIN_PAGES_PER_TASK = 8
+
+# Plain text files are read in blocks of this many characters
+TEXT_READ_BLOCK_SIZE = 64 * 1024
+
+# Uploads are copied to disk and hashed in blocks of this many bytes
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Bump whenever a change to the chunker changes its output, so chunks
+# stored by the previous version are not reused
+CHUNKER_VERSION = 2
+
+# Chunk size in estimated tokens, and how much consecutive chunks overlap
+CHUNK_MAX_TOKENS = int(os.environ.get("CHUNK_MAX_TOKENS", 300))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 50))
+# Sentences are packed into chunks in windows of about this many
+CHUNK_WINDOW_UNITS = 2048
+
+def file_extension(filename):
+    """Lowercase extension of a file name, without the dot"""
+    return filename.rsplit('.', 1)[1].lower()
+
 def allowed_file(filename):
     """Check if a file has an allowed extension"""
     return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+           file_extension(filename) in ALLOWED_EXTENSIONS
+
+def content_path(upload_folder, content_hash, extension):
+    """
+    Location of an upload with the given content, sharded by the first
+    hash bytes so no directory grows too large: <folder>/ab/cd/abcd....pdf
+    """
+    return os.path.join(upload_folder, content_hash[:2], content_hash[2:4],
+                        f"{content_hash}.{extension}")
 
+def file_sha256(file_path):
+    """SHA-256 hex digest of a file's content"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(UPLOAD_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def save_upload(stream, upload_folder, extension):
+    """
+    Copy an uploaded file to disk, hashing it on the way, and store it
+    under its content hash. Identical uploads share one stored copy.
+    
+    Args:
+        stream: Readable binary stream of the upload
+        upload_folder (str): Root directory of stored uploads
+        extension (str): File extension to store it with
+        
+    Returns:
+        tuple: (SHA-256 hex digest of the content, path of the stored file)
+    """
+    digest = hashlib.sha256()
+    descriptor, tmp_path = tempfile.mkstemp(dir=upload_folder, suffix=".part")
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            for block in iter(lambda: stream.read(UPLOAD_BLOCK_SIZE), b''):
+                digest.update(block)
+                file.write(block)
+        
+        content_hash = digest.hexdigest()
+        path = content_path(upload_folder, content_hash, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    return content_hash, path
+
+@timed()
 def extract_text_from_file(file_path):
     """
     Extract text content from various file types
@@ -43,26 +126,110 @@ def extract_text_from_file(file_path):
         logger.error(f"Error extracting text from {file_path}: {str(e)}")
         return ""
 
+def iter_raw_text(file_path):
+    """
+    Yield the raw, uncleaned text of a file piece by piece: pages of a PDF,
+    paragraphs of a DOCX or fixed-size blocks of a TXT file, so the whole
+    document never has to be held in memory at once. Extraction errors are
+    raised.
+    
+    Args:
+        file_path (str): Path to the file
+        
+    Yields:
+        str: Consecutive pieces of the file's text
+    """
+    file_ext = file_path.rsplit('.', 1)[1].lower()
+    
+    if file_ext == 'pdf':
+        for page_text in iter_pdf_pages(file_path):
+            yield page_text + "\f"
+    elif file_ext == 'docx':
+        import docx
+        
+        doc = docx.Document(file_path)
+        for para in doc.paragraphs:
+            yield para.text + "\n\n"
+    elif file_ext == 'txt':
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
+            for block in iter(lambda: file.read(TEXT_READ_BLOCK_SIZE), ''):
+                yield block
+    else:
+        logger.warning(f"Unsupported file type: {file_ext}")
+
+def _extract_pdf_page_range(file_path, start, stop):
+    """Extract the text of pages start..stop-1 of a PDF (runs in a worker process)"""
+    from PyPDF2 import PdfReader
+    
+    with open(file_path, 'rb') as file:
+        pdf_reader = PdfReader(file)
+        return [pdf_reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def iter_pdf_pages(file_path, parallel_min_pages=PDF_PARALLEL_MIN_PAGES, workers=PDF_EXTRACTION_WORKERS):
+    """
+    Yield the text of each page of a PDF in page order
+    
+    Large PDFs are split into page ranges that are extracted in parallel by
+    a process pool. Pages are yielded as soon as they and all earlier pages
+    are ready, so consumers can start before the whole file is parsed.
+    
+    Args:
+        file_path (str): Path to the PDF file
+        parallel_min_pages (int): Page count from which the pool is used
+        workers (int): Most processes in the pool
+        
+    Yields:
+        str: Text of each page
+    """
+    # Imported on first use to keep app startup fast
+    from PyPDF2 import PdfReader
+    
+    with open(file_path, 'rb') as file:
+        pdf_reader = PdfReader(file)
+        page_count = len(pdf_reader.pages)
+        
+        if page_count < parallel_min_pages or workers < 2 or page_count < 2 * PDF_MIN_PAGES_PER_TASK:
+            for page in pdf_reader.pages:
+                yield page.extract_text() or ""
+            return
+    
+    # A few ranges per worker keeps the pool busy when some pages are slower
+    workers = min(workers, page_count // PDF_MIN_PAGES_PER_TASK)
+    pages_per_task = max(PDF_MIN_PAGES_PER_TASK, -(-page_count // (workers * 4)))
+    ranges = [(start, min(start + pages_per_task, page_count))
+              for start in range(0, page_count, pages_per_task)]
+    
+    # Spawned rather than forked: the caller may be a threaded web worker
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [executor.submit(_extract_pdf_page_range, file_path, start, stop)
+                   for start, stop in ranges]
+        try:
+            for future in futures:
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
 def extract_text_from_pdf(file_path):
     """Extract text from PDF file"""
-    text = ""
+    pages = []
     try:
-        with open(file_path, 'rb') as file:
-            pdf_reader = PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
+        pages.extend(iter_pdf_pages(file_path))
     except Exception as e:
         logger.error(f"Error extracting text from PDF: {str(e)}")
     
-    return clean_text(text)
+    return clean_text("\f".join(pages))
 
 def extract_text_from_docx(file_path):
     """Extract text from DOCX file"""
+    import docx
+    
     text = ""
     try:
         doc = docx.Document(file_path)
         for para in doc.paragraphs:
-            text += para.text + "\n"
+            text += para.text + "\n\n"
     except Exception as e:
         logger.error(f"Error extracting text from DOCX: {str(e)}")
     
@@ -79,57 +246,278 @@ def extract_text_from_txt(file_path):
     
     return clean_text(text)
 
+_WHITESPACE_RE = re.compile(r'\s+')
+_SPECIAL_CHARS_RE = re.compile(r'[^\w\s\.\,\?\!\:\;\-\']')
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?])\s+')
+
+@timed()
 def clean_text(text):
-    """Clean and normalize text"""
+    """
+    Clean and normalize text
+    
+    Whitespace and special characters are normalized within each line, but
+    paragraph breaks (blank lines and page breaks) are kept as blank lines
+    so the chunker can split on them.
+    """
     if not text:
         return ""
     
+    return "\n\n".join(iter_clean_paragraphs([text]))
+
+def _clean_line(line):
+    """Clean a single line of text"""
     # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text)
+    line = _WHITESPACE_RE.sub(' ', line)
     
     # Remove special characters
-    text = re.sub(r'[^\w\s\.\,\?\!\:\;\-\']', '', text)
+    line = _SPECIAL_CHARS_RE.sub('', line)
     
-    return text.strip()
+    return line.strip()
 
-def split_text_into_chunks(text, chunk_size=1000, overlap=200):
+def _iter_lines(pieces):
+    """Yield the lines of text arriving in pieces; page breaks become blank lines"""
+    partial = []
+    
+    for piece in pieces:
+        if not piece:
+            continue
+        
+        lines = piece.replace('\f', '\n\n').split('\n')
+        if len(lines) == 1:
+            partial.append(piece)
+            continue
+        
+        partial.append(lines[0])
+        yield ''.join(partial)
+        yield from lines[1:-1]
+        partial = [lines[-1]]
+    
+    if partial:
+        yield ''.join(partial)
+
+def iter_clean_paragraphs(pieces):
+    """
+    Clean text arriving in pieces and yield it paragraph by paragraph
+    
+    Paragraphs are separated by blank lines or page breaks; the lines
+    within a paragraph are joined with spaces.
+    
+    Args:
+        pieces (iterable): Consecutive pieces of raw text
+        
+    Yields:
+        str: Cleaned paragraphs
+    """
+    paragraph = []
+    
+    for line in _iter_lines(pieces):
+        line = _clean_line(line)
+        if line:
+            paragraph.append(line)
+        elif paragraph:
+            yield ' '.join(paragraph)
+            paragraph = []
+    
+    if paragraph:
+        yield ' '.join(paragraph)
+
+def estimate_tokens(text):
+    """
+    Fast approximation of the number of model tokens in a text
+    
+    About 4 characters per token for English text with the OpenAI
+    tokenizers, which is close enough for sizing chunks and prompts.
+    """
+    return (len(text) + 3) // 4
+
+def _split_units(paragraph, max_tokens):
+    """
+    Split a paragraph into sentences, breaking up any sentence that
+    would not fit in a chunk on its own at word boundaries
+    """
+    max_chars = max_tokens * 4
+    units = []
+    
+    for sentence in _SENTENCE_END_RE.split(paragraph):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars + 1)
+            if cut <= 0:
+                cut = max_chars
+            units.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            units.append(sentence)
+    
+    return units
+
+def _pack_units(units, paragraph_ends, max_tokens, overlap_tokens, final):
+    """
+    Group consecutive text units into chunks of at most max_tokens
+    
+    Chunk ends are found with a binary search over cumulative token counts
+    and moved back to the last paragraph boundary when that still fills at
+    least half the budget. Chunks that end inside a paragraph overlap the
+    next one by up to overlap_tokens of whole units.
+    
+    Returns:
+        tuple: (list of (start, end) unit ranges, index of the first unit
+        not yet emitted). When final is False the last, possibly
+        incomplete chunk is left for the caller to carry over.
+    """
+    lengths = np.fromiter((len(unit) for unit in units), dtype=np.int64, count=len(units))
+    cumulative = np.concatenate(([0], np.cumsum((lengths + 3) // 4)))
+    paragraph_ends = np.asarray(paragraph_ends, dtype=bool)
+    
+    ranges = []
+    start = 0
+    count = len(units)
+    
+    while start < count:
+        # Furthest end that keeps the chunk within budget (at least one unit)
+        end = int(np.searchsorted(cumulative, cumulative[start] + max_tokens, side='right')) - 1
+        end = max(end, start + 1)
+        
+        if end >= count:
+            if not final:
+                break
+            ranges.append((start, count))
+            start = count
+            break
+        
+        # Prefer ending the chunk at a paragraph or page boundary
+        boundaries = np.flatnonzero(paragraph_ends[start:end])
+        if boundaries.size:
+            boundary_end = start + int(boundaries[-1]) + 1
+            if cumulative[boundary_end] - cumulative[start] >= max_tokens // 2:
+                end = boundary_end
+        
+        ranges.append((start, end))
+        
+        if paragraph_ends[end - 1]:
+            start = end
+        else:
+            next_start = int(np.searchsorted(cumulative, cumulative[end] - overlap_tokens, side='left'))
+            start = min(max(next_start, start + 1), end)
+    
+    return ranges, start
+
+def _join_units(units, paragraph_ends):
+    """Join units into chunk text, keeping paragraph breaks"""
+    parts = []
+    for unit, paragraph_end in zip(units, paragraph_ends):
+        parts.append(unit)
+        parts.append("\n\n" if paragraph_end else " ")
+    return ''.join(parts[:-1])
+
+def iter_chunk_spans(pieces, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Split text arriving in pieces into overlapping chunks for embedding,
+    with the position of each chunk in the cleaned text
+    
+    The text is cleaned and split into paragraphs and sentences, which are
+    packed into chunks of at most max_tokens estimated tokens, breaking at
+    paragraph and page boundaries where possible. Paragraphs are buffered
+    in bounded windows, so memory use doesn't grow with the document.
+    
+    The cleaned text is the paragraphs joined by blank lines, as returned
+    by clean_text, and each chunk's text is exactly its [start:end] slice,
+    except that a word too long for a chunk is split with a space.
+    
+    Args:
+        pieces (iterable): Consecutive pieces of raw or cleaned text
+        max_tokens (int): Token budget of each chunk
+        overlap_tokens (int): Overlap between chunks in tokens
+        
+    Yields:
+        tuple: (start offset, end offset, text) of each chunk
+    """
+    units = []
+    paragraph_ends = []
+    # Offset of each unit in the cleaned text, and of the next one
+    offsets = []
+    position = 0
+    
+    def spans(ranges):
+        for start, end in ranges:
+            yield (offsets[start], offsets[end - 1] + len(units[end - 1]),
+                   _join_units(units[start:end], paragraph_ends[start:end]))
+    
+    for paragraph in iter_clean_paragraphs(pieces):
+        paragraph_units = _split_units(paragraph, max_tokens)
+        for unit in paragraph_units:
+            offsets.append(position)
+            position += len(unit) + 1
+        # Paragraphs are separated by a blank line rather than a space
+        position += 1
+        units.extend(paragraph_units)
+        paragraph_ends.extend([False] * (len(paragraph_units) - 1) + [True])
+        
+        if len(units) >= CHUNK_WINDOW_UNITS:
+            ranges, carry = _pack_units(units, paragraph_ends, max_tokens, overlap_tokens, final=False)
+            yield from spans(ranges)
+            units = units[carry:]
+            paragraph_ends = paragraph_ends[carry:]
+            offsets = offsets[carry:]
+    
+    if units:
+        ranges, _ = _pack_units(units, paragraph_ends, max_tokens, overlap_tokens, final=True)
+        yield from spans(ranges)
+
+def iter_text_chunks(pieces, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Split text arriving in pieces into overlapping chunks for embedding
+    
+    Args:
+        pieces (iterable): Consecutive pieces of raw or cleaned text
+        max_tokens (int): Token budget of each chunk
+        overlap_tokens (int): Overlap between chunks in tokens
+        
+    Yields:
+        str: Text chunks, as made by iter_chunk_spans
+    """
+    for _, _, text in iter_chunk_spans(pieces, max_tokens=max_tokens, overlap_tokens=overlap_tokens):
+        yield text
+
+@timed()
+def split_text_into_chunks(text, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
     """
     Split text into overlapping chunks for embedding
     
     Args:
         text (str): Text to split
-        chunk_size (int): Size of each chunk in characters
-        overlap (int): Overlap between chunks in characters
+        max_tokens (int): Token budget of each chunk
+        overlap_tokens (int): Overlap between chunks in tokens
         
     Returns:
         list: List of text chunks
     """
-    if not text:
-        return []
+    return list(iter_text_chunks([text], max_tokens=max_tokens, overlap_tokens=overlap_tokens))
+
+def merge_chunk_spans(spans):
+    """
+    Join chunks of a document into one text using their offsets, dropping
+    the text each chunk repeats from the ones before
     
-    # Split by paragraphs first
-    paragraphs = text.split('\n')
-    chunks = []
-    current_chunk = ""
+    Chunks that follow each other are joined with the space or blank line
+    that separates them in the cleaned text; chunks further apart are
+    joined with a blank line.
     
-    for paragraph in paragraphs:
-        if len(current_chunk) + len(paragraph) <= chunk_size:
-            current_chunk += paragraph + "\n"
+    Args:
+        spans (list): (start offset, end offset, text) of chunks from
+            iter_chunk_spans, in document order
+        
+    Returns:
+        str: The merged text
+    """
+    parts = [spans[0][2]]
+    merged_end = spans[0][1]
+    for start, end, text in spans[1:]:
+        if end <= merged_end:
+            continue
+        if start < merged_end:
+            parts.append(text[merged_end - start:])
         else:
-            # Add current chunk to list if it's not empty
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            
-            # Start new chunk, but include overlap from previous chunk
-            if len(current_chunk) > overlap:
-                # Take the last 'overlap' characters from the previous chunk
-                overlap_text = current_chunk[-overlap:]
-                current_chunk = overlap_text + paragraph + "\n"
-            else:
-                current_chunk = paragraph + "\n"
-    
-    # Add the last chunk
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    return chunks
+            parts.append(" " if start - merged_end == 1 else "\n\n")
+            parts.append(text)
+        merged_end = end
+    return "".join(parts)
@@ -0,0 +1,285 @@
+import os
+import logging
+import numpy as np
+
+from index_store import UserIndexStore
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Exact per-user search is used for users with at most this many chunks;
+# larger users are served by the ChromaDB HNSW index. 0 disables it.
+VECTOR_INDEX_MAX_CHUNKS = int(os.environ.get("VECTOR_INDEX_MAX_CHUNKS", 2000))
+VECTOR_INDEX_DIRECTORY = os.environ.get(
+    "VECTOR_INDEX_DIRECTORY", os.path.join(os.getcwd(), 'vector_index')
+)
+
+STORAGE_DTYPES = ("float32", "float16", "int8")
+
+# Storage type of the exact-search index vectors: "float32", "float16"
+# (half the size) or "int8" (a quarter, plus a scale per vector). This only
+# shrinks these indexes and the memory they are mapped into: ChromaDB keeps
+# its own float32 copy of every vector, so PERSISTENCE_DIRECTORY does not
+# get smaller. With the smaller types the best
+# VECTOR_INDEX_RESCORE_FACTOR * top_k matches are re-ranked with
+# full-precision vectors when the caller can supply them, which for
+# retrieval costs a ChromaDB get per query; 0 skips re-ranking, trading
+# some recall (see flask bench-quantization) for that round trip.
+VECTOR_INDEX_DTYPE = os.environ.get("VECTOR_INDEX_DTYPE", "float32").lower()
+VECTOR_INDEX_RESCORE_FACTOR = int(os.environ.get("VECTOR_INDEX_RESCORE_FACTOR", 4))
+
+if VECTOR_INDEX_DTYPE not in STORAGE_DTYPES:
+    raise ValueError(f"VECTOR_INDEX_DTYPE must be one of {', '.join(STORAGE_DTYPES)}, "
+                     f"not {VECTOR_INDEX_DTYPE!r}")
+
+# Rows converted to float32 at a time when scoring a quantized matrix
+SCORE_BLOCK_ROWS = 1024
+
+def quantize(matrix, dtype):
+    """
+    Convert normalized float32 vectors to a storage type
+
+    Args:
+        matrix (array): Vectors, one per row
+        dtype (str): One of STORAGE_DTYPES
+
+    Returns:
+        tuple: (stored matrix, per-row scales for int8 or None)
+    """
+    if dtype == "float32":
+        return np.asarray(matrix, dtype=np.float32), None
+    if dtype == "float16":
+        return np.asarray(matrix, dtype=np.float16), None
+    if dtype == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    raise ValueError(f"Unknown vector storage type {dtype!r}, expected one of {', '.join(STORAGE_DTYPES)}")
+
+def storage_bytes(count, dimensions, dtype):
+    """Bytes taken by count vectors of a storage type"""
+    if dtype == "int8":
+        return count * (dimensions + 4)
+    return count * dimensions * np.dtype(dtype).itemsize
+
+class UserVectorIndex:
+    """
+    Exact nearest-neighbour search over one user's chunk embeddings.
+
+    The embeddings are L2-normalized rows of a matrix (memory-mapped from
+    disk), so cosine similarity for a query is a single matrix-vector
+    product. The matrix may be quantized to float16, or to int8 with a
+    scale per row. An index marked is_large holds no vectors; it records
+    that the user has outgrown exact search. Indexes are stamped with the
+    user's documents version they were built from.
+    """
+
+    def __init__(self, ids, matrix, documents, metadatas, is_large=False, chunk_count=None, scales=None,
+                 documents_version=None):
+        self.ids = ids
+        self.matrix = matrix
+        self.scales = scales
+        self.documents = documents
+        self.metadatas = metadatas
+        self.is_large = is_large
+        self.chunk_count = len(ids) if chunk_count is None else chunk_count
+        self.documents_version = documents_version
+
+    def _rows(self, rows):
+        """Rows of the matrix as float32 vectors"""
+        vectors = np.asarray(self.matrix[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def _scores(self, query):
+        if self.matrix.dtype == np.float32:
+            return self.matrix @ query
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for start in range(0, len(self.ids), SCORE_BLOCK_ROWS):
+            block = np.asarray(self.matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            scores[start:start + SCORE_BLOCK_ROWS] = block @ query
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def search(self, query_embedding, top_k, include_embeddings=False, full_precision=None):
+        """
+        Find the chunks most similar to a query embedding
+
+        Args:
+            query_embedding (list): Query embedding vector
+            top_k (int): Number of results to return
+            include_embeddings (bool): Also return the matches' normalized
+                embeddings, as a matrix under 'embeddings'
+            full_precision (callable): For a quantized index, takes a list
+                of chunk IDs and returns their float32 embeddings (or None
+                if it can't), to re-rank the best matches exactly
+
+        Returns:
+            dict: 'ids', 'documents', 'metadatas' and cosine 'distances' of
+            the best matches, best first
+        """
+        k = min(top_k, len(self.ids))
+        if k <= 0:
+            results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+            if include_embeddings:
+                results["embeddings"] = np.zeros((0, 0), np.float32)
+            return results
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = self._scores(query)
+
+        exact = None
+        if self.matrix.dtype != np.float32 and full_precision is not None and VECTOR_INDEX_RESCORE_FACTOR > 0:
+            # Over-fetch with the approximate scores, then re-rank exactly
+            candidates = min(k * VECTOR_INDEX_RESCORE_FACTOR, len(self.ids))
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            exact = full_precision([self.ids[i] for i in top])
+            if exact is not None:
+                exact = np.asarray(exact, dtype=np.float32)
+                exact /= np.maximum(np.linalg.norm(exact, axis=1, keepdims=True), 1e-12)
+                exact_scores = exact @ query
+                order = np.argsort(-exact_scores, kind="stable")[:k]
+                top, exact = top[order], exact[order]
+                top_scores = exact_scores[order]
+
+        if exact is None:
+            # Select the top k in linear time, then sort just those
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            top_scores = scores[top]
+
+        results = {
+            "ids": [self.ids[i] for i in top],
+            "documents": [self.documents[i] for i in top],
+            "metadatas": [self.metadatas[i] for i in top],
+            "distances": [float(1.0 - score) for score in top_scores],
+        }
+        if include_embeddings:
+            results["embeddings"] = exact if exact is not None else self._rows(top)
+        return results
+
+def mmr_select(relevance, embeddings, k, diversity_weight):
+    """
+    Pick k candidates by maximal marginal relevance: each pick is the
+    candidate with the best relevance after subtracting its cosine
+    similarity to the closest one already picked
+
+    Args:
+        relevance (array): Relevance of each candidate to the query, from 0 to 1
+        embeddings (array): Candidate embeddings, one per row
+        k (int): Number of candidates to pick
+        diversity_weight (float): Weight of the redundancy penalty, from 0
+            (rank by relevance only) to 1 (only avoid redundancy)
+
+    Returns:
+        list: Row indices of the picked candidates, in pick order
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    k = min(k, matrix.shape[0])
+    if k <= 0:
+        return []
+
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    relevance = (1.0 - diversity_weight) * np.asarray(relevance, dtype=np.float32)
+    similarity = diversity_weight * (matrix @ matrix.T)
+
+    picked = [int(np.argmax(relevance))]
+    redundancy = similarity[picked[0]].copy()
+    available = np.ones(matrix.shape[0], dtype=bool)
+    available[picked[0]] = False
+
+    while len(picked) < k:
+        scores = np.where(available, relevance - redundancy, -np.inf)
+        pick = int(np.argmax(scores))
+        picked.append(pick)
+        available[pick] = False
+        np.maximum(redundancy, similarity[pick], out=redundancy)
+
+    return picked
+
+_store = UserIndexStore(VECTOR_INDEX_DIRECTORY, ".npy", "vector")
+
+def _from_files(meta, matrix_path):
+    documents_version = meta["documents_version"]
+    if meta.get("is_large"):
+        return UserVectorIndex([], None, [], [], is_large=True, chunk_count=meta["chunk_count"],
+                               documents_version=documents_version)
+    if meta.get("dtype", "float32") != VECTOR_INDEX_DTYPE:
+        # Built with another storage type; rebuild
+        return None
+    matrix = np.load(matrix_path, mmap_mode='r') if meta["ids"] else np.zeros((0, 0), np.float32)
+    if matrix.shape[0] != len(meta["ids"]):
+        # Caught between writes of the two files; rebuild
+        return None
+    scales = np.asarray(meta["scales"], dtype=np.float32) if meta.get("scales") else None
+    return UserVectorIndex(meta["ids"], matrix, meta["documents"], meta["metadatas"], scales=scales,
+                           documents_version=documents_version)
+
+def load_user_index(user_id, documents_version):
+    """
+    Load a user's index from disk, reusing the in-process copy while the
+    files are unchanged
+
+    Args:
+        user_id (int): ID of the user
+        documents_version (int): The user's current documents version; an
+            index built from another version of their documents is stale
+
+    Returns:
+        UserVectorIndex: The index, or None if it has not been built or is stale
+    """
+    return _store.load(user_id, documents_version, _from_files)
+
+def build_user_index(user_id, documents_version, ids, embeddings, documents, metadatas):
+    """
+    Write a user's index to disk
+
+    Args:
+        user_id (int): ID of the user
+        documents_version (int): The user's documents version, read before
+            the chunks were
+        ids (list): Chunk IDs
+        embeddings (list): Chunk embedding vectors
+        documents (list): Chunk texts
+        metadatas (list): Chunk metadata dicts
+
+    Returns:
+        UserVectorIndex: The new index
+    """
+    scales = None
+    write_matrix = None
+    if len(ids):
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1.0, norms)
+        matrix, scales = quantize(matrix, VECTOR_INDEX_DTYPE)
+        # np.save appends .npy to names without it, so write through a file object
+        def write_matrix(path):
+            with open(path, 'wb') as file:
+                np.save(file, matrix)
+    else:
+        matrix = np.zeros((0, 0), np.float32)
+
+    meta = {"ids": list(ids), "documents": list(documents), "metadatas": list(metadatas),
+            "dtype": VECTOR_INDEX_DTYPE, "documents_version": documents_version}
+    if scales is not None:
+        meta["scales"] = scales.tolist()
+    _store.save(user_id, meta, write_matrix)
+
+    logger.info(f"Built {VECTOR_INDEX_DTYPE} vector index for user {user_id} with {len(ids)} chunks")
+    return UserVectorIndex(meta["ids"], matrix, meta["documents"], meta["metadatas"], scales=scales,
+                           documents_version=documents_version)
+
+def mark_user_index_large(user_id, documents_version, chunk_count):
+    """Record that a user has too many chunks for exact search"""
+    _store.save(user_id, {"is_large": True, "chunk_count": chunk_count,
+                          "documents_version": documents_version})
+    return UserVectorIndex([], None, [], [], is_large=True, chunk_count=chunk_count,
+                           documents_version=documents_version)
+
+def invalidate_user_index(user_id):
+    """Drop a user's index after their documents change; it is rebuilt on next use"""
+    _store.invalidate(user_id)
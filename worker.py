@@ -0,0 +1,192 @@
+"""
+Background worker for document ingestion, report generation and chat
+summaries.
+
+Uploaded documents, report requests and chat summary updates are queued
+in the database with status 'queued'. Each worker process claims queued
+rows one at a time and runs documents through rag.process_document,
+report jobs through report_generator.process_report_job and summary jobs
+through prompt_builder.process_summary_job, which record their progress
+on the row.
+
+Usage:
+    python worker.py [--processes N]
+"""
+import os
+import time
+import signal
+import logging
+import argparse
+import datetime
+import multiprocessing
+from sqlalchemy import update, func
+
+from logging_config import configure_logging
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.environ.get("INGESTION_POLL_INTERVAL", 2))
+# Jobs stuck in an in-progress state this long belonged to a worker that died
+STALE_AFTER_SECONDS = int(os.environ.get("INGESTION_STALE_SECONDS", 900))
+MAX_ATTEMPTS = int(os.environ.get("INGESTION_MAX_ATTEMPTS", 3))
+
+def _requeue_stale(model, in_progress_statuses):
+    """Requeue or fail jobs of one kind that have been in progress too long"""
+    from app import db
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=STALE_AFTER_SECONDS)
+    stale = (model.status.in_(in_progress_statuses), model.status_updated < cutoff)
+
+    failed = db.session.execute(
+        update(model)
+        .where(*stale, func.coalesce(model.attempts, 0) >= MAX_ATTEMPTS)
+        .values(status='failed', status_message="Processing did not complete",
+                status_updated=datetime.datetime.utcnow())
+    ).rowcount
+    requeued = db.session.execute(
+        update(model)
+        .where(*stale)
+        .values(status='queued', progress=0, status_updated=datetime.datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+
+    if failed or requeued:
+        logger.warning(f"Recovered stale {model.__tablename__} jobs: {requeued} requeued, {failed} failed")
+    return failed + requeued
+
+def requeue_stale_jobs():
+    """
+    Put documents, report jobs and summary jobs abandoned mid-processing
+    back on the queue, or mark them failed once they have used up their
+    attempts
+
+    Returns:
+        int: Number of jobs requeued or failed
+    """
+    from models import Document, ReportJob, SummaryJob
+
+    return (_requeue_stale(Document, ('extracting', 'embedding')) +
+            _requeue_stale(ReportJob, ('running',)) +
+            _requeue_stale(SummaryJob, ('running',)))
+
+def _claim_next(model, claimed_status):
+    """
+    Atomically claim the oldest queued row of a job model for this worker
+
+    The status is only changed if the row is still queued, so two workers
+    racing for the same row can't both claim it.
+
+    Returns:
+        int: ID of the claimed row, or None if the queue is empty
+    """
+    from app import db
+
+    candidate_ids = db.session.execute(
+        db.select(model.id)
+        .where(model.status == 'queued')
+        .order_by(model.id)
+        .limit(10)
+    ).scalars().all()
+
+    for job_id in candidate_ids:
+        claimed = db.session.execute(
+            update(model)
+            .where(model.id == job_id, model.status == 'queued')
+            .values(status=claimed_status, progress=0,
+                    attempts=func.coalesce(model.attempts, 0) + 1,
+                    status_updated=datetime.datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+
+        if claimed == 1:
+            return job_id
+
+    return None
+
+def run_once():
+    """
+    Run a single queued job. Report jobs go first since a user is
+    waiting on the page for them, then summary jobs, which are short and
+    keep ongoing chats' prompts complete.
+
+    Returns:
+        bool: True if a job was claimed, False if the queues were empty
+    """
+    from models import Document, ReportJob, SummaryJob
+    from rag import process_document
+    from report_generator import process_report_job
+    from prompt_builder import process_summary_job
+
+    job_id = _claim_next(ReportJob, 'running')
+    if job_id is not None:
+        logger.info(f"Running report job {job_id}")
+        process_report_job(job_id)
+        return True
+
+    job_id = _claim_next(SummaryJob, 'running')
+    if job_id is not None:
+        logger.info(f"Running summary job {job_id}")
+        process_summary_job(job_id)
+        return True
+
+    document_id = _claim_next(Document, 'extracting')
+    if document_id is not None:
+        logger.info(f"Processing document {document_id}")
+        process_document(document_id)
+        return True
+
+    return False
+
+def run_worker(poll_interval=POLL_INTERVAL):
+    """Worker process main loop: claim and run jobs until stopped"""
+    # Forked from main(); start this process's own log writer
+    configure_logging()
+    from app import app, db
+
+    with app.app_context():
+        last_recovery = 0
+        while True:
+            try:
+                if time.monotonic() - last_recovery > STALE_AFTER_SECONDS / 2:
+                    requeue_stale_jobs()
+                    last_recovery = time.monotonic()
+
+                if not run_once():
+                    time.sleep(poll_interval)
+            except Exception as e:
+                logger.error(f"Background worker error: {str(e)}")
+                db.session.rollback()
+                time.sleep(poll_interval)
+            finally:
+                db.session.remove()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run background document and report workers")
+    parser.add_argument("--processes", type=int,
+                        default=int(os.environ.get("INGESTION_WORKERS", 2)),
+                        help="number of worker processes")
+    args = parser.parse_args()
+
+    configure_logging()
+
+    # The app is only imported inside the children, so no database
+    # connections are shared across the fork
+    workers = [multiprocessing.Process(target=run_worker, name=f"worker-{i}")
+               for i in range(max(1, args.processes))]
+    for process in workers:
+        process.start()
+    logger.info(f"Started {len(workers)} background worker processes")
+
+    def shutdown(signum, frame):
+        for process in workers:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for process in workers:
+        process.join()
+
+if __name__ == "__main__":
+    main()